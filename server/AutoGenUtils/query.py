@@ -1,6 +1,5 @@
 import json
 from server.custom_types import Node, PrimitiveTaskDescription
-from autogen_core import CancellationToken
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.messages import TextMessage
@@ -8,7 +7,11 @@ from tqdm import tqdm
 import asyncio
 import re
 
-from server.utils import extract_json_content, retry_llm_json_extraction
+from server.utils import (
+    extract_json_content,
+    retry_llm_json_extraction,
+    cancellation_token,
+)
 
 
 def save_json(data, filename):
@@ -19,7 +22,7 @@ def save_json(data, filename):
 async def call_agent(agent, user_message):
     response = await agent.on_messages(
         [TextMessage(content=user_message, source="user")],
-        cancellation_token=CancellationToken(),
+        cancellation_token=cancellation_token(),
     )
     return response
 
@@ -85,7 +88,7 @@ async def run_goal_decomposition_agent(goal: str, model: str, api_key: str):
     result = await retry_llm_json_extraction(
         llm_call_func=goal_decomposition_agent.on_messages,
         llm_call_args=([TextMessage(content=goal, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="steps",
         max_retries=3,
     )
@@ -190,7 +193,7 @@ async def run_goal_decomposition_agent_stepped(
     result = await retry_llm_json_extraction(
         llm_call_func=goal_decomposition_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="next_steps",
         max_retries=5,
         retry_delay=1.0,
@@ -264,7 +267,7 @@ async def run_decomposition_self_evaluation_agent(
         result = await retry_llm_json_extraction(
             llm_call_func=decomposition_self_evaluation_agent.on_messages,
             llm_call_args=([TextMessage(content=user_message, source="user")],),
-            llm_call_kwargs={"cancellation_token": CancellationToken()},
+            llm_call_kwargs={"cancellation_token": cancellation_token()},
             expected_key="evaluation_score",
             max_retries=3,
             retry_delay=1.0,
@@ -287,6 +290,100 @@ async def run_decomposition_self_evaluation_agent(
         return responses
 
 
+async def run_batch_decomposition_self_evaluation_agent(
+    goal: str, candidates: list[tuple[list, list]], model: str, api_key: str
+) -> list[list[int]]:
+    """Evaluates the next steps of several beams in a single request.
+    Args:
+        candidates: A list of (previous_steps, next_steps) tuples, one per beam.
+    Returns:
+        One list of scores per beam, aligned with its next_steps.
+    """
+    model_client = OpenAIChatCompletionClient(
+        model=model,
+        api_key=api_key,
+        temperature=0.0,
+        model_capabilities={
+            "vision": False,
+            "function_calling": False,
+            "json_output": True,
+        },
+    )
+    decomposition_self_evaluation_agent = AssistantAgent(
+        name="decomposition_batch_self_evaluation_agent",
+        model_client=model_client,
+        system_message="""
+        ** Context **
+        You are a text analytics expert.
+        Users will describe a text analytics goal and several alternative plans they are considering.
+        Each plan lists the steps taken so far and candidate next steps.
+        ** Task **
+        Your task is to evaluate the correctness of every candidate next step, given the steps of its own plan.
+        ** Requirements **
+        Give each candidate a score from 0 to 5, where 0 is completely incorrect and 5 is perfect.
+        Evaluate every candidate independently. Do not compare candidates across plans.
+        Reply with this JSON format:
+            {
+                "evaluation_scores": [
+                    {
+                        "candidate_id": (string) the id of the candidate,
+                        "evaluation_score": (int) 0-5
+                    },
+                    ...
+                ]
+            }  """,
+    )
+    user_message = "My goal is: {goal}".format(goal=goal) + "\n"
+    for beam_index, (previous_steps, next_steps) in enumerate(candidates):
+        user_message += f"<plan>\n<plan_id> {beam_index} </plan_id>\n"
+        if len(previous_steps) > 0:
+            previous_steps_str = "\n".join(
+                list(
+                    map(lambda s: f"{s['label']}: {s['description']}", previous_steps)
+                )
+            )
+            user_message += "Steps done so far: \n{previous_steps}\n".format(
+                previous_steps=previous_steps_str
+            )
+        for step_index, next_step in enumerate(next_steps):
+            user_message += (
+                "<candidate> <candidate_id> {beam_index}-{step_index} </candidate_id> "
+                "{label}: {description} </candidate>\n".format(
+                    beam_index=beam_index,
+                    step_index=step_index,
+                    label=next_step["label"],
+                    description=next_step["description"],
+                )
+            )
+        user_message += "</plan>\n"
+
+    result = await retry_llm_json_extraction(
+        llm_call_func=decomposition_self_evaluation_agent.on_messages,
+        llm_call_args=([TextMessage(content=user_message, source="user")],),
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
+        expected_key="evaluation_scores",
+        max_retries=3,
+        retry_delay=1.0,
+        backoff_factor=2.0,
+    )
+    scores = {}
+    for evaluation in result or []:
+        try:
+            scores[str(evaluation["candidate_id"]).strip()] = int(
+                evaluation["evaluation_score"]
+            )
+        except (KeyError, TypeError, ValueError):
+            continue
+    # candidates the model skipped get a neutral score, as in the single evaluation
+    return [
+        [
+            scores.get(f"{beam_index}-{step_index}", 3)
+            for step_index in range(len(next_steps))
+        ]
+        for beam_index, (_, next_steps) in enumerate(candidates)
+    ]
+
+
 async def run_stepped_decomposition_to_primitive_task_agent(
     tree: list[Node],
     primitive_task_list: list[PrimitiveTaskDescription],
@@ -509,7 +606,7 @@ async def run_stepped_decomposition_to_primitive_task_agent(
         result = await retry_llm_json_extraction(
             llm_call_func=decomposition_to_primitive_task_agent.on_messages,
             llm_call_args=([TextMessage(content=user_message, source="user")],),
-            llm_call_kwargs={"cancellation_token": CancellationToken()},
+            llm_call_kwargs={"cancellation_token": cancellation_token()},
             expected_key="primitive_tasks",
             max_retries=3,
             retry_delay=1.0,
@@ -665,7 +762,7 @@ async def run_decomposition_to_primitive_task_agent(
     return await retry_llm_json_extraction(
         llm_call_func=decomposition_to_primitive_task_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="primitive_tasks",
         max_retries=3,
         retry_delay=1.0,
@@ -722,7 +819,7 @@ async def run_task_decomposition_agent(task: Node, model: str, api_key: str):
     return await retry_llm_json_extraction(
         llm_call_func=goal_decomposition_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="steps",
         max_retries=3,
         retry_delay=1.0,
@@ -820,7 +917,7 @@ async def _run_decomposition_to_primitive_task_agent(
     return await retry_llm_json_extraction(
         llm_call_func=decomposition_to_primitive_task_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="primitive_tasks",
         max_retries=3,
         retry_delay=1.0,
@@ -931,7 +1028,7 @@ async def run_prompt_generation_agent(
     result = await retry_llm_json_extraction(
         llm_call_func=prompt_generation_agent.on_messages,
         llm_call_args=([TextMessage(content=task_message, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=5,
         retry_delay=1.0,
         backoff_factor=2.0,
@@ -1045,7 +1142,7 @@ async def run_input_key_generation_agent(
     return await retry_llm_json_extraction(
         llm_call_func=prompt_generation_agent.on_messages,
         llm_call_args=([TextMessage(content=task_message, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="required_keys",
         max_retries=3,
         retry_delay=1.0,
@@ -1118,7 +1215,7 @@ async def run_result_evaluator_generation_agent(
     return await retry_llm_json_extraction(
         llm_call_func=prompt_generation_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         expected_key="evaluator_specification",
         max_retries=3,
         retry_delay=1.0,
@@ -1431,7 +1528,7 @@ CORRECTED:
     return await retry_llm_json_extraction(
         llm_call_func=data_transform_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=3,
         retry_delay=1.0,
         backoff_factor=2.0,
@@ -1576,7 +1673,7 @@ async def run_clustering_plan_agent(
     return await retry_llm_json_extraction(
         llm_call_func=clustering_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=3,
         retry_delay=1.0,
         backoff_factor=2.0,
@@ -1708,7 +1805,7 @@ async def run_dim_reduction_plan_agent(
     return await retry_llm_json_extraction(
         llm_call_func=dim_reduction_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=3,
         retry_delay=1.0,
         backoff_factor=2.0,
@@ -1827,7 +1924,7 @@ async def run_embedding_plan_agent(
     return await retry_llm_json_extraction(
         llm_call_func=embedding_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=3,
         retry_delay=1.0,
         backoff_factor=2.0,
@@ -1957,7 +2054,7 @@ async def run_segmentation_plan_agent(
     return await retry_llm_json_extraction(
         llm_call_func=segmentation_agent.on_messages,
         llm_call_args=([TextMessage(content=user_message_content, source="user")],),
-        llm_call_kwargs={"cancellation_token": CancellationToken()},
+        llm_call_kwargs={"cancellation_token": cancellation_token()},
         max_retries=3,
         retry_delay=1.0,
         backoff_factor=2.0,
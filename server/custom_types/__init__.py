@@ -4,6 +4,9 @@ from .custom_types import (
     PrimitiveTaskDescription,
     UserExecutionState,
     BaseStateSchema,
+    DocumentTable,
+    DocumentRecords,
+    MatrixColumn,
     SemanticTaskResponse,
     MCT_Node,
     # ScoreWithReasoning,
@@ -15,6 +18,9 @@ __all__ = [
     "PrimitiveTaskDescription",
     "UserExecutionState",
     "BaseStateSchema",
+    "DocumentTable",
+    "DocumentRecords",
+    "MatrixColumn",
     "SemanticTaskResponse",
     "MCT_Node",
     # "ScoreWithReasoning",
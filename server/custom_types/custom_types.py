@@ -1,5 +1,10 @@
+import json
+import os
+import uuid
+import numpy as np
 from pydantic import BaseModel, Field
-from typing import TypedDict, Annotated, Any, Dict, List, Optional
+from dataclasses import dataclass, field
+from typing import TypedDict, Annotated, Any, Dict, List, Optional, Union
 
 # from typing import NotRequired
 
@@ -50,8 +55,235 @@ class MCT_Node(Node):
     user_evaluation: Evaluation = Evaluation()
 
 
+@dataclass
+class MatrixColumn:
+    """A DocumentTable column of vectors (i.e. embeddings) stored as one contiguous
+    float32 matrix. Documents reference their vectors by row: rows[i] is a row index,
+    a [start, stop] range for a document with several vectors, or None.
+    Indexing returns views of the matrix, use to_list() at the API boundary.
+    """
+
+    matrix: np.ndarray
+    rows: list[Union[int, list[int], None]]
+
+    @classmethod
+    def from_values(cls, values: list, mmap_dir: str = None) -> "MatrixColumn":
+        """Stacks the vectors of each document into one matrix.
+        A value is a vector, a list of vectors, or empty. With mmap_dir the matrix
+        is written to a .npy file there and memory-mapped read-only.
+        Raises ValueError if the values are not numeric vectors of one dimension.
+        """
+        blocks = []
+        rows = []
+        n_rows = 0
+        for value in values:
+            block = None if value is None else np.asarray(value, dtype=np.float32)
+            if block is None or block.size == 0:
+                rows.append(None)
+                continue
+            if block.ndim == 1:
+                rows.append(n_rows)
+                block = block[np.newaxis, :]
+            elif block.ndim == 2:
+                rows.append([n_rows, n_rows + len(block)])
+            else:
+                raise ValueError(f"Expected vectors, got an array of shape {block.shape}")
+            blocks.append(block)
+            n_rows += len(block)
+        dims = {block.shape[1] for block in blocks}
+        if len(dims) > 1:
+            raise ValueError(f"Vectors of different dimensions: {sorted(dims)}")
+        shape = (n_rows, dims.pop() if dims else 0)
+        if mmap_dir is None or n_rows == 0:
+            matrix = np.concatenate(blocks) if blocks else np.empty(shape, np.float32)
+            return cls(matrix=matrix, rows=rows)
+        os.makedirs(mmap_dir, exist_ok=True)
+        path = os.path.join(mmap_dir, f"{uuid.uuid4().hex}.npy")
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+        np.concatenate(blocks, out=matrix)
+        matrix.flush()
+        del matrix
+        return cls(matrix=np.load(path, mmap_mode="r"), rows=rows)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "MatrixColumn":
+        header, body = data.split(b"\0", 1)
+        header = json.loads(header)
+        matrix = np.frombuffer(body, dtype=np.float32).reshape(header["shape"])
+        return cls(matrix=matrix, rows=header["rows"])
+
+    def to_bytes(self) -> bytes:
+        header = {"shape": list(self.matrix.shape), "rows": self.rows}
+        body = np.ascontiguousarray(self.matrix, dtype=np.float32).tobytes()
+        return json.dumps(header).encode() + b"\0" + body
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> Optional[np.ndarray]:
+        row = self.rows[i]
+        if row is None:
+            return None
+        if isinstance(row, int):
+            return self.matrix[row]
+        return self.matrix[row[0] : row[1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.rows)))
+
+    def positions(self) -> tuple[list[int], list[int]]:
+        """(document index, position in the document) of every matrix row"""
+        doc_indices = []
+        positions = []
+        for i, row in enumerate(self.rows):
+            if row is None:
+                continue
+            count = 1 if isinstance(row, int) else row[1] - row[0]
+            doc_indices.extend([i] * count)
+            positions.extend(range(count))
+        return doc_indices, positions
+
+    def to_list(self) -> list:
+        return [None if value is None else value.tolist() for value in self]
+
+
+class DocumentRecords(list):
+    """Documents selected from a DocumentTable.
+    Vector values are views of the matrix columns, which tools can read as a whole
+    from `matrices` (key -> MatrixColumn) instead of stacking the values again.
+    """
+
+    def __init__(self, records=(), matrices: dict[str, MatrixColumn] = None):
+        super().__init__(records)
+        self.matrices = matrices or {}
+
+
+@dataclass
+class DocumentTable:
+    """Columnar storage of the execution documents.
+    Each document key is a column of values. A node output adds or replaces columns
+    and shares the untouched ones with its input, so it costs O(new columns).
+    Columns are never modified in place. Use to_records() at the API boundary.
+    A column is a list of values or a MatrixColumn of vectors.
+    """
+
+    columns: dict[str, Union[list, MatrixColumn]] = field(default_factory=dict)
+    length: int = 0
+    # column -> indices of the documents that do not have the key
+    missing: dict[str, list[int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> "DocumentTable":
+        return cls(length=len(records)).with_rows(records)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def keys(self) -> list[str]:
+        return list(self.columns.keys())
+
+    def has(self, key: str) -> bool:
+        return key in self.columns
+
+    def column(self, key: str) -> Union[list, MatrixColumn]:
+        """The values of the key, None for the documents without it"""
+        return self.columns[key]
+
+    def matrix(self, key: str) -> Optional[MatrixColumn]:
+        """The column of the key if it is stored as a matrix of vectors"""
+        column = self.columns.get(key)
+        return column if isinstance(column, MatrixColumn) else None
+
+    def select(self, keys: list[str]) -> "DocumentRecords":
+        """Projects the documents to the given keys"""
+        keys = [key for key in keys if key in self.columns]
+        missing = {key: set(self.missing.get(key, [])) for key in keys}
+        return DocumentRecords(
+            [
+                {
+                    key: self.columns[key][i]
+                    for key in keys
+                    if not missing[key] or i not in missing[key]
+                }
+                for i in range(self.length)
+            ],
+            matrices={
+                key: self.columns[key]
+                for key in keys
+                if isinstance(self.columns[key], MatrixColumn)
+            },
+        )
+
+    def to_records(self) -> list[dict]:
+        return self.select(self.keys())
+
+    def with_columns(
+        self, columns: dict[str, list], missing: dict[str, list[int]] = None
+    ) -> "DocumentTable":
+        """A new table with the columns added or replaced"""
+        missing = missing or {}
+        new_missing = {
+            key: indices for key, indices in self.missing.items() if key not in columns
+        }
+        new_missing.update(
+            {key: indices for key, indices in missing.items() if indices}
+        )
+        return DocumentTable(
+            columns={**self.columns, **columns},
+            length=self.length,
+            missing=new_missing,
+        )
+
+    def take(self, indices: list[int]) -> "DocumentTable":
+        """A new table of the documents at the indices, matrices are shared"""
+        columns = {}
+        for key, column in self.columns.items():
+            if isinstance(column, MatrixColumn):
+                rows = [column.rows[i] for i in indices]
+                columns[key] = MatrixColumn(matrix=column.matrix, rows=rows)
+            else:
+                columns[key] = [column[i] for i in indices]
+        missing = {}
+        for key, key_missing in self.missing.items():
+            key_missing = set(key_missing)
+            missing[key] = [j for j, i in enumerate(indices) if i in key_missing]
+        return DocumentTable(
+            columns=columns,
+            length=len(indices),
+            missing={key: value for key, value in missing.items() if value},
+        )
+
+    def with_rows(self, rows: list[dict]) -> "DocumentTable":
+        """A new table with the keys of rows[i] merged into document i.
+        Documents past the end of rows have no row, as if their row were empty.
+        Raises ValueError if there are more rows than documents.
+        """
+        if len(rows) > self.length:
+            raise ValueError(f"{len(rows)} rows for {self.length} documents")
+        columns = {}
+        for i, row in enumerate(rows):
+            for key in row:
+                if key not in columns:
+                    columns[key] = [None] * self.length
+                columns[key][i] = row[key]
+        missing = {
+            key: [
+                i for i in range(self.length) if i >= len(rows) or key not in rows[i]
+            ]
+            for key in columns
+        }
+        # documents without a row keep their previous value of the key
+        for key, indices in missing.items():
+            if key in self.columns and indices:
+                previous_missing = set(self.missing.get(key, []))
+                for i in indices:
+                    columns[key][i] = self.columns[key][i]
+                missing[key] = [i for i in indices if i in previous_missing]
+        return self.with_columns(columns, missing)
+
+
 class BaseStateSchema(TypedDict):
-    documents: Annotated[list, lambda a, b: b]
+    documents: Annotated[DocumentTable, lambda a, b: b]
     global_store: Annotated[
         dict[str, Any], lambda x, y: y
     ]  # a global storage for dynamic data (i.e. aggregated data on all docs)
@@ -13,6 +13,7 @@ from .monte_carlo_tree_search import (
     recalculate_node_values,
     # collect_MCT_node_dict,
 )
+from .oracles import Oracle, LLMOracle, CascadeOracle, SimulatedOracle
 
 __all__ = [
     "goal_decomposition",
@@ -26,4 +27,8 @@ __all__ = [
     "stream_MCTS",
     "MCTS_regenerate",
     "recalculate_node_values",
+    "Oracle",
+    "LLMOracle",
+    "CascadeOracle",
+    "SimulatedOracle",
 ]
@@ -1,19 +1,60 @@
-import server.AutoGenUtils.query as autogen_utils
+import asyncio
 import random
 import copy
+import time
 from collections import defaultdict
+from .oracles import Oracle, get_oracle
+
+MAX_STEPS = 5
+# seconds the fused evaluation always gets, even when the expansion used up the deadline
+MIN_EVALUATION_SECONDS = 5.0
+# score of the candidates whose evaluation ran past the deadline
+UNSCORED = 0
 
 
 async def goal_decode_n_samples(
-    goal: str, previous_steps: list, model: str, api_key: str, n: int = 2
+    goal: str,
+    previous_steps: list,
+    model: str,
+    api_key: str,
+    n: int = 2,
+    oracle: Oracle | None = None,
 ):
-    candidate_steps = []
-    next_steps = await autogen_utils.run_goal_decomposition_agent_stepped(
-        goal, previous_steps, model, api_key, n
+    oracle = get_oracle(oracle)
+    next_steps = await generate_next_steps(
+        goal, previous_steps, model, api_key, n, oracle=oracle
+    )
+    evaluation_scores = await oracle.self_evaluate(
+        goal, previous_steps, next_steps, model, api_key
     )
-    evaluation_scores = await autogen_utils.run_decomposition_self_evaluation_agent(
-        goal, previous_steps, next_steps, model, api_key, n
+    return make_candidates(previous_steps, next_steps, evaluation_scores)
+
+
+async def generate_next_steps(
+    goal: str,
+    previous_steps: list,
+    model: str,
+    api_key: str,
+    n: int = 2,
+    oracle: Oracle | None = None,
+) -> list[dict]:
+    next_steps = await get_oracle(oracle).expand(
+        goal,
+        previous_steps,
+        model=model,
+        api_key=api_key,
+        temperature=1.0,
+        n=n,
+        remain_steps=MAX_STEPS - len(previous_steps),
     )
+    # steps are numbered by their position in the beam
+    for next_step in next_steps:
+        next_step["id"] = str(len(previous_steps))
+    return next_steps
+
+
+def make_candidates(previous_steps: list, next_steps: list, evaluation_scores: list):
+    candidate_steps = []
     for next_step, evaluation_score in zip(next_steps, evaluation_scores):
         new_beam = copy.deepcopy(previous_steps)
         new_beam.append(next_step)
@@ -26,48 +67,135 @@ async def goal_decode_n_samples(
             task["complexity"] = random.random()
             decomposed_semantic_tasks[j] = task
         decomposed_semantic_tasks = add_children(decomposed_semantic_tasks)
-    candidate_steps[i] = (decomposed_semantic_tasks, eval_score)
+        candidate_steps[i] = (decomposed_semantic_tasks, eval_score)
     return candidate_steps
 
 
+def is_finished(beam: list) -> bool:
+    return len(beam) > 0 and beam[-1]["label"] == "END"
+
+
+async def wait_for_beams(tasks: list[asyncio.Task], deadline: float | None) -> set:
+    """Waits for the beam tasks until the deadline (seconds) and cancels the late ones.
+    If no beam finishes in time, the first one to finish is kept so the search advances."""
+    if not tasks:
+        return set()
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    if not done:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"Beam search deadline: dropped {len(pending)} of {len(tasks)} beams")
+    return done
+
+
 async def beam_search_decomposition_step(
-    goal: str, candidate_steps: list, model: str, api_key: str, k: int = 2, n: int = 2
+    goal: str,
+    candidate_steps: list,
+    model: str,
+    api_key: str,
+    k: int = 2,
+    n: int = 2,
+    oracle: Oracle | None = None,
+    fused: bool = True,
+    deadline: float | None = None,
 ):
-    new_candidates = []
-    for beam, score in candidate_steps:
-        previous_steps = beam
-        if previous_steps[-1]["label"] == "END":
+    """Expands all unfinished beams concurrently and keeps the top k candidates.
+    With fused, the candidates of all beams are self-evaluated in one request once
+    they are generated, otherwise every beam evaluates its own candidates as soon as
+    they are ready. The deadline (seconds) bounds the whole step: beams not expanded
+    by then are dropped. The fused evaluation gets the rest of the deadline, at least
+MIN_EVALUATION_SECONDS, and the candidates it did not score in time are kept unscored."""
+    start = time.monotonic()
+    oracle = get_oracle(oracle)
+    # finished beams compete with the new candidates instead of disappearing
+    new_candidates = [
+        (beam, score) for beam, score in candidate_steps if is_finished(beam)
+    ]
+    open_beams = [beam for beam, _ in candidate_steps if not is_finished(beam)]
+    if fused:
+        tasks = [
+            asyncio.create_task(
+                generate_next_steps(goal, beam, model, api_key, n, oracle=oracle)
+            )
+            for beam in open_beams
+        ]
+    else:
+        tasks = [
+            asyncio.create_task(
+                goal_decode_n_samples(goal, beam, model, api_key, n, oracle=oracle)
+            )
+            for beam in open_beams
+        ]
+    done = await wait_for_beams(tasks, deadline)
+    results = []
+    for beam, task in zip(open_beams, tasks):
+        if task not in done:
             continue
-        new_candidates += await goal_decode_n_samples(
-            goal, previous_steps, model, api_key, n
-        )
+        if task.exception() is not None:
+            print(f"Error in beam expansion: {task.exception()}")
+            continue
+        results.append((beam, task.result()))
+
+    if fused:
+        if results:
+            remaining = None
+            if deadline is not None:
+                remaining = max(
+                    MIN_EVALUATION_SECONDS, deadline - (time.monotonic() - start)
+                )
+            try:
+                evaluation_scores = await asyncio.wait_for(
+                    oracle.batch_self_evaluate(goal, results, model, api_key),
+                    remaining,
+                )
+            except asyncio.TimeoutError:
+                print(f"Beam search deadline: kept {len(results)} beams unscored")
+                evaluation_scores = [
+                    [UNSCORED] * len(next_steps) for _, next_steps in results
+                ]
+            for (beam, next_steps), scores in zip(results, evaluation_scores):
+                new_candidates += make_candidates(beam, next_steps, scores)
+    else:
+        for _, beam_candidates in results:
+            new_candidates += beam_candidates
     candidate_steps = new_candidates
     # sort by score
     candidate_steps.sort(key=lambda x: x[1], reverse=True)
     # select top k steps
     candidate_steps = candidate_steps[:k]
-
-    # add parents and children
-    for i, (decomposed_semantic_tasks, eval_score) in enumerate(candidate_steps):
-        for j, task in enumerate(decomposed_semantic_tasks):
-            task["confidence"] = random.random()
-            task["complexity"] = random.random()
-            decomposed_semantic_tasks[j] = task
-        # decomposed_semantic_tasks = prune_redundant_parents(decomposed_semantic_tasks)
-        decomposed_semantic_tasks = add_children(decomposed_semantic_tasks)
-    candidate_steps[i] = (decomposed_semantic_tasks, eval_score)
     return candidate_steps
 
 
 async def stream_goal_beam_search(
-    goal: str, candidate_steps: list, model: str, api_key: str, k: int = 2, n: int = 2
+    goal: str,
+    candidate_steps: list,
+    model: str,
+    api_key: str,
+    k: int = 2,
+    n: int = 2,
+    oracle: Oracle | None = None,
+    fused: bool = True,
+    deadline: float | None = None,
 ):
+    if len(candidate_steps) == 0:
+        # start from a single empty beam
+        candidate_steps = [([], 0)]
     while True:
         candidate_steps = await beam_search_decomposition_step(
-            goal, candidate_steps, model, api_key, k=k, n=n
+            goal,
+            candidate_steps,
+            model,
+            api_key,
+            k=k,
+            n=n,
+            oracle=oracle,
+            fused=fused,
+            deadline=deadline,
         )
         yield candidate_steps
-        if len(candidate_steps) > 0 and all(
+        if len(candidate_steps) == 0 or all(
             [beam[-1]["label"] == "END" for beam, _ in candidate_steps]
         ):
             break
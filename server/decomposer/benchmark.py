@@ -0,0 +1,291 @@
+"""Offline scaling study of the decomposition searches against a SimulatedOracle.
+Runs stream_MCTS and stream_goal_beam_search many times in parallel processes and
+reports the quality of the best plan found against the number of LLM calls spent,
+and the CPU time of the tree code itself (excluding the oracle).
+
+Usage:
+    python -m server.decomposer.benchmark --runs 1000 --exploration-weights 0.5 1.41 2.0
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from . import beam_search
+from . import monte_carlo_tree_search as mcts
+from .oracles import SimulatedOracle
+
+
+def run_MCTS(config: dict, oracle: SimulatedOracle) -> list[tuple[int, float]]:
+    root = mcts.init_MCTS()
+    node_dict = {root.MCT_id: root}
+    trajectory = []
+
+    async def search():
+        iterations = 0
+        async for root_node, nodes, next_selection, max_value_path in mcts.stream_MCTS(
+            root,
+            node_dict,
+            goal="simulated goal",
+            model="simulated",
+            api_key="",
+            eval_definitions={},
+            eval_few_shot_examples={},
+            select_strategy_arg=config["select_strategy"],
+            branching_strategy_arg=config["branching_strategy"],
+            oracle=oracle,
+        ):
+            if max_value_path is not None:
+                steps = [
+                    nodes[MCT_id] for MCT_id in max_value_path[0] if MCT_id != "-1"
+                ]
+                trajectory.append((oracle.llm_calls, oracle.path_quality(steps)))
+            iterations += 1
+            if next_selection is None or iterations >= config["iterations"]:
+                break
+
+    asyncio.run(search())
+    return trajectory
+
+
+def run_beam_search(config: dict, oracle: SimulatedOracle) -> list[tuple[int, float]]:
+    trajectory = []
+
+    async def search():
+        async for candidate_steps in beam_search.stream_goal_beam_search(
+            "simulated goal",
+            [([], 0)],
+            model="simulated",
+            api_key="",
+            k=config["k"],
+            n=config["n"],
+            oracle=oracle,
+        ):
+            if not candidate_steps:
+                break
+            best_beam, _ = candidate_steps[0]
+            trajectory.append((oracle.llm_calls, oracle.path_quality(best_beam)))
+
+    asyncio.run(search())
+    return trajectory
+
+
+ALGORITHMS = {
+    "MCTS": run_MCTS,
+    "beam_search": run_beam_search,
+}
+
+
+def run_once(task: tuple[dict, int]) -> dict:
+    config, seed = task
+    # module level search parameters are set per run, each worker runs one at a time
+    mcts.MAX_STEPS = config["max_steps"]
+    mcts.EXPLORATION_WEIGHT = config["exploration_weight"]
+    beam_search.MAX_STEPS = config["max_steps"]
+    oracle = SimulatedOracle(seed=seed, **config["oracle"])
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    trajectory = ALGORITHMS[config["algorithm"]](config, oracle)
+    cpu_time = time.process_time() - start_cpu
+    return {
+        "config": config,
+        "seed": seed,
+        "trajectory": trajectory,
+        "llm_calls": oracle.llm_calls,
+        "calls": dict(oracle.calls),
+        "wall_time": time.perf_counter() - start_wall,
+        "tree_cpu_time": cpu_time - oracle.cpu_time,
+    }
+
+
+def config_key(config: dict) -> str:
+    if config["algorithm"] == "MCTS":
+        return (
+            f"MCTS select={config['select_strategy']}"
+            f" branching={config['branching_strategy']}"
+            f" c={config['exploration_weight']} max_steps={config['max_steps']}"
+        )
+    return (
+        f"beam_search k={config['k']} n={config['n']}"
+        f" max_steps={config['max_steps']}"
+    )
+
+
+def quality_at(trajectory: list[tuple[int, float]], budget: int) -> float:
+    """Quality of the best plan known once budget LLM calls have been spent"""
+    quality = 0.0
+    for llm_calls, path_quality in trajectory:
+        if llm_calls > budget:
+            break
+        quality = path_quality
+    return quality
+
+
+def mean_stderr(values: list[float]) -> tuple[float, float]:
+    if not values:
+        return 0.0, 0.0
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    variance = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, math.sqrt(variance / len(values))
+
+
+def summarize(results: list[dict], num_buckets: int) -> dict:
+    grouped = defaultdict(list)
+    for result in results:
+        grouped[config_key(result["config"])].append(result)
+    max_calls = max((result["llm_calls"] for result in results), default=0)
+    bucket_size = max(1, math.ceil(max_calls / num_buckets))
+    budgets = [bucket_size * (i + 1) for i in range(num_buckets)]
+
+    summary = {}
+    for key, runs in grouped.items():
+        curve = []
+        for budget in budgets:
+            mean, stderr = mean_stderr(
+                [quality_at(run["trajectory"], budget) for run in runs]
+            )
+            curve.append({"llm_calls": budget, "quality": mean, "stderr": stderr})
+        final_quality = mean_stderr(
+            [run["trajectory"][-1][1] if run["trajectory"] else 0.0 for run in runs]
+        )
+        tree_cpu_time = mean_stderr([run["tree_cpu_time"] for run in runs])
+        llm_calls = mean_stderr([run["llm_calls"] for run in runs])
+        summary[key] = {
+            "runs": len(runs),
+            "curve": curve,
+            "final_quality": final_quality,
+            "llm_calls": llm_calls,
+            "tree_cpu_time": tree_cpu_time,
+            # CPU time of the tree code per LLM call the search would have made
+            "tree_cpu_time_per_call": (
+                tree_cpu_time[0] / llm_calls[0] if llm_calls[0] else 0.0
+            ),
+        }
+    return summary
+
+
+def print_summary(summary: dict):
+    for key, stats in summary.items():
+        print(f"== {key} ({stats['runs']} runs)")
+        print(
+            "final quality {:.3f} ± {:.3f}, llm calls {:.1f} ± {:.1f}".format(
+                *stats["final_quality"], *stats["llm_calls"]
+            )
+        )
+        print(
+            "tree cpu time {:.2f}ms ± {:.2f}ms, {:.3f}ms per llm call".format(
+                stats["tree_cpu_time"][0] * 1000,
+                stats["tree_cpu_time"][1] * 1000,
+                stats["tree_cpu_time_per_call"] * 1000,
+            )
+        )
+        for point in stats["curve"]:
+            print(
+                f"  {point['llm_calls']:>6} calls: "
+                f"{point['quality']:.3f} ± {point['stderr']:.3f}"
+            )
+
+
+def build_configs(args) -> list[dict]:
+    oracle = {
+        "branching": args.branching,
+        "quality_spread": args.quality_spread,
+        "noise": args.noise,
+        "end_probability": args.end_probability,
+        "num_agents": args.num_agents,
+    }
+    configs = []
+    if "MCTS" in args.algorithms:
+        for select_strategy, branching_strategy, exploration_weight, max_steps in (
+            itertools.product(
+                args.select_strategies,
+                args.branching_strategies,
+                args.exploration_weights,
+                args.max_steps,
+            )
+        ):
+            configs.append(
+                {
+                    "algorithm": "MCTS",
+                    "select_strategy": select_strategy,
+                    "branching_strategy": branching_strategy,
+                    "exploration_weight": exploration_weight,
+                    "max_steps": max_steps,
+                    "iterations": args.iterations,
+                    "oracle": oracle,
+                }
+            )
+    if "beam_search" in args.algorithms:
+        for max_steps in args.max_steps:
+            configs.append(
+                {
+                    "algorithm": "beam_search",
+                    "k": args.beam_k,
+                    "n": args.beam_n,
+                    "exploration_weight": mcts.EXPLORATION_WEIGHT,
+                    "max_steps": max_steps,
+                    "oracle": oracle,
+                }
+            )
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=100, help="runs per config")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--algorithms", nargs="+", default=list(ALGORITHMS), choices=list(ALGORITHMS)
+    )
+    parser.add_argument("--iterations", type=int, default=30, help="MCTS steps per run")
+    parser.add_argument("--select-strategies", nargs="+", default=["UCT"])
+    parser.add_argument(
+        "--branching-strategies",
+        nargs="+",
+        default=["fixed"],
+        choices=list(mcts.BRANCHING_STRATEGIES),
+    )
+    parser.add_argument(
+        "--exploration-weights", nargs="+", type=float, default=[mcts.EXPLORATION_WEIGHT]
+    )
+    parser.add_argument("--max-steps", nargs="+", type=int, default=[mcts.MAX_STEPS])
+    parser.add_argument("--beam-k", type=int, default=2)
+    parser.add_argument("--beam-n", type=int, default=2)
+    parser.add_argument("--branching", type=int, default=4)
+    parser.add_argument("--quality-spread", type=float, default=0.2)
+    parser.add_argument("--noise", type=float, default=0.15)
+    parser.add_argument("--end-probability", type=float, default=0.2)
+    parser.add_argument("--num-agents", type=int, default=3)
+    parser.add_argument("--buckets", type=int, default=10)
+    parser.add_argument("--output", help="write the raw results and summary as json")
+    args = parser.parse_args()
+
+    configs = build_configs(args)
+    tasks = [
+        (config, args.seed + run) for config in configs for run in range(args.runs)
+    ]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(run_once, tasks, chunksize=max(1, len(tasks) // 256)))
+    print(f"{len(tasks)} runs in {time.perf_counter() - start:.1f}s")
+
+    summary = summarize(results, args.buckets)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"summary": summary, "results": results}, f, indent=4, ensure_ascii=False
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
 import random
 from pydantic import BaseModel
+import asyncio
 import math
 import random
-from server.AutoGenUtils import query
 from server.custom_types.custom_types import MCT_Node
-import server.evaluator as evaluator
+from .oracles import Oracle, get_oracle
 import traceback
 
 
 MAX_STEPS = 5
+EXPLORATION_WEIGHT = 1.41
+# progressive widening: a node may have ceil(C * (visits + 1) ^ alpha) children,
+# scaled by how promising (mean value) and uncertain (children value spread) it is
+WIDENING_CONSTANT = 1.0
+WIDENING_EXPONENT = 0.5
+MIN_CHILDREN = 1
+MAX_CHILDREN = 4
 
 
 def init_MCTS():
@@ -46,7 +53,13 @@ async def stream_MCTS(
     eval_definitions=None,
     eval_few_shot_examples=[],
     select_strategy_arg="UCT",
+    branching_strategy_arg="fixed",
+    speculate=False,
+    oracle: Oracle | None = None,
 ):
+    # when speculating, the most likely next selection is expanded while the
+    # children of the current selection are still being evaluated
+    speculator = ExpansionSpeculator(oracle) if speculate else None
     try:
         while True:
             root, node_dict = await MCTS_step(
@@ -59,11 +72,17 @@ async def stream_MCTS(
                 model=model,
                 api_key=api_key,
                 select_strategy_arg=select_strategy_arg,
+                branching_strategy_arg=branching_strategy_arg,
+                speculator=speculator,
+                oracle=oracle,
             )
             if all_END(root, node_dict):
                 yield root, node_dict, None, None
             next_selection = select(
-                root, node_dict, select_strategy_arg=select_strategy_arg
+                root,
+                node_dict,
+                select_strategy_arg=select_strategy_arg,
+                branching_strategy_arg=branching_strategy_arg,
             )
             max_value_path = get_max_value_path(root, node_dict)
             yield root, node_dict, next_selection, max_value_path
@@ -71,7 +90,12 @@ async def stream_MCTS(
         traceback.print_exc()
         print(f"Error in stream_MCTS: {e}")
         yield root, node_dict, None, None
-    pass
+    finally:
+        if speculator is not None:
+            speculator.cancel()
+            print(
+                f"MCTS speculation: {speculator.hits} hits, {speculator.misses} misses"
+            )
 
 
 async def MCTS_step(
@@ -84,6 +108,9 @@ async def MCTS_step(
     eval_definitions=None,
     eval_few_shot_examples=[],
     select_strategy_arg="UCT",
+    branching_strategy_arg="fixed",
+    speculator=None,
+    oracle: Oracle | None = None,
 ) -> tuple[MCT_Node, dict]:
     # update node status
     for node_id, node in node_dict.items():
@@ -91,11 +118,28 @@ async def MCTS_step(
 
     # select a node to expand
     if next_selection is None:
-        node = select(root, node_dict, select_strategy_arg)
+        node = select(root, node_dict, select_strategy_arg, branching_strategy_arg)
     else:
         node = node_dict[next_selection.MCT_id]
-    # expand the node with children
-    children = await expand(node, node_dict, goal, model, api_key)
+    # expand the node with as many new children as the branching strategy allows
+    branching_strategy = get_branching_strategy(branching_strategy_arg)
+    n = max(branching_strategy(node, node_dict) - len(node.MCT_children_ids), 1)
+    children = await expand(
+        node,
+        node_dict,
+        goal,
+        model,
+        api_key,
+        n=n,
+        speculator=speculator,
+        oracle=oracle,
+    )
+    # overlap the evaluation of the children with the expansion of the likely next selection
+    if speculator is not None:
+        predicted_node, predicted_n = predict_next_selection(
+            root, node_dict, children, select_strategy_arg, branching_strategy_arg
+        )
+        speculator.start(predicted_node, node_dict, goal, model, api_key, predicted_n)
     # run evaluation on *ALL* the children
     reward_value_list = await reward(
         goal,
@@ -105,6 +149,7 @@ async def MCTS_step(
         api_key=api_key,
         eval_definitions=eval_definitions,
         eval_few_shot_examples=eval_few_shot_examples,
+        oracle=oracle,
     )
     # backpropagate the reward values
     for child, reward_value in zip(children, reward_value_list):
@@ -126,6 +171,7 @@ async def MCTS_regenerate(
     api_key: str,
     eval_definitions=None,
     eval_few_shot_examples=[],
+    oracle: Oracle | None = None,
 ):
     try:
         # update node status
@@ -135,7 +181,7 @@ async def MCTS_regenerate(
         node_dict = remove_branch(target_node, node_dict)
         remove_backpropagate_effect(target_node, target_node.value, node_dict)
         previous_steps = get_previous_steps(parent_node, node_dict)
-        new_generation = await query.run_goal_decomposition_agent_stepped(
+        new_generation = await get_oracle(oracle).expand(
             goal,
             previous_steps,
             model=model,
@@ -166,6 +212,7 @@ async def MCTS_regenerate(
             api_key=api_key,
             eval_definitions=eval_definitions,
             eval_few_shot_examples=eval_few_shot_examples,
+            oracle=oracle,
         )
         reward_value = reward_value[0]
 
@@ -181,8 +228,10 @@ async def MCTS_regenerate(
         return root
 
 
-def UCT(node: MCT_Node, parent_node: MCT_Node | None, exploration_weight=1.41) -> float:
+def UCT(node: MCT_Node, parent_node: MCT_Node | None, exploration_weight=None) -> float:
     """Upper Confidence Bound for Trees (UCT) selection"""
+    if exploration_weight is None:
+        exploration_weight = EXPLORATION_WEIGHT
     if node.label == "END":
         return float("-inf")  # Avoid END nodes
     if node.value == 0:
@@ -205,15 +254,66 @@ def greedy(node: MCT_Node, parent_node: MCT_Node | None) -> float:
     return node.value / node.visits
 
 
+def fixed_branching(node: MCT_Node, node_dict: dict, n=2) -> int:
+    """Fixed branching: a leaf is expanded with n children and never widened afterwards"""
+    if node.MCT_children_ids:
+        return len(node.MCT_children_ids)
+    return n
+
+
+def progressive_widening(node: MCT_Node, node_dict: dict) -> int:
+    """Progressive widening: the number of children a node may have grows with its visits.
+    High-value or high-variance nodes are allowed more children, low-value ones fewer."""
+    if is_END(node) or node.children_all_ends:
+        return len(node.MCT_children_ids)
+    allowed = WIDENING_CONSTANT * math.pow(node.visits + 1, WIDENING_EXPONENT)
+    if node.visits > 0:
+        mean_value = node.value / node.visits
+        allowed *= 0.5 + mean_value + children_value_std(node, node_dict)
+    return int(max(MIN_CHILDREN, min(MAX_CHILDREN, math.ceil(allowed))))
+
+
+def children_value_std(node: MCT_Node, node_dict: dict) -> float:
+    """Standard deviation of the mean values of the visited children"""
+    child_values = [
+        node_dict[child_id].value / node_dict[child_id].visits
+        for child_id in node.MCT_children_ids
+        if node_dict[child_id].visits > 0
+    ]
+    if len(child_values) < 2:
+        return 0.0
+    mean = sum(child_values) / len(child_values)
+    return math.sqrt(sum((v - mean) ** 2 for v in child_values) / len(child_values))
+
+
+BRANCHING_STRATEGIES = {
+    "fixed": fixed_branching,
+    "progressive_widening": progressive_widening,
+}
+
+
+def get_branching_strategy(branching_strategy_arg: str | None):
+    if branching_strategy_arg not in BRANCHING_STRATEGIES:
+        return fixed_branching
+    return BRANCHING_STRATEGIES[branching_strategy_arg]
+
+
 def select(
-    node: MCT_Node, node_dict: dict, select_strategy_arg: str = "UCT"
+    node: MCT_Node,
+    node_dict: dict,
+    select_strategy_arg: str = "UCT",
+    branching_strategy_arg: str = "fixed",
 ) -> MCT_Node:
     if select_strategy_arg == "UCT":
         select_strategy = UCT
     else:
         select_strategy = greedy
+    branching_strategy = get_branching_strategy(branching_strategy_arg)
 
     while node.MCT_children_ids:
+        # stop at nodes that are allowed to grow more children
+        if branching_strategy(node, node_dict) > len(node.MCT_children_ids):
+            return node
         candidate_children_ids = list(
             filter(
                 lambda id: not node_dict[id].children_all_ends, node.MCT_children_ids
@@ -240,28 +340,154 @@ def select(
     return node
 
 
+def predict_next_selection(
+    root: MCT_Node,
+    node_dict: dict,
+    pending_children: list[MCT_Node],
+    select_strategy_arg: str = "UCT",
+    branching_strategy_arg: str = "fixed",
+) -> tuple[MCT_Node | None, int]:
+    """Guesses the next selection before the pending children are evaluated,
+    assuming each of them is rewarded with the mean value of its parent.
+    Returns the predicted node and the number of children it would be expanded with."""
+    simulated_dict = {
+        node_id: node.model_copy() for node_id, node in node_dict.items()
+    }
+    priors = []
+    for child in pending_children:
+        parent_node = simulated_dict[child.MCT_parent_id]
+        prior = parent_node.value / parent_node.visits if parent_node.visits else 0.5
+        priors.append((child.MCT_id, prior))
+    for child_id, prior in priors:
+        backpropagate(simulated_dict[child_id], prior, simulated_dict)
+    predicted_node = select(
+        simulated_dict[root.MCT_id],
+        simulated_dict,
+        select_strategy_arg,
+        branching_strategy_arg,
+    )
+    if predicted_node is None:
+        return None, 0
+    branching_strategy = get_branching_strategy(branching_strategy_arg)
+    n = max(
+        branching_strategy(predicted_node, simulated_dict)
+        - len(predicted_node.MCT_children_ids),
+        1,
+    )
+    return node_dict[predicted_node.MCT_id], n
+
+
+class ExpansionSpeculator:
+    """Expands a predicted next selection in the background.
+    The generated children are only adopted if the real selection matches the
+    prediction, otherwise the speculative request is cancelled and discarded."""
+
+    def __init__(self, oracle: Oracle | None = None):
+        self.oracle = oracle
+        self.target_id = None
+        self.n = 0
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(
+        self,
+        node: MCT_Node | None,
+        node_dict: dict,
+        goal: str,
+        model: str,
+        api_key: str,
+        n: int,
+    ):
+        self.cancel()
+        if node is None:
+            return
+        self.target_id = node.MCT_id
+        self.n = n
+        self.task = asyncio.create_task(
+            generate_children(node, node_dict, goal, model, api_key, n, self.oracle)
+        )
+
+    async def take(self, node: MCT_Node, n: int) -> list[dict] | None:
+        """Returns the speculatively generated children for node, or None on a miss"""
+        if self.task is None:
+            return None
+        if node.MCT_id != self.target_id or n > self.n:
+            self.misses += 1
+            self.cancel()
+            return None
+        task = self.task
+        self.task = None
+        self.target_id = None
+        try:
+            children = await task
+        except (Exception, asyncio.CancelledError) as e:
+            print(f"Error in speculative expansion: {e}")
+            children = None
+        if children is None or len(children) < n:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return children[:n]
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.target_id = None
+
+
+async def generate_children(
+    parent_node: MCT_Node,
+    node_dict: dict,
+    goal: str,
+    model: str,
+    api_key: str,
+    n=2,
+    oracle: Oracle | None = None,
+) -> list[dict]:
+    """Generates n candidate next steps for the node without modifying the tree"""
+    previous_steps = get_previous_steps(parent_node, node_dict)
+    return await get_oracle(oracle).expand(
+        goal,
+        previous_steps,
+        model=model,
+        api_key=api_key,
+        temperature=1.0,
+        n=n,
+        remain_steps=MAX_STEPS - parent_node.level,
+    )
+
+
 async def expand(
-    parent_node: MCT_Node, node_dict: dict, goal: str, model: str, api_key: str, n=2
+    parent_node: MCT_Node,
+    node_dict: dict,
+    goal: str,
+    model: str,
+    api_key: str,
+    n=2,
+    speculator=None,
+    oracle: Oracle | None = None,
 ) -> MCT_Node:
-    """Expands the node by adding one of its possible children"""
+    """Expands the node by adding n new children and returns only the new ones"""
     try:
-        previous_steps = get_previous_steps(parent_node, node_dict)
-        children = await query.run_goal_decomposition_agent_stepped(
-            goal,
-            previous_steps,
-            model=model,
-            api_key=api_key,
-            temperature=1.0,
-            n=n,
-            remain_steps=MAX_STEPS - parent_node.level,
-        )
+        children = None
+        if speculator is not None:
+            children = await speculator.take(parent_node, n)
+        if children is None:
+            children = await generate_children(
+                parent_node, node_dict, goal, model, api_key, n, oracle
+            )
+        # widened nodes already have children, new ones are numbered after them
+        offset = len(parent_node.MCT_children_ids)
+        new_children_ids = []
         for index, child_node in enumerate(children):
             child_node["parentIds"] = [
                 str(parent_id) for parent_id in child_node["parentIds"]
             ]
             child_as_MCT_node = MCT_Node(
                 **child_node,
-                MCT_id=f"{parent_node.MCT_id}/{index}",
+                MCT_id=f"{parent_node.MCT_id}/{offset + index}",
                 id=f"{int(parent_node.id)+1}",
                 print_label=f"{child_node['label']} (0/0)",
                 MCT_parent_id=str(parent_node.MCT_id),
@@ -270,9 +496,10 @@ async def expand(
             )
             node_dict[child_as_MCT_node.MCT_id] = child_as_MCT_node
             parent_node.MCT_children_ids.append(child_as_MCT_node.MCT_id)
+            new_children_ids.append(child_as_MCT_node.MCT_id)
         update_end_paths(parent_node, node_dict)
 
-        return [node_dict[child_id] for child_id in parent_node.MCT_children_ids]
+        return [node_dict[child_id] for child_id in new_children_ids]
     except Exception as e:
         print(f"Error in expand: {e}")
 
@@ -294,6 +521,7 @@ async def reward(
     api_key: str,
     eval_definitions=None,
     eval_few_shot_examples=[],
+    oracle: Oracle | None = None,
 ) -> float:
     """Evaluates the children nodes and returns the reward value for each child in parallel"""
     try:
@@ -304,7 +532,7 @@ async def reward(
             eval_params.append((goal, node, node_dict[node.MCT_parent_id]))
 
         # runs evaluation on all children in parallel
-        eval_results, eval_reasons, num_agents = await evaluator.run_all_evaluations(
+        eval_results, eval_reasons, num_agents = await get_oracle(oracle).evaluate(
             goal=goal,
             eval_params=eval_params,
             eval_definitions=eval_definitions,
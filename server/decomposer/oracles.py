@@ -0,0 +1,466 @@
+import asyncio
+import logging
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+import server.AutoGenUtils.query as autogen_utils
+import server.evaluator as evaluator
+
+logger = logging.getLogger(__name__)
+
+
+class Oracle(ABC):
+    """Source of expansions and evaluations for the tree searches.
+    MCTS (`expand`, `reward`) and beam search (`goal_decode_n_samples`) call the oracle
+    instead of the agents directly, so the LLMs can be swapped for a synthetic generator.
+    """
+
+    @abstractmethod
+    async def expand(
+        self,
+        goal: str,
+        previous_steps: list,
+        model: str,
+        api_key: str,
+        temperature=1.0,
+        n=1,
+        remain_steps=5,
+    ) -> list[dict]:
+        """Returns n candidate next steps"""
+
+    @abstractmethod
+    async def evaluate(
+        self,
+        goal: str,
+        eval_params: list[tuple],
+        eval_definitions: dict[str, str],
+        eval_few_shot_examples: dict[str, list[dict]],
+    ):
+        """Returns (results_grouped, reasons_grouped, num_agents), see evaluator.run_all_evaluations"""
+
+    @abstractmethod
+    async def self_evaluate(
+        self,
+        goal: str,
+        previous_steps: list,
+        next_steps: list[dict],
+        model: str,
+        api_key: str,
+    ) -> list:
+        """Returns one evaluation score per next step"""
+
+    async def batch_self_evaluate(
+        self,
+        goal: str,
+        candidates: list[tuple[list, list]],
+        model: str,
+        api_key: str,
+    ) -> list[list]:
+        """Returns the scores of the next steps of several beams, given as
+        (previous_steps, next_steps) tuples. Evaluates the beams in parallel unless
+        the oracle can fuse them into a single request."""
+        return list(
+            await asyncio.gather(
+                *[
+                    self.self_evaluate(goal, previous_steps, next_steps, model, api_key)
+                    for previous_steps, next_steps in candidates
+                ]
+            )
+        )
+
+
+class LLMOracle(Oracle):
+    """Queries the decomposition and evaluation agents"""
+
+    async def expand(
+        self,
+        goal: str,
+        previous_steps: list,
+        model: str,
+        api_key: str,
+        temperature=1.0,
+        n=1,
+        remain_steps=5,
+    ) -> list[dict]:
+        return await autogen_utils.run_goal_decomposition_agent_stepped(
+            goal,
+            previous_steps,
+            model=model,
+            api_key=api_key,
+            temperature=temperature,
+            n=n,
+            remain_steps=remain_steps,
+        )
+
+    async def evaluate(
+        self,
+        goal: str,
+        eval_params: list[tuple],
+        eval_definitions: dict[str, str],
+        eval_few_shot_examples: dict[str, list[dict]],
+    ):
+        return await evaluator.run_all_evaluations(
+            goal=goal,
+            eval_params=eval_params,
+            eval_definitions=eval_definitions,
+            eval_few_shot_examples=eval_few_shot_examples,
+        )
+
+    async def self_evaluate(
+        self,
+        goal: str,
+        previous_steps: list,
+        next_steps: list[dict],
+        model: str,
+        api_key: str,
+    ) -> list:
+        # each candidate is evaluated on its own, in parallel
+        return list(
+            await asyncio.gather(
+                *[
+                    autogen_utils.run_decomposition_self_evaluation_agent(
+                        goal, previous_steps, next_step, model, api_key
+                    )
+                    for next_step in next_steps
+                ]
+            )
+        )
+
+    async def batch_self_evaluate(
+        self,
+        goal: str,
+        candidates: list[tuple[list, list]],
+        model: str,
+        api_key: str,
+    ) -> list[list]:
+        return await autogen_utils.run_batch_decomposition_self_evaluation_agent(
+            goal, candidates, model, api_key
+        )
+
+
+class CascadeOracle(LLMOracle):
+    """Two-tier model cascade for MCTS.
+    Expansions use the cheap expansion-model. Every new child is pre-screened by the
+    prescreen-models, and only the top-k children whose pre-screen reward reaches the
+    promote-threshold are evaluated by the full eval-models ensemble. The other
+    children keep their pre-screen votes, scaled to the size of the ensemble.
+    The agreement between the tiers on the promoted children is logged.
+    """
+
+    def __init__(self, expansion_model=None, top_k=2, promote_threshold=0.5):
+        self.expansion_model = expansion_model
+        self.top_k = top_k
+        self.promote_threshold = promote_threshold
+        self.stats = Counter()
+        # sum of |prescreen reward - full reward| over the promoted children
+        self.reward_error = 0.0
+
+    @classmethod
+    def from_config(cls):
+        # an empty tier fails here, not in the middle of a search
+        if not evaluator.get_model_list("eval-models"):
+            raise ValueError("No eval-models in model_list.yaml for the cascade")
+        evaluator.get_model_list("prescreen-models")
+        config = evaluator.get_cascade_config()
+        return cls(
+            expansion_model=config["expansion-model"],
+            top_k=config["promote-top-k"],
+            promote_threshold=config["promote-threshold"],
+        )
+
+    async def expand(
+        self,
+        goal: str,
+        previous_steps: list,
+        model: str,
+        api_key: str,
+        temperature=1.0,
+        n=1,
+        remain_steps=5,
+    ) -> list[dict]:
+        return await super().expand(
+            goal,
+            previous_steps,
+            model=self.expansion_model or model,
+            api_key=api_key,
+            temperature=temperature,
+            n=n,
+            remain_steps=remain_steps,
+        )
+
+    async def evaluate(
+        self,
+        goal: str,
+        eval_params: list[tuple],
+        eval_definitions: dict[str, str],
+        eval_few_shot_examples: dict[str, list[dict]],
+    ):
+        if not evaluator.get_model_list("prescreen-models"):
+            return await super().evaluate(
+                goal, eval_params, eval_definitions, eval_few_shot_examples
+            )
+        prescreen_results, prescreen_reasons, prescreen_agents = (
+            await evaluator.run_all_evaluations(
+                goal=goal,
+                eval_params=eval_params,
+                eval_definitions=eval_definitions,
+                eval_few_shot_examples=eval_few_shot_examples,
+                model_list_key="prescreen-models",
+                summarize=False,
+            )
+        )
+        priors = [sum(result) / (3 * prescreen_agents) for result in prescreen_results]
+        ranked = sorted(range(len(eval_params)), key=lambda i: priors[i], reverse=True)
+        promoted = [
+            i for i in ranked[: self.top_k] if priors[i] >= self.promote_threshold
+        ]
+
+        if promoted:
+            full_results, full_reasons, num_agents = (
+                await evaluator.run_all_evaluations(
+                    goal=goal,
+                    eval_params=[eval_params[i] for i in promoted],
+                    eval_definitions=eval_definitions,
+                    eval_few_shot_examples=eval_few_shot_examples,
+                )
+            )
+        else:
+            full_results, full_reasons = [], []
+            # the size of the full ensemble, without building its agents
+            num_agents = len(evaluator.get_model_list("eval-models"))
+
+        # screened out children keep their votes, scaled to the ensemble size
+        results_grouped = [
+            [round(value * num_agents / prescreen_agents) for value in result]
+            for result in prescreen_results
+        ]
+        reasons_grouped = list(prescreen_reasons)
+        for i, result, reason in zip(promoted, full_results, full_reasons):
+            self.record_agreement(priors[i], sum(result) / (3 * num_agents))
+            results_grouped[i] = result
+            reasons_grouped[i] = reason
+        self.stats["screened"] += len(eval_params)
+        self.stats["promoted"] += len(promoted)
+        self.log_agreement()
+        return results_grouped, reasons_grouped, num_agents
+
+    def record_agreement(self, prior: float, reward: float):
+        prior_pass = prior >= self.promote_threshold
+        full_pass = reward >= self.promote_threshold
+        self.stats["agree" if prior_pass == full_pass else "disagree"] += 1
+        self.reward_error += abs(prior - reward)
+
+    def log_agreement(self):
+        compared = self.stats["agree"] + self.stats["disagree"]
+        logger.info(
+            "MCTS cascade: %d/%d children promoted, "
+            "tier agreement %.2f, mean reward error %.3f",
+            self.stats["promoted"],
+            self.stats["screened"],
+            self.stats["agree"] / compared if compared else 0.0,
+            self.reward_error / compared if compared else 0.0,
+        )
+
+
+class SimulatedOracle(Oracle):
+    """Synthetic plan space for offline scaling studies.
+    Every step has `branching` latent alternatives for its next step. An alternative's
+    latent quality drifts from its parent's quality by `quality_spread`, and it is an
+    END step with probability `end_probability`. Evaluations are Bernoulli votes on the
+    latent quality blurred by `noise`, so the searches only ever see noisy rewards.
+    Every request that would have gone to an LLM is counted in `calls`.
+    """
+
+    def __init__(
+        self,
+        branching=4,
+        quality_mean=0.5,
+        quality_spread=0.2,
+        noise=0.15,
+        end_probability=0.2,
+        num_agents=3,
+        seed=None,
+    ):
+        self.branching = branching
+        self.quality_mean = quality_mean
+        self.quality_spread = quality_spread
+        self.noise = noise
+        self.end_probability = end_probability
+        self.num_agents = num_agents
+        self.rng = random.Random(seed)
+        # description -> latent quality and depth, descriptions are unique step keys
+        self.latent = {}
+        self.depth = {}
+        # descriptions of the previous steps -> latent alternatives of the next step
+        self.alternatives = {}
+        self.calls = Counter()
+        # CPU time spent inside the oracle, to separate it from the tree code overhead
+        self.cpu_time = 0.0
+
+    @property
+    def llm_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def quality(self, step) -> float:
+        description = (
+            step["description"] if isinstance(step, dict) else step.description
+        )
+        return self.latent.get(description, 0.0)
+
+    def path_quality(self, steps: list) -> float:
+        """Mean latent quality of the non-END steps of a plan"""
+        qualities = [
+            self.quality(step)
+            for step in steps
+            if (step["label"] if isinstance(step, dict) else step.label) != "END"
+        ]
+        if not qualities:
+            return 0.0
+        return sum(qualities) / len(qualities)
+
+    def _noisy(self, quality: float) -> float:
+        return min(1.0, max(0.0, quality + self.rng.gauss(0, self.noise)))
+
+    def _new_step(
+        self, label: str, quality: float, depth: int, parent_ids: list
+    ) -> dict:
+        description = f"simulated step {len(self.latent)}"
+        self.latent[description] = quality
+        self.depth[description] = depth
+        return {
+            "label": label,
+            "description": description,
+            "explanation": "simulated",
+            "parentIds": parent_ids,
+        }
+
+    def _last_step(self, previous_steps: list) -> dict | None:
+        # MCTS passes the steps leaf first, beam search root first
+        if not previous_steps:
+            return None
+        return max(
+            previous_steps, key=lambda step: self.depth.get(step["description"], -1)
+        )
+
+    def _alternatives(self, previous_steps: list) -> list[dict]:
+        path_key = frozenset(step["description"] for step in previous_steps)
+        if path_key not in self.alternatives:
+            last_step = self._last_step(previous_steps)
+            parent_quality = (
+                self.quality(last_step) if last_step else self.quality_mean
+            )
+            parent_ids = [last_step["id"]] if last_step else []
+            depth = len(previous_steps)
+            alternatives = []
+            for index in range(self.branching):
+                if previous_steps and self.rng.random() < self.end_probability:
+                    alternatives.append(
+                        self._new_step("END", parent_quality, depth, parent_ids)
+                    )
+                    continue
+                quality = min(
+                    1.0,
+                    max(0.0, parent_quality + self.rng.gauss(0, self.quality_spread)),
+                )
+                alternatives.append(
+                    self._new_step(f"Step {depth}.{index}", quality, depth, parent_ids)
+                )
+            self.alternatives[path_key] = alternatives
+        return self.alternatives[path_key]
+
+    async def expand(
+        self,
+        goal: str,
+        previous_steps: list,
+        model: str,
+        api_key: str,
+        temperature=1.0,
+        n=1,
+        remain_steps=5,
+    ) -> list[dict]:
+        start = time.process_time()
+        if remain_steps <= 0:
+            # the decomposition agent also answers these without a model call
+            ids = list(map(lambda step: step["id"], previous_steps))
+            last_step = self._last_step(previous_steps)
+            parent_quality = self.quality(last_step) if last_step else 0.0
+            steps = [
+                self._new_step("END", parent_quality, len(previous_steps), ids)
+                for _ in range(n)
+            ]
+        else:
+            self.calls["expansion"] += 1
+            alternatives = self._alternatives(previous_steps)
+            if n <= len(alternatives):
+                steps = self.rng.sample(alternatives, n)
+            else:
+                steps = [self.rng.choice(alternatives) for _ in range(n)]
+            steps = [dict(step) for step in steps]
+        self.cpu_time += time.process_time() - start
+        return steps
+
+    async def evaluate(
+        self,
+        goal: str,
+        eval_params: list[tuple],
+        eval_definitions: dict[str, str],
+        eval_few_shot_examples: dict[str, list[dict]],
+    ):
+        start = time.process_time()
+        results_grouped = []
+        reasons_grouped = []
+        for _, node, _ in eval_params:
+            quality = self.quality(node)
+            results_grouped.append(
+                [
+                    sum(
+                        self.rng.random() < self._noisy(quality)
+                        for _ in range(self.num_agents)
+                    )
+                    for _ in range(3)
+                ]
+            )
+            reasons_grouped.append(["simulated", "simulated", "simulated"])
+        # 3 criteria x num_agents evaluations plus 3 reason summaries per node
+        self.calls["evaluation"] += len(eval_params) * 3 * (self.num_agents + 1)
+        self.cpu_time += time.process_time() - start
+        return results_grouped, reasons_grouped, self.num_agents
+
+    async def self_evaluate(
+        self,
+        goal: str,
+        previous_steps: list,
+        next_steps: list[dict],
+        model: str,
+        api_key: str,
+    ) -> list:
+        start = time.process_time()
+        self.calls["self_evaluation"] += len(next_steps)
+        scores = [round(5 * self._noisy(self.quality(step))) for step in next_steps]
+        self.cpu_time += time.process_time() - start
+        return scores
+
+    async def batch_self_evaluate(
+        self,
+        goal: str,
+        candidates: list[tuple[list, list]],
+        model: str,
+        api_key: str,
+    ) -> list[list]:
+        start = time.process_time()
+        # all candidates are scored by one fused request
+        self.calls["self_evaluation"] += 1
+        scores = [
+            [round(5 * self._noisy(self.quality(step))) for step in next_steps]
+            for _, next_steps in candidates
+        ]
+        self.cpu_time += time.process_time() - start
+        return scores
+
+
+default_oracle = LLMOracle()
+
+
+def get_oracle(oracle: Oracle | None) -> Oracle:
+    return default_oracle if oracle is None else oracle
@@ -2,6 +2,7 @@ from .criteria import run_importance_evaluation_agent
 from .criteria import run_complexity_evaluation_agent
 from .criteria import run_coherence_evaluation_agent
 from .criteria import run_all_evaluations
+from .agents import get_agents, get_cascade_config, get_model_list
 from .eval_definitions import (
     complexity_definition,
     coherence_definition,
@@ -1,9 +1,10 @@
+import logging
 import os
 import re
 import yaml
 from typing import List, Literal
 
-from autogen_core import CancellationToken
+from server.utils import cancellation_token
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.messages import TextMessage
@@ -23,6 +24,7 @@ from semantic_kernel.memory.null_memory import NullMemory
 from dotenv import load_dotenv
 
 load_dotenv("../../.env")
+logger = logging.getLogger(__name__)
 dirname = os.path.dirname(__file__)
 relative_path = lambda filename: os.path.join(dirname, filename)
 
@@ -128,10 +130,37 @@ def get_gemini_client(model_name: str):
     )
 
 
-def get_agents(agent_name: str, system_message: str):
+# models with a client, see get_agents
+SUPPORTED_MODEL_PREFIXES = ("gpt-", "chatgpt-", "o1-", "claude-3-", "gemini-")
+
+
+def get_model_list(model_list_key: str = "eval-models") -> list[str]:
+    """
+    The models of model_list.yaml that get_agents makes agents of. The models without
+    a client (see SUPPORTED_MODEL_PREFIXES) are skipped with a warning.
+    Raises ValueError if models are listed under the key but none of them has a client.
+    """
     with open(relative_path("model_list.yaml"), "r", encoding="utf-8") as f:
         data = yaml.safe_load(f)
-        model_list = data.get("eval-models", [])
+        configured = data.get(model_list_key, []) or []
+    model_list = []
+    for model in configured:
+        if model.startswith(SUPPORTED_MODEL_PREFIXES):
+            model_list.append(model)
+        else:
+            logger.warning(
+                f"Skipping {model} of {model_list_key} in model_list.yaml: "
+                f"no client for it, supported: {', '.join(SUPPORTED_MODEL_PREFIXES)}"
+            )
+    if configured and not model_list:
+        raise ValueError(f"No supported model in {model_list_key} of model_list.yaml")
+    return model_list
+
+
+def get_agents(
+    agent_name: str, system_message: str, model_list_key: str = "eval-models"
+):
+    model_list = get_model_list(model_list_key)
 
     agents = []
 
@@ -156,10 +185,22 @@ def get_agents(agent_name: str, system_message: str):
     return agents
 
 
+def get_cascade_config() -> dict:
+    """The cascade section of model_list.yaml, with defaults for the missing keys"""
+    with open(relative_path("model_list.yaml"), "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+        cascade = data.get("cascade", {}) or {}
+    return {
+        "expansion-model": cascade.get("expansion-model", None),
+        "promote-top-k": cascade.get("promote-top-k", 2),
+        "promote-threshold": cascade.get("promote-threshold", 0.5),
+    }
+
+
 async def get_response(agent: AssistantAgent, messages: List[TextMessage]):
     response = response = await agent.on_messages(
         messages,
-        cancellation_token=CancellationToken(),
+        cancellation_token=cancellation_token(),
     )
 
     result_text = response.chat_message.content.strip()
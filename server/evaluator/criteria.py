@@ -76,6 +76,8 @@ async def run_all_evaluations(
     eval_params: list[tuple[str, dict, dict]],  # [goal, node, parent_node]
     eval_definitions: dict[str, str],
     eval_few_shot_examples: dict[str, list[dict]],
+    model_list_key: str = "eval-models",
+    summarize: bool = True,
 ):
     """Run all evaluation agents for all nodes. Each node is evaluated for complexity, coherence, and importance.
     Args:
@@ -85,8 +87,10 @@ async def run_all_evaluations(
         eval_few_shot_examples: Few-shot examples for the evaluation. (optional)
         model: The model to use for evaluation.
         api_key: The API key for the model.
+        model_list_key: The model list in model_list.yaml to evaluate with. (e.g. "prescreen-models")
+        summarize: Whether to summarize the reasons of the models into one. (otherwise the first reason is kept)
     Returns:
-        Tuple of (results_grouped, reasons_grouped)
+        Tuple of (results_grouped, reasons_grouped, num_agents)
     """
     nested_tasks = []
     for goal, node, parent_node in eval_params:
@@ -103,6 +107,7 @@ async def run_all_evaluations(
                         if "complexity" in eval_few_shot_examples
                         else []
                     ),
+                    model_list_key=model_list_key,
                 ),
                 run_coherence_evaluation_agent(
                     goal=goal,
@@ -114,6 +119,7 @@ async def run_all_evaluations(
                         if "coherence" in eval_few_shot_examples
                         else []
                     ),
+                    model_list_key=model_list_key,
                 ),
                 run_importance_evaluation_agent(
                     goal=goal,
@@ -124,6 +130,7 @@ async def run_all_evaluations(
                         if "importance" in eval_few_shot_examples
                         else []
                     ),
+                    model_list_key=model_list_key,
                 ),
             ]
         )
@@ -162,23 +169,26 @@ async def run_all_evaluations(
 
         summarize_reason_tasks.append(
             [
-                summarize_reason(
+                combine_reasons(
                     [
                         complexity_results[model_name]["reason"]
                         for model_name in complexity_results.keys()
-                    ]
+                    ],
+                    summarize,
                 ),
-                summarize_reason(
+                combine_reasons(
                     [
                         coherence_results[model_name]["reason"]
                         for model_name in coherence_results.keys()
-                    ]
+                    ],
+                    summarize,
                 ),
-                summarize_reason(
+                combine_reasons(
                     [
                         importance_results[model_name]["reason"]
                         for model_name in importance_results.keys()
-                    ]
+                    ],
+                    summarize,
                 ),
             ]
         )
@@ -281,6 +291,7 @@ async def run_complexity_evaluation_agent(
     node: MCT_Node,
     complexity_definition: str,
     few_shot_examples: list[dict],
+    model_list_key: str = "eval-models",
 ):
     """
     Run the complexity evaluation agent to evaluate whether the node is complex.
@@ -291,6 +302,7 @@ async def run_complexity_evaluation_agent(
         api_key: The API key for the model.
         complexity_definition: The definition of complexity.
         few_shot_examples: Few-shot examples for the evaluation. (optional)
+        model_list_key: The model list in model_list.yaml to evaluate with.
     Returns:
         A dictionary containing the evaluation results for the node.
         Key: The model name.
@@ -301,7 +313,9 @@ async def run_complexity_evaluation_agent(
         definition=complexity_definition
     )
     agents = get_agents(
-        agent_name="complexity_evaluator", system_message=system_message
+        agent_name="complexity_evaluator",
+        system_message=system_message,
+        model_list_key=model_list_key,
     )
 
     distributed_few_shot_examples = distribute_few_shot_examples(
@@ -374,6 +388,7 @@ async def run_coherence_evaluation_agent(
     child_node: MCT_Node,
     coherence_definition: str,
     few_shot_examples: list[dict],
+    model_list_key: str = "eval-models",
 ):
     """
     Run the coherence evaluation agent to evaluate whether the child node is coherent with the parent node.
@@ -385,12 +400,17 @@ async def run_coherence_evaluation_agent(
         api_key: The API key for the model.
         coherence_definition: The definition of coherence.
         few_shot_examples: Few-shot examples for the evaluation. (optional)
+        model_list_key: The model list in model_list.yaml to evaluate with.
     """
 
     system_message = load_system_message("coherence_evaluator").format(
         definition=coherence_definition
     )
-    agents = get_agents(agent_name="coherence_evaluator", system_message=system_message)
+    agents = get_agents(
+        agent_name="coherence_evaluator",
+        system_message=system_message,
+        model_list_key=model_list_key,
+    )
 
     distributed_few_shot_examples = distribute_few_shot_examples(
         few_shot_examples, len(agents)
@@ -472,6 +492,7 @@ async def run_importance_evaluation_agent(
     node: MCT_Node,
     importance_definition: str,
     few_shot_examples: list[dict],
+    model_list_key: str = "eval-models",
 ):
     """
     Run the importance evaluation agent to evaluate whether the node is important.
@@ -482,13 +503,16 @@ async def run_importance_evaluation_agent(
         api_key: The API key for the model.
         importance_definition: The definition of importance.
         few_shot_examples: Few-shot examples for the evaluation. (optional)
+        model_list_key: The model list in model_list.yaml to evaluate with.
     """
 
     system_message = load_system_message("importance_evaluator").format(
         definition=importance_definition
     )
     agents = get_agents(
-        agent_name="importance_evaluator", system_message=system_message
+        agent_name="importance_evaluator",
+        system_message=system_message,
+        model_list_key=model_list_key,
     )
 
     distributed_few_shot_examples = distribute_few_shot_examples(
@@ -609,6 +633,13 @@ Provide a reasoning explanation:
     return response
 
 
+async def combine_reasons(reasons: list[str], summarize: bool = True) -> str:
+    """Summarize the reasons of several models. A single reason needs no summarization."""
+    if not summarize or len(reasons) == 1:
+        return reasons[0]
+    return await summarize_reason(reasons)
+
+
 async def summarize_reason(reasons: list[str]) -> str:
     """Summarize a list of reasons into a single coherent reason using an LLM.
 
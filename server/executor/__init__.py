@@ -7,6 +7,8 @@ from .langgraph_utils import (
     update_execution_state,
     find_last_state,
     collect_keys,
+    to_legacy_state,
+    BARRIER_TOOLS,
 )
 from .llm_evaluators import (
     create_evaluator_spec,
@@ -15,6 +17,14 @@ from .llm_evaluators import (
     create_evaluator_specs,
 )
 from .radial_chart import radial_dr
+from .checkpointer import DeltaSqliteSaver
+from .pipeline import run_pipeline, critical_path_seconds
+from .memo import document_memo
+from .node_cache import node_cache
+from .tool_pool import shutdown_pool, tool_metrics
+from .result_view import result_view
+from .preview import preview_node, sample_indices
+from .speculation import SpeculativeRuns, SPECULATE
 
 __all__ = [
     "create_graph",
@@ -30,4 +40,18 @@ __all__ = [
     "generate_evaluator_descriptions",
     "create_evaluator_specs",
     "collect_keys",
+    "to_legacy_state",
+    "BARRIER_TOOLS",
+    "DeltaSqliteSaver",
+    "run_pipeline",
+    "critical_path_seconds",
+    "document_memo",
+    "node_cache",
+    "shutdown_pool",
+    "tool_metrics",
+    "result_view",
+    "preview_node",
+    "sample_indices",
+    "SpeculativeRuns",
+    "SPECULATE",
 ]
@@ -0,0 +1,93 @@
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+
+class CheckpointIndex:
+    """Index of the checkpoints of one execution thread, by the node they lead to.
+
+    find_last_state and get_node_config used to walk the full state history on every
+    call, deserializing every checkpoint. The index is refreshed incrementally instead:
+    history is read newest first only until the last indexed checkpoint, so a refresh
+    costs O(new checkpoints) and the lookups are dictionary reads.
+    """
+
+    def __init__(self):
+        self.last_checkpoint_id = None
+        self.size = 0
+        # node id -> configs of the checkpoints about to run the node, oldest first
+        self.node_configs = defaultdict(list)
+        # node id -> config of the latest checkpoint waiting at the node's evaluation
+        self.evaluation_configs = {}
+
+    def clear(self):
+        self.last_checkpoint_id = None
+        self.size = 0
+        self.node_configs.clear()
+        self.evaluation_configs.clear()
+
+    def refresh(self, graph, thread_config):
+        latest_checkpoint_id = peek_latest_checkpoint_id(graph, thread_config)
+        if latest_checkpoint_id is not None and (
+            latest_checkpoint_id == self.last_checkpoint_id
+        ):
+            return
+        new_steps = []
+        found_last = self.last_checkpoint_id is None
+        for step in graph.get_state_history(thread_config):
+            if step.config["configurable"]["checkpoint_id"] == self.last_checkpoint_id:
+                found_last = True
+                break
+            new_steps.append(step)
+        if not found_last:
+            # the history was reset or replaced, index it from scratch
+            self.clear()
+        for step in reversed(new_steps):
+            self.add(step)
+
+    def add(self, step):
+        self.size += 1
+        self.last_checkpoint_id = step.config["configurable"]["checkpoint_id"]
+        if not step.next:
+            return
+        next_node = step.next[0]
+        if next_node.endswith("_evaluation"):
+            self.evaluation_configs[next_node[: -len("_evaluation")]] = step.config
+        else:
+            self.node_configs[next_node].append(step.config)
+
+    def is_empty(self) -> bool:
+        return self.size == 0
+
+    def node_config(self, node_id: str, execution_version=None):
+        node_configs = self.node_configs.get(node_id, [])
+        if len(node_configs) == 0:
+            return None
+        if execution_version is None:
+            return node_configs[-1]
+        return node_configs[execution_version]
+
+    def evaluation_config(self, node_id: str):
+        return self.evaluation_configs.get(node_id)
+
+
+# checkpointer -> thread id -> index, entries go away with their checkpointer
+_indexes = WeakKeyDictionary()
+
+
+def get_checkpoint_index(graph, thread_config) -> CheckpointIndex:
+    """The up to date index of the thread in the graph's checkpointer"""
+    thread_indexes = _indexes.setdefault(graph.checkpointer, {})
+    thread_id = str(thread_config["configurable"]["thread_id"])
+    if thread_id not in thread_indexes:
+        thread_indexes[thread_id] = CheckpointIndex()
+    index = thread_indexes[thread_id]
+    index.refresh(graph, thread_config)
+    return index
+
+
+def peek_latest_checkpoint_id(graph, thread_config):
+    """Id of the newest checkpoint, if the checkpointer can tell without loading it"""
+    checkpointer = graph.checkpointer
+    if hasattr(checkpointer, "latest_checkpoint_id"):
+        return checkpointer.latest_checkpoint_id(thread_config)
+    return None
@@ -0,0 +1,622 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import weakref
+import zlib
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence, Union
+
+from collections import OrderedDict
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+from server.custom_types import DocumentTable, MatrixColumn
+from server.utils import estimate_bytes, profiler
+
+
+# channels whose values are stored field by field, see encode_value
+FIELD_CHANNELS = ("documents", "global_store")
+# DocumentTable columns whose digest is remembered, see _put_column
+COLUMN_DIGEST_CACHE_SIZE = 1024
+# memory budget of the list columns held by the digest cache
+COLUMN_DIGEST_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# object type of MatrixColumns, stored as raw float32 bytes instead of through serde
+MATRIX_TYPE = "float32-matrix"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    version TEXT NOT NULL,
+    manifest TEXT NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT NOT NULL,
+    checkpoint BLOB NOT NULL,
+    metadata_type TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL,
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    manifest TEXT NOT NULL,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+class DeltaSqliteSaver(BaseCheckpointSaver):
+    """A durable LangGraph checkpointer backed by a single SQLite file.
+
+    Like MemorySaver, a channel value is only stored when its version changes.
+    On top of that, the documents and global_store channels are split into fields:
+    a documents version (a DocumentTable) is a manifest of one object per column, a
+    global_store version is a manifest of one object per store key. Columns and objects are
+    content-addressed and zlib-compressed, so a new version only stores the fields
+    a node actually added or changed and the rest is shared with its parent.
+
+    Args:
+        path: The SQLite file. Use ":memory:" for a throwaway saver.
+        compression_level: zlib level of the stored objects.
+    """
+
+    def __init__(self, path: str, compression_level: int = 6, serde=None):
+        super().__init__(serde=serde)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.compression_level = compression_level
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # id(column) -> (column or weak reference, digest, bytes held). Table columns
+        # are never modified in place and are shared between versions, so unchanged
+        # columns are not serialized again. The entry references the column so its id
+        # cannot be reused: weakly for a MatrixColumn, which is dropped with its entry,
+        # strongly for a list within COLUMN_DIGEST_CACHE_MAX_BYTES. It only saves the
+        # serialization: the object may have been deleted since (by a reset or garbage
+        # collection, here or in another worker), so it is checked first.
+        self.column_digests = OrderedDict()
+        self.column_digest_bytes = 0
+        # compressed bytes of the objects stored by the current write, under self.lock
+        self.written_bytes = 0
+
+    # ---- content-addressed objects ----
+
+    def _put_object(self, cursor, value: Any) -> str:
+        if isinstance(value, MatrixColumn):
+            type_, data = MATRIX_TYPE, value.to_bytes()
+        else:
+            type_, data = self.serde.dumps_typed(value)
+        digest = hashlib.sha256(type_.encode() + b"\0" + data).hexdigest()
+        compressed = zlib.compress(data, self.compression_level)
+        cursor.execute(
+            "INSERT OR IGNORE INTO objects (hash, type, data) VALUES (?, ?, ?)",
+            (digest, type_, compressed),
+        )
+        if cursor.rowcount > 0:
+            self.written_bytes += len(compressed)
+        return digest
+
+    def _put_column(self, cursor, column: Union[list, MatrixColumn]) -> str:
+        cached = self.column_digests.get(id(column))
+        if cached is not None and held_column(cached[0]) is column:
+            stored = cursor.execute(
+                "SELECT 1 FROM objects WHERE hash = ?", (cached[1],)
+            ).fetchone()
+            if stored is not None:
+                self.column_digests.move_to_end(id(column))
+                return cached[1]
+        digest = self._put_object(cursor, column)
+        self._remember_column(column, digest)
+        return digest
+
+    def _remember_column(self, column: Union[list, MatrixColumn], digest: str):
+        key = id(column)
+        self._forget_column(key)
+        if isinstance(column, MatrixColumn):
+
+            def forget(ref):
+                # the matrix was freed, unless its id already holds another column.
+                # Not under self.lock: it may run while a write holds it.
+                entry = self.column_digests.get(key)
+                if entry is not None and entry[0] is ref:
+                    self.column_digests.pop(key, None)
+
+            self.column_digests[key] = (weakref.ref(column, forget), digest, 0)
+        else:
+            nbytes = estimate_bytes(column)
+            if nbytes > COLUMN_DIGEST_CACHE_MAX_BYTES:
+                return
+            self.column_digests[key] = (column, digest, nbytes)
+            self.column_digest_bytes += nbytes
+        while (
+            len(self.column_digests) > COLUMN_DIGEST_CACHE_SIZE
+            or self.column_digest_bytes > COLUMN_DIGEST_CACHE_MAX_BYTES
+        ):
+            self._forget_column(next(iter(self.column_digests)))
+
+    def _forget_column(self, key: int):
+        entry = self.column_digests.pop(key, None)
+        if entry is not None:
+            self.column_digest_bytes -= entry[2]
+
+    def _clear_columns(self):
+        self.column_digests.clear()
+        self.column_digest_bytes = 0
+
+    def held_columns(self) -> list[list]:
+        """The list columns kept alive by the digest cache"""
+        with self.lock:
+            entries = list(self.column_digests.values())
+        return [entry[0] for entry in entries if entry[2] > 0]
+
+    def _get_object(self, cursor, digest: str) -> Any:
+        type_, data = cursor.execute(
+            "SELECT type, data FROM objects WHERE hash = ?", (digest,)
+        ).fetchone()
+        if type_ == MATRIX_TYPE:
+            return MatrixColumn.from_bytes(zlib.decompress(data))
+        return self.serde.loads_typed((type_, zlib.decompress(data)))
+
+    def encode_value(self, cursor, channel: str, value: Any) -> str:
+        """Stores the value and returns its manifest as json"""
+        if isinstance(value, DocumentTable):
+            fields = [
+                [key, self._put_column(cursor, column), value.missing.get(key, [])]
+                for key, column in value.columns.items()
+            ]
+            manifest = {"kind": "table", "length": len(value), "fields": fields}
+        elif channel in FIELD_CHANNELS and is_records(value):
+            fields = []
+            for key in collect_fields(value):
+                missing = [i for i, record in enumerate(value) if key not in record]
+                column = [record.get(key) for record in value]
+                fields.append([key, self._put_object(cursor, column), missing])
+            manifest = {"kind": "records", "length": len(value), "fields": fields}
+        elif channel in FIELD_CHANNELS and isinstance(value, dict):
+            items = [[key, self._put_object(cursor, v)] for key, v in value.items()]
+            manifest = {"kind": "dict", "items": items}
+        else:
+            manifest = {"kind": "value", "hash": self._put_object(cursor, value)}
+        return json.dumps(manifest)
+
+    def decode_value(self, cursor, manifest: str) -> Any:
+        manifest = json.loads(manifest)
+        if manifest["kind"] == "table":
+            return DocumentTable(
+                columns={
+                    key: self._get_object(cursor, digest)
+                    for key, digest, _ in manifest["fields"]
+                },
+                length=manifest["length"],
+                missing={key: missing for key, _, missing in manifest["fields"] if missing},
+            )
+        if manifest["kind"] == "records":
+            records = [{} for _ in range(manifest["length"])]
+            for key, digest, missing in manifest["fields"]:
+                missing = set(missing)
+                column = self._get_object(cursor, digest)
+                for i, value in enumerate(column):
+                    if i not in missing:
+                        records[i][key] = value
+            return records
+        if manifest["kind"] == "dict":
+            return {
+                key: self._get_object(cursor, digest)
+                for key, digest in manifest["items"]
+            }
+        return self._get_object(cursor, manifest["hash"])
+
+    # ---- BaseCheckpointSaver ----
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self.lock:
+            cursor = self.conn.cursor()
+            if checkpoint_id:
+                row = cursor.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+                    "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = cursor.execute(
+                    "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+                    "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            if row is None:
+                return None
+            return self._load_tuple(cursor, thread_id, checkpoint_ns, row)
+
+    def _load_tuple(self, cursor, thread_id, checkpoint_ns, row) -> CheckpointTuple:
+        (
+            checkpoint_id,
+            parent_checkpoint_id,
+            type_,
+            checkpoint,
+            metadata_type,
+            metadata,
+        ) = row
+        checkpoint = self.serde.loads_typed((type_, zlib.decompress(checkpoint)))
+        channel_values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            blob = cursor.execute(
+                "SELECT manifest FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? "
+                "AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if blob is None:
+                continue
+            manifest = blob[0]
+            if json.loads(manifest)["kind"] == "empty":
+                continue
+            channel_values[channel] = self.decode_value(cursor, manifest)
+        pending_writes = [
+            (task_id, channel, self.decode_value(cursor, manifest))
+            for task_id, channel, manifest in cursor.execute(
+                "SELECT task_id, channel, manifest FROM writes WHERE thread_id = ? "
+                "AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchall()
+        ]
+        return CheckpointTuple(
+            config={
+                "configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": checkpoint_id,
+                }
+            },
+            checkpoint={**checkpoint, "channel_values": channel_values},
+            metadata=self._load_metadata(metadata_type, metadata),
+            parent_config=(
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": parent_checkpoint_id,
+                    }
+                }
+                if parent_checkpoint_id
+                else None
+            ),
+            pending_writes=pending_writes,
+        )
+
+    def _load_metadata(self, metadata_type: str, metadata: bytes) -> dict:
+        return self.serde.loads_typed((metadata_type, zlib.decompress(metadata)))
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        query = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, "
+            "type, checkpoint, metadata_type, metadata FROM checkpoints"
+        )
+        conditions, params = [], []
+        if config is not None:
+            conditions.append("thread_id = ?")
+            params.append(str(config["configurable"]["thread_id"]))
+            checkpoint_ns = config["configurable"].get("checkpoint_ns")
+            if checkpoint_ns is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            checkpoint_id = get_checkpoint_id(config)
+            if checkpoint_id:
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before is not None and get_checkpoint_id(before):
+            conditions.append("checkpoint_id < ?")
+            params.append(get_checkpoint_id(before))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        # tuples are loaded lazily, callers often stop after the newest few
+        count = 0
+        for thread_id, checkpoint_ns, *row in rows:
+            if filter:
+                metadata = self._load_metadata(row[-2], row[-1])
+                if not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+            with self.lock:
+                checkpoint_tuple = self._load_tuple(
+                    self.conn.cursor(), thread_id, checkpoint_ns, row
+                )
+            yield checkpoint_tuple
+            count += 1
+            if limit is not None and count >= limit:
+                break
+
+    def latest_checkpoint_id(self, config: RunnableConfig) -> Optional[str]:
+        """Id of the newest checkpoint of the thread, without loading it"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? "
+                "AND checkpoint_ns = ?",
+                (
+                    str(config["configurable"]["thread_id"]),
+                    config["configurable"].get("checkpoint_ns", ""),
+                ),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        checkpoint = checkpoint.copy()
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        values = checkpoint.pop("channel_values")
+        with profiler.span("checkpoint", channels=len(new_versions)) as span:
+            with self.lock, self.conn:
+                self.written_bytes = 0
+                cursor = self.conn.cursor()
+                for channel, version in new_versions.items():
+                    manifest = (
+                        self.encode_value(cursor, channel, values[channel])
+                        if channel in values
+                        else json.dumps({"kind": "empty"})
+                    )
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, manifest) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (thread_id, checkpoint_ns, channel, str(version), manifest),
+                    )
+                type_, data = self.serde.dumps_typed(checkpoint)
+                metadata_type, metadata_data = self.serde.dumps_typed(metadata)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, "
+                    "parent_checkpoint_id, type, checkpoint, metadata_type, metadata) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        thread_id,
+                        checkpoint_ns,
+                        checkpoint["id"],
+                        config["configurable"].get("checkpoint_id"),
+                        type_,
+                        zlib.compress(data, self.compression_level),
+                        metadata_type,
+                        zlib.compress(metadata_data, self.compression_level),
+                    ),
+                )
+                span.set(bytes=self.written_bytes)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # special writes (errors, interrupts) replace earlier ones, regular writes are kept once
+        verb = (
+            "INSERT OR REPLACE"
+            if all(channel in WRITES_IDX_MAP for channel, _ in writes)
+            else "INSERT OR IGNORE"
+        )
+        with profiler.span("checkpoint", writes=len(writes)) as span:
+            with self.lock, self.conn:
+                self.written_bytes = 0
+                cursor = self.conn.cursor()
+                for idx, (channel, value) in enumerate(writes):
+                    cursor.execute(
+                        f"{verb} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, "
+                        "idx, channel, manifest, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            thread_id,
+                            checkpoint_ns,
+                            checkpoint_id,
+                            task_id,
+                            WRITES_IDX_MAP.get(channel, idx),
+                            channel,
+                            self.encode_value(cursor, channel, value),
+                            task_path,
+                        ),
+                    )
+                span.set(bytes=self.written_bytes)
+
+    def get_next_version(self, current: Optional[str], channel) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        next_v = current_v + 1
+        next_h = random.random()
+        return f"{next_v:032}.{next_h:016}"
+
+    def delete_thread(self, thread_id: str) -> None:
+        thread_id = str(thread_id)
+        with self.lock, self.conn:
+            for table in ("checkpoints", "blobs", "writes"):
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,)
+                )
+            self._collect_garbage()
+
+    def reset(self) -> None:
+        """Removes every thread and object"""
+        with self.lock, self.conn:
+            for table in ("checkpoints", "blobs", "writes", "objects"):
+                self.conn.execute(f"DELETE FROM {table}")
+            self._clear_columns()
+
+    def _collect_garbage(self):
+        referenced = set()
+        for table in ("blobs", "writes"):
+            for (manifest,) in self.conn.execute(f"SELECT manifest FROM {table}"):
+                referenced.update(manifest_hashes(json.loads(manifest)))
+        stored = [digest for (digest,) in self.conn.execute("SELECT hash FROM objects")]
+        self.conn.executemany(
+            "DELETE FROM objects WHERE hash = ?",
+            [(digest,) for digest in stored if digest not in referenced],
+        )
+        # the digests of deleted objects must not be reused
+        self._clear_columns()
+
+    def stats(self) -> dict:
+        """Row counts and stored bytes, to monitor the size of a session"""
+        with self.lock:
+            objects, stored_bytes = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM objects"
+            ).fetchone()
+            checkpoints = self.conn.execute(
+                "SELECT COUNT(*) FROM checkpoints"
+            ).fetchone()[0]
+        return {
+            "checkpoints": checkpoints,
+            "objects": objects,
+            "stored_bytes": stored_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # ---- async variants, the sqlite calls run in the default executor ----
+    # the writes run in the caller's context, so their spans are in its trace
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.get_tuple, config
+        )
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        results = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)),
+        )
+        for result in results:
+            yield result
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            self.put,
+            config,
+            checkpoint,
+            metadata,
+            new_versions,
+        )
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            contextvars.copy_context().run,
+            self.put_writes,
+            config,
+            writes,
+            task_id,
+            task_path,
+        )
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.delete_thread, thread_id
+        )
+
+
+def is_records(value: Any) -> bool:
+    return isinstance(value, list) and all(isinstance(v, dict) for v in value)
+
+
+def collect_fields(records: list[dict]) -> list[str]:
+    """The keys of all records, in order of first appearance"""
+    fields = {}
+    for record in records:
+        for key in record:
+            fields.setdefault(key, None)
+    return list(fields)
+
+
+def held_column(entry: Any) -> Any:
+    # the column of a column_digests entry, None if it was freed
+    return entry() if isinstance(entry, weakref.ref) else entry
+
+
+def manifest_hashes(manifest: dict) -> list[str]:
+    if manifest["kind"] in ("table", "records"):
+        return [digest for _, digest, _ in manifest["fields"]]
+    if manifest["kind"] == "dict":
+        return [digest for _, digest in manifest["items"]]
+    if manifest["kind"] == "value":
+        return [manifest["hash"]]
+    return []
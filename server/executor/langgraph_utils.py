@@ -9,7 +9,7 @@ from server.executor.tools.data_transform_tool import data_transform_tool
 from server.executor.tools.dim_reduction_tool import dim_reduction_tool
 from server.executor.tools.segmentation_tool import segmentation_tool
 from server.AutoGenUtils import query as autogen_utils
-from server.utils import extract_json_content
+from server.utils import estimate_bytes, extract_json_content, profiler
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
@@ -17,6 +17,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")
 import json
 import re
 import copy
+import numpy as np
 from typing import Annotated, Literal, TypedDict, Dict, List, Any
 from langchain_core.messages import HumanMessage
 from langchain_openai import ChatOpenAI
@@ -25,6 +26,7 @@ from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph, MessagesState
 from langgraph.prebuilt import ToolNode
 from langchain_core.runnables import (
+    Runnable,
     RunnableConfig,
     RunnableLambda,
     RunnablePassthrough,
@@ -39,8 +41,24 @@ from server.custom_types import (
     PrimitiveTaskDescription,
     UserExecutionState,
     BaseStateSchema,
+    DocumentTable,
+    MatrixColumn,
 )
 import server.executor.tools as custom_tools
+from server.executor.checkpoint_index import get_checkpoint_index
+from server.executor.memo import document_memo
+from server.executor.node_cache import node_cache
+from server.executor.preview import preview_node
+from server.executor.tool_pool import run_tool_in_pool
+
+# tools that need all documents at once, the others run document by document
+BARRIER_TOOLS = [
+    "clustering_tool",
+    "data_transform_tool",
+    "dim_reduction_tool",
+]
+# directory of the memory-mapped embedding matrices, unset keeps them in memory
+MATRIX_DIR = os.environ.get("VIDEE_MATRIX_DIR")
 
 LOCAL_TOOL_TASKS = [
     "Data Transformation",
@@ -97,20 +115,12 @@ def update_execution_state(user_execution_state, node_id):
 
 
 def find_last_state(graph, execute_node, thread_config):
-    state_history = list(
-        reversed([step for step in graph.get_state_history(thread_config)])
-    )
-    # print([step.next[0] for step in state_history])
-    if len(state_history) == 0:
+    # the latest state waiting at the node's evaluation, i.e. the node's last output
+    index = get_checkpoint_index(graph, thread_config)
+    evaluation_config = index.evaluation_config(execute_node)
+    if evaluation_config is None:
         return None
-    past_states = [
-        step.values
-        for step in state_history
-        if step.next[0] == f"{execute_node}_evaluation"
-    ]
-    if len(past_states) == 0:
-        return None
-    return past_states[-1]
+    return graph.get_state(evaluation_config).values
 
 
 def collect_keys(
@@ -712,30 +722,31 @@ def human_approval(state):
 
 
 def get_node_config(app, thread_config, node_id, execution_version=None):
-    state_history = list(
-        reversed([step for step in app.get_state_history(thread_config)])
+    return get_checkpoint_index(app, thread_config).node_config(
+        node_id, execution_version
     )
-    node_configs = [
-        # step.config for step in state_history if step.next[0] == f"{node_id}_evaluation"
-        step.config
-        for step in state_history
-        if step.next[0] == f"{node_id}"
-    ]
-    if len(node_configs) == 0:
-        return None
-    if execution_version is None:
-        return node_configs[-1]
-    else:
-        return node_configs[execution_version]
 
 
 async def execute_node(
-    app, thread_config, node_id, execution_version=None, state=None, parallelize=False
+    app,
+    thread_config,
+    node_id,
+    execution_version=None,
+    state=None,
+    parallelize=False,
+    preview=None,
 ):
+    # a preview runs the node on a sample of the state's documents, without checkpoints
+    # preview: {"sample_size", "stratify_key", "seed"}, see preview_node
+    if preview is not None:
+        return await preview_node(app, node_id, state, **preview)
+
     # if this is the first node executed in the graph
     # then we need to invoke with the initial state
-    if len(list(app.get_state_history(thread_config))) == 0:
+    index = get_checkpoint_index(app, thread_config)
+    if index.is_empty():
         new_state = await app.ainvoke(state, config=thread_config)
+        index.refresh(app, thread_config)
         return new_state
 
     # if this is not the first node executed in the graph
@@ -757,6 +768,8 @@ async def execute_node(
                 Command(goto=node_id, update=state),
                 config=node_config,
             )
+    # index the checkpoints written by this execution
+    index.refresh(app, thread_config)
     return new_state
 
 
@@ -807,8 +820,14 @@ def execute_next(app, thread_config):
 # first, specify how to get the input (map)
 # then, specify the function to execute on the input (map)
 # finally, specify how to format the output (reduce)
-def create_node(step, custom_get_input_func=None, custom_reduce_func=None):
-    execution_chain = convert_spec_to_chain(step["execution"])
+def create_node(
+    step,
+    custom_get_input_func=None,
+    custom_reduce_func=None,
+    use_memo=True,
+    use_cache=True,
+):
+    execution_chain = convert_spec_to_chain(step["execution"], step.get("id"))
     state_input_key = step["state_input_key"]
     doc_input_keys = step["doc_input_keys"]
     state_output_key = step["state_output_key"]
@@ -820,6 +839,9 @@ def create_node(step, custom_get_input_func=None, custom_reduce_func=None):
         )
     else:
         get_input = custom_get_input_func
+    get_input = profile_runnable(
+        "input", get_input, lambda state, records: measure_records(records)
+    )
 
     # how to produce output
     if custom_reduce_func is None:
@@ -838,37 +860,109 @@ def create_node(step, custom_get_input_func=None, custom_reduce_func=None):
         #     reduce = lambda combined: reduce_func(
         #         combined, state_input_key, state_output_key
         #     )
-        reduce = lambda combined: tools_reduce_func(
-            combined, state_input_key, state_output_key, state_output_key
-        )
+        reduce = node_reduce_func(step)
     else:
         reduce = custom_reduce_func
+    reduce = profile_runnable(
+        "reduce",
+        reduce,
+        lambda combined, output: (
+            {"documents": len(output["documents"])} if "documents" in output else {}
+        ),
+    )
 
     # create the map-reduce chain
     # for clustering, dim reduction, data transformation the input is all documents
     # We cannot do batch process document by document
-    if step["execution"]["tool"] in [
-        "clustering_tool",
-        "data_transform_tool",
-        "dim_reduction_tool",
-    ]:
-        map = RunnableAssign({state_output_key: get_input | execution_chain})
+    tool_span = lambda chain: profile_runnable(
+        "tool",
+        chain,
+        lambda inputs, outputs: {
+            "documents": len(inputs),
+            "bytes": estimate_bytes(outputs),
+        },
+    )
+    if step["execution"]["tool"] in BARRIER_TOOLS:
+        map = RunnableAssign({state_output_key: get_input | tool_span(execution_chain)})
     else:
         """
         embedding_tool
         segmentation_tool
         prompt_tool
         """
-        map = RunnableAssign(
-            {
-                state_output_key: get_input
-                | RunnableLambda(
-                    func=execution_chain.batch, afunc=execution_chain.abatch
-                )
-            }
-        )
+        if use_memo:
+            # only the documents not seen with the same spec are run
+            batch = document_memo.wrap(step["execution"], execution_chain)
+        else:
+            batch = RunnableLambda(
+                func=execution_chain.batch, afunc=execution_chain.abatch
+            )
+        map = RunnableAssign({state_output_key: get_input | tool_span(batch)})
     map_reduce_chain = map | reduce
-    return map_reduce_chain
+    if use_cache and custom_get_input_func is None and custom_reduce_func is None:
+        # sessions running the same node on the same input share its output state
+        map_reduce_chain = node_cache.wrap(step, map_reduce_chain)
+    # a trace per node execution, a cached output has no input, tool or reduce spans
+    return profile_runnable(
+        "node",
+        map_reduce_chain,
+        lambda state, output: {"documents": len(state.get("documents") or [])},
+        node_id=step.get("id"),
+        tool=step["execution"]["tool"],
+    )
+
+
+def profile_runnable(name: str, runnable, measure=None, **attributes) -> RunnableLambda:
+    """
+    The runnable, timed as a span of the current trace (see utils.profiler).
+
+    Args:
+        name: The span name, i.e. the phase of the node
+        runnable: The runnable or function to time
+        measure: (input, output) -> span attributes, i.e. {"documents", "bytes"}
+        **attributes: The span's fixed attributes
+    """
+    if not isinstance(runnable, Runnable):
+        runnable = RunnableLambda(runnable)
+
+    def invoke(value, config: RunnableConfig):
+        with profiler.span(name, **attributes) as span:
+            output = runnable.invoke(value, config)
+            if measure is not None:
+                span.set(**measure(value, output))
+        return output
+
+    async def ainvoke(value, config: RunnableConfig):
+        with profiler.span(name, **attributes) as span:
+            output = await runnable.ainvoke(value, config)
+            if measure is not None:
+                span.set(**measure(value, output))
+        return output
+
+    return RunnableLambda(func=invoke, afunc=ainvoke)
+
+
+def measure_records(records) -> dict:
+    # the documents a phase reads or writes, and their estimated bytes
+    return {"documents": len(records), "bytes": estimate_bytes(records)}
+
+
+def node_reduce_func(step):
+    """The default reduce function of the step's node"""
+    return lambda combined: tools_reduce_func(
+        combined,
+        step["state_input_key"],
+        step["state_output_key"],
+        step["state_output_key"],
+    )
+
+
+def is_per_document(step) -> bool:
+    """Whether the step's node maps the documents one by one, so they can be streamed"""
+    return (
+        step["state_input_key"] == "documents"
+        and step["execution"]["tool"] not in BARRIER_TOOLS
+    )
 
 
 # an empty node that is the root of the graph
@@ -893,7 +987,6 @@ def get_input_func(
         A list of dictionaries containing only the required input fields
     """
     result = []
-    key_schemas = {}
     feature_key = "content"
     if (
         execution
@@ -903,30 +996,12 @@ def get_input_func(
         feature_key = execution["parameters"]["feature_key"]
     elif len(doc_input_keys) > 0:
         feature_key = doc_input_keys[0]
-    try:
-        key_schemas = execution["parameters"]["input_key_schemas"]
-    except Exception:
-        pass
 
     # For documents, extract fields from each document
     if state_input_key == "documents":
-        docs = state["documents"]
-        # Extract only the requested fields from each document
-        for doc in docs:
-            doc_data = {}
-            for key in doc_input_keys:
-                if key in doc:
-                    # Get the value from the document
-                    value = doc[key]
-
-                    # Use schema information for potential data validation/conversion
-                    if key in key_schemas:
-                        schema = key_schemas[key]
-                        # TODO: Here we could implement schema validation/conversion
-                        # For example, ensure lists contain the right types, etc.
-
-                    doc_data[key] = value
-            result.append(doc_data)
+        # Extract only the requested columns, the other columns are not touched.
+        # The values are passed as they are, the input_key_schemas are not enforced.
+        result = as_document_table(state["documents"]).select(doc_input_keys)
     else:
         # For other state keys, retrieve directly from state
         if "global_store" not in state:
@@ -970,13 +1045,10 @@ def get_input_func(
             # Otherwise, try to find all requested keys in the state
             # For each doc_input_key, look for a matching key in documents or global_store
             # NOTE: This should really not happen, but we do it anyway to avoid/recover from errors at best.
+            documents = as_document_table(state["documents"])
             for key in doc_input_keys:
-                if (
-                    isinstance(state["documents"], list)
-                    and len(state["documents"]) > 0
-                    and key in state["documents"][0]
-                ):
-                    result.extend([{key: doc[key]} for doc in state["documents"]])
+                if len(documents) > 0 and documents.has(key):
+                    result.extend([{key: v} for v in documents.column(key)])
                 elif key in state["global_store"]:
                     data = state["global_store"][key]
                     if isinstance(data, list):
@@ -991,14 +1063,9 @@ def reduce_func(combined: dict, state_input_key: str, state_output_key: str):
 
     result = {}
     if state_input_key == "documents":
-        original_data = combined[state_input_key]  # i.e. "documents"
-        # Create the base result with modified documents (original behavior)
-        result = {
-            "documents": [
-                {**doc, **{k: v for k, v in output.items()}}
-                for doc, output in zip(original_data, outputs)
-            ]
-        }
+        original_data = as_document_table(combined[state_input_key])
+        # Add the output keys as columns of the documents
+        result = {"documents": original_data.with_rows(outputs[: len(original_data)])}
     else:
         original_data = combined["global_store"][state_input_key]
         # Create the base result with modified global_store key
@@ -1092,6 +1159,9 @@ def tools_reduce_func(
         else:
             if label_key in ["embedding", "embeddings"]:
                 # only embeddings should reach here
+                if is_vector_output(output_data):
+                    # keep the vectors as rows of one contiguous float32 matrix
+                    output_data = MatrixColumn.from_values(output_data, MATRIX_DIR)
                 result["global_store"][state_output_key] = [
                     {label_key: v} for v in output_data
                 ]
@@ -1127,11 +1197,21 @@ def merge_back_to_original_state(
         and state_input_key not in combined["global_store"]
     ):
         return
-    input_data = (
-        combined.get(state_input_key)
-        if state_input_key == "documents"
-        else combined.get("global_store").get(state_input_key)
-    )
+    if state_input_key == "documents":
+        input_data = as_document_table(combined.get(state_input_key))
+        result[state_input_key] = input_data
+        if is_vector_output(output_data) and len(input_data) == len(output_data):
+            # Vectors (i.e. embeddings) are stored as one contiguous float32 matrix
+            result[state_input_key] = input_data.with_columns(
+                {label_key: MatrixColumn.from_values(output_data, MATRIX_DIR)}
+            )
+        elif isinstance(output_data, list) and len(input_data) == len(output_data):
+            # For outputs matching the documents, add them as columns
+            result[state_input_key] = input_data.with_rows(
+                [document_output(output, label_key) for output in output_data]
+            )
+        return
+    input_data = combined.get("global_store").get(state_input_key)
     if (
         isinstance(input_data, list)
         and isinstance(output_data, list)
@@ -1146,10 +1226,75 @@ def merge_back_to_original_state(
                 updated_items.append({**item, label_key: output})
             else:
                 updated_items.append({label_key: output})
-        if state_input_key == "documents":
-            result[state_input_key] = updated_items
-        else:
-            result["global_store"][state_input_key] = updated_items
+        result["global_store"][state_input_key] = updated_items
+
+
+def document_output(output, label_key: str) -> dict:
+    """The keys a tool output adds to its document"""
+    return output if isinstance(output, dict) else {label_key: output}
+
+
+def as_document_table(documents) -> DocumentTable:
+    # states created before the columnar store hold a list of documents
+    if isinstance(documents, DocumentTable):
+        return documents
+    return DocumentTable.from_records(documents or [])
+
+
+def is_vector_output(outputs) -> bool:
+    """Whether the per-document outputs are float vectors or matrices of one dimension (empty on errors)"""
+    if not isinstance(outputs, list):
+        return False
+    dims = set()
+    for output in outputs:
+        if (
+            isinstance(output, np.ndarray)
+            and output.dtype.kind == "f"
+            and output.ndim in (1, 2)
+        ):
+            if output.size > 0:
+                dims.add(output.shape[-1])
+        elif not (output is None or (isinstance(output, list) and len(output) == 0)):
+            return False
+    return len(dims) == 1
+
+
+def to_json_value(value):
+    """Converts the vectors in the value to lists, only done when sending it to the client"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, MatrixColumn):
+        return value.to_list()
+    if isinstance(value, list):
+        return [to_json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: to_json_value(v) for k, v in value.items()}
+    return value
+
+
+def to_legacy_state(state: dict, max_vector_dims: int = None) -> dict:
+    """Converts an execution state to the list of documents form used by the API.
+    max_vector_dims truncates the document vectors before they are converted to lists.
+    """
+    if state is None:
+        return None
+    legacy_state = dict(state)
+    if "documents" in legacy_state:
+        documents = as_document_table(state["documents"])
+        matrices = {}
+        for key in documents.keys():
+            column = documents.matrix(key)
+            if column is None:
+                continue
+            if max_vector_dims is not None:
+                column = MatrixColumn(column.matrix[:, :max_vector_dims], column.rows)
+            matrices[key] = column.to_list()
+        legacy_state["documents"] = documents.with_columns(matrices).to_records()
+    if "global_store" in legacy_state:
+        legacy_state["global_store"] = {
+            key: to_json_value(value) for key, value in state["global_store"].items()
+        }
+    return legacy_state
 
 
 def should_merge_sublist_to_global(outputs, label_key="item"):
@@ -1195,7 +1340,8 @@ def merge_list_results_to_global_list(outputs: list, label_key="item"):
     return merged_results
 
 
-def convert_spec_to_chain(spec):
+def convert_spec_to_chain(spec, node_id=None):
+    # node_id: the metrics of the tools run in the tool pool are kept per node
     if spec["tool"] == "prompt_tool":
         return custom_tools.prompt_tool(
             spec["parameters"]["name"],
@@ -1208,13 +1354,17 @@ def convert_spec_to_chain(spec):
         n_clusters = spec["parameters"].get("n_clusters", 3)
         feature_key = spec["parameters"].get("feature_key", "content")
         algorithm = spec["parameters"].get("algorithm", "kmeans")
-        return RunnableLambda(
-            lambda inputs: clustering_tool(
-                inputs,
-                n_clusters=n_clusters,
-                feature_key=feature_key,
-                algorithm=algorithm,
+        params = dict(
+            n_clusters=n_clusters, feature_key=feature_key, algorithm=algorithm
+        )
+
+        async def run_in_pool(inputs):
+            return await run_tool_in_pool(
+                "clustering_tool", inputs, node_id=node_id, **params
             )
+
+        return RunnableLambda(
+            func=lambda inputs: clustering_tool(inputs, **params), afunc=run_in_pool
         )
     elif spec["tool"] == "embedding_tool":
         api_key = spec["parameters"]["api_key"]
@@ -1243,14 +1393,20 @@ def convert_spec_to_chain(spec):
                 "output_schema",
             ]
         }
-        return RunnableLambda(
-            lambda inputs: dim_reduction_tool(
-                inputs,
-                algorithm=algorithm,
-                feature_key=feature_key,
-                n_components=n_components,
-                **extra_params,
+        params = dict(
+            algorithm=algorithm,
+            feature_key=feature_key,
+            n_components=n_components,
+            **extra_params,
+        )
+
+        async def run_in_pool(inputs):
+            return await run_tool_in_pool(
+                "dim_reduction_tool", inputs, node_id=node_id, **params
             )
+
+        return RunnableLambda(
+            func=lambda inputs: dim_reduction_tool(inputs, **params), afunc=run_in_pool
         )
 
     # Embedding Tools
@@ -1320,13 +1476,17 @@ def convert_spec_to_chain(spec):
         operation = spec["parameters"].get("operation", "transform")
         transform_code = spec["parameters"].get("transform_code", None)
         wrap_result = spec["parameters"].get("wrap_result", False)
-        return RunnableLambda(
-            lambda inputs: data_transform_tool(
-                inputs,
-                operation=operation,
-                transform_code=transform_code,
-                wrap_result=wrap_result,
+        params = dict(
+            operation=operation, transform_code=transform_code, wrap_result=wrap_result
+        )
+
+        async def run_in_pool(inputs):
+            return await run_tool_in_pool(
+                "data_transform_tool", inputs, node_id=node_id, **params
             )
+
+        return RunnableLambda(
+            func=lambda inputs: data_transform_tool(inputs, **params), afunc=run_in_pool
         )
     else:
         raise ValueError(f"Unknown execution type: {spec}")
@@ -1,5 +1,5 @@
 import server.executor.tools as custom_tools
-from .langgraph_utils import get_input_func, reduce_func
+from .langgraph_utils import get_input_func, reduce_func, as_document_table
 from langchain_core.runnables import RunnableAssign, RunnableLambda
 from server.AutoGenUtils import query
 from langgraph.graph import END, START, StateGraph, MessagesState
@@ -30,11 +30,11 @@ async def create_evaluator_specs(evaluator_description_pairs, model, api_key):
 
 def evaluator_reduce_func(combined, state_input_key, state_output_key):
     outputs = combined[state_output_key]  # "summaries"
-    documents = combined[state_input_key]  # "documents"
+    documents = as_document_table(combined[state_input_key])  # "documents"
     return {
-        "documents": [
-            {**doc, state_output_key: output} for doc, output in zip(documents, outputs)
-        ]
+        "documents": documents.with_rows(
+            [{state_output_key: output} for output in outputs[: len(documents)]]
+        )
     }
 
 
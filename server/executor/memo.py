@@ -0,0 +1,185 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+
+from server.utils import estimate_bytes
+
+# documents outputs remembered across executions, least recently used go first
+MEMO_MAX_ENTRIES = 200_000
+# memory budget of the remembered outputs (i.e. embedding vectors)
+MEMO_MAX_BYTES = 512 * 1024 * 1024
+# execution parameters that do not change the outputs
+IGNORED_PARAMETERS = ("api_key",)
+
+
+def hash_spec(execution: dict) -> str:
+    """Hash of a node's execution spec (tool and parameters)"""
+    spec = dict(execution)
+    if isinstance(spec.get("parameters"), dict):
+        spec["parameters"] = {
+            k: v for k, v in spec["parameters"].items() if k not in IGNORED_PARAMETERS
+        }
+    return hashlib.sha256(
+        json.dumps(spec, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def hash_value(value) -> str:
+    """Hash of a json-like value, vectors included"""
+    hasher = hashlib.sha256()
+    _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def _update_hash(hasher, value):
+    if isinstance(value, np.ndarray):
+        hasher.update(f"a{value.dtype.str}{value.shape}".encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        hasher.update(f"d{len(value)}".encode())
+        for key in sorted(value, key=str):
+            _update_hash(hasher, key)
+            _update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f"l{len(value)}".encode())
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(b"v" + json.dumps(value, default=str).encode() + b"\0")
+
+
+def is_memoizable(output) -> bool:
+    # the tools return empty outputs on errors, those are recomputed next time
+    if output is None:
+        return False
+    if isinstance(output, np.ndarray):
+        return output.size > 0
+    if isinstance(output, (list, dict, str)):
+        return len(output) > 0
+    return True
+
+
+class DocumentMemo:
+    """Outputs of per-document nodes by (execution spec hash, document input hash).
+
+    A node wrapped with wrap() only runs the documents whose projected input it has
+    not seen with the same spec, and splices the remembered outputs back in order.
+    Re-running a node, or the pipeline after appending documents to the dataset,
+    then only computes the new or changed documents.
+    """
+
+    def __init__(
+        self, max_entries: int = MEMO_MAX_ENTRIES, max_bytes: int = MEMO_MAX_BYTES
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (output, estimated bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple[str, str]):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key: tuple[str, str], output):
+        if not is_memoizable(output):
+            return
+        nbytes = estimate_bytes(output)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (output, nbytes)
+            self.total_bytes += nbytes
+            while (
+                len(self.entries) > self.max_entries
+                or self.total_bytes > self.max_bytes
+            ):
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _lookup(self, spec_hash: str, inputs: list):
+        keys = [(spec_hash, hash_value(x)) for x in inputs]
+        outputs = [self.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        return keys, outputs, missing
+
+    def _splice(self, keys, outputs, missing, computed):
+        for i, output in zip(missing, computed):
+            outputs[i] = output
+            self.put(keys[i], output)
+        return outputs
+
+    def wrap(self, execution: dict, execution_chain) -> RunnableLambda:
+        """A batch runnable for the node's documents that only runs the unseen ones"""
+        spec_hash = hash_spec(execution)
+
+        def batch(inputs: list) -> list:
+            keys, outputs, missing = self._lookup(spec_hash, inputs)
+            computed = (
+                execution_chain.batch([inputs[i] for i in missing]) if missing else []
+            )
+            return self._splice(keys, outputs, missing, computed)
+
+        async def abatch(inputs: list) -> list:
+            keys, outputs, missing = self._lookup(spec_hash, inputs)
+            if not missing:
+                return outputs
+            # each output is remembered when it is done, so a cancelled execution
+            # keeps its finished documents and only runs the others next time
+            pending = [inputs[i] for i in missing]
+            async for j, output in execution_chain.abatch_as_completed(pending):
+                outputs[missing[j]] = output
+                self.put(keys[missing[j]], output)
+            return outputs
+
+        return RunnableLambda(func=batch, afunc=abatch)
+
+    async def ainvoke(
+        self, execution: dict, execution_chain, inputs: dict, spec_hash: str = None
+    ):
+        """Runs one document through the node, unless it was seen with the same spec"""
+        key = (spec_hash or hash_spec(execution), hash_value(inputs))
+        output = self.get(key)
+        if output is None:
+            output = await execution_chain.ainvoke(inputs)
+            self.put(key, output)
+        return output
+
+
+# shared by all nodes of all sessions, specs are hashed without api keys
+document_memo = DocumentMemo()
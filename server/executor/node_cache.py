@@ -0,0 +1,194 @@
+import threading
+from collections import OrderedDict
+
+from langchain_core.runnables import RunnableLambda
+
+from server.custom_types import DocumentTable, MatrixColumn
+from server.executor.memo import hash_spec, hash_value
+from server.utils import estimate_bytes
+
+# memory budget of the cached node outputs, least recently used go first
+NODE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# memory budget of the columns and store values whose digest is remembered,
+# see NodeResultCache.digest
+DIGEST_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class NodeResultCache:
+    """Output states of nodes shared by all sessions, keyed by
+    (dataset fingerprint, upstream lineage hash, node spec hash).
+
+    The dataset fingerprint and the lineage are both taken from the node's input state:
+    its documents start as the dataset and every upstream node adds or replaces columns
+    and global store keys, so the digest of the input's columns and store values stands
+    for the dataset and everything computed from it. Columns are never modified in place
+    and are shared between states, so each one is only hashed the first time it is seen.
+    A new session that runs the same nodes on the same dataset gets the cached states,
+    whose columns already have digests, all the way down the plan.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = NODE_CACHE_MAX_BYTES,
+        max_digest_bytes: int = DIGEST_CACHE_MAX_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_digest_bytes = max_digest_bytes
+        # key -> (output state, estimated bytes)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # id(value) -> (value, digest, estimated bytes), holding the value so its id
+        # cannot be reused
+        self.digests = OrderedDict()
+        self.digest_bytes = 0
+
+    # ---- fingerprints ----
+
+    def digest(self, value) -> str:
+        with self.lock:
+            cached = self.digests.get(id(value))
+            if cached is not None and cached[0] is value:
+                self.digests.move_to_end(id(value))
+                return cached[1]
+        if isinstance(value, MatrixColumn):
+            digest = hash_value({"rows": value.rows, "matrix": value.matrix})
+        else:
+            digest = hash_value(value)
+        nbytes = estimate_bytes(value)
+        if nbytes > self.max_digest_bytes:
+            return digest
+        with self.lock:
+            if id(value) in self.digests:
+                self.digest_bytes -= self.digests.pop(id(value))[2]
+            self.digests[id(value)] = (value, digest, nbytes)
+            self.digest_bytes += nbytes
+            while self.digest_bytes > self.max_digest_bytes:
+                _, (_, _, evicted_bytes) = self.digests.popitem(last=False)
+                self.digest_bytes -= evicted_bytes
+        return digest
+
+    def fingerprint(self, state: dict) -> tuple[str, str]:
+        """(dataset fingerprint, lineage hash) of a node's input state"""
+        documents = state.get("documents")
+        if not isinstance(documents, DocumentTable):
+            documents = DocumentTable.from_records(documents or [])
+        dataset = hash_value(
+            [len(documents), sorted(documents.keys()), documents.missing]
+        )
+        lineage = hash_value(
+            {
+                "columns": {
+                    key: self.digest(column) for key, column in documents.columns.items()
+                },
+                "global_store": {
+                    key: self.digest(value)
+                    for key, value in state.get("global_store", {}).items()
+                },
+            }
+        )
+        return dataset, lineage
+
+    # ---- entries ----
+
+    def get(self, key: tuple):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key: tuple, state: dict):
+        nbytes = estimate_bytes(state)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (state, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.digests.clear()
+            self.digest_bytes = 0
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "digest_bytes": self.digest_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    # ---- nodes ----
+
+    def wrap(self, step: dict, node_chain) -> RunnableLambda:
+        """The node's chain, returning the cached output state when there is one.
+        The node spec is the step's execution and the keys it reads and writes.
+        """
+        spec_hash = hash_value(
+            [
+                hash_spec(step["execution"]),
+                step.get("state_input_key"),
+                step.get("doc_input_keys"),
+                step.get("state_output_key"),
+            ]
+        )
+
+        def key_of(state: dict) -> tuple:
+            return (*self.fingerprint(state), spec_hash)
+
+        def remember(key: tuple, output: dict) -> dict:
+            self.put(key, cacheable_state(output))
+            return output
+
+        def invoke(state: dict) -> dict:
+            key = key_of(state)
+            cached = self.get(key)
+            if cached is not None:
+                return restore_state(cached)
+            return remember(key, node_chain.invoke(state))
+
+        async def ainvoke(state: dict) -> dict:
+            key = key_of(state)
+            cached = self.get(key)
+            if cached is not None:
+                return restore_state(cached)
+            return remember(key, await node_chain.ainvoke(state))
+
+        return RunnableLambda(func=invoke, afunc=ainvoke)
+
+
+def cacheable_state(output: dict) -> dict:
+    # the reduce functions update the global store in place, keep a copy of the dict
+    state = {key: output[key] for key in ("documents", "global_store") if key in output}
+    if "global_store" in state:
+        state["global_store"] = dict(state["global_store"])
+    return state
+
+
+def restore_state(cached: dict) -> dict:
+    state = dict(cached)
+    if "global_store" in state:
+        state["global_store"] = dict(state["global_store"])
+    return state
+
+
+# shared by all sessions
+node_cache = NodeResultCache()
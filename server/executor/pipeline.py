@@ -0,0 +1,407 @@
+"""Headless execution of a compiled plan: runs the whole DAG on a dataset without
+the human approval interrupts of create_graph. A node starts as soon as all its parents
+are done, so independent branches run concurrently and the pipeline takes about as
+long as its critical path. Within chains of per-document nodes (i.e. prompt_tool,
+segmentation_tool, embedding_tool) each document is streamed to the next node as soon
+as it is done, the barrier tools (see BARRIER_TOOLS) still wait for all documents.
+
+Usage:
+    python -m server.executor.pipeline --plan plan.json --dataset docs.json --output result.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+
+from server.custom_types import DocumentTable, PrimitiveTaskExecution
+from server.executor.langgraph_utils import (
+    as_document_table,
+    convert_spec_to_chain,
+    create_node,
+    document_output,
+    is_per_document,
+    node_reduce_func,
+    to_legacy_state,
+)
+from server.executor.memo import document_memo, hash_spec
+from server.utils import profiler
+
+# documents waiting before each streamed node, a full queue pauses the upstream node
+STREAM_QUEUE_SIZE = 32
+# documents processed at the same time by each streamed node
+STREAM_WORKERS = 16
+
+
+def executable_steps(steps: list[PrimitiveTaskExecution]) -> list[PrimitiveTaskExecution]:
+    """The compiled steps of the plan, without the root and the uncompiled nodes"""
+    return [
+        step
+        for step in steps
+        if step is not None and step["id"] != "-1" and "execution" in step
+    ]
+
+
+def topological_order(steps: list[PrimitiveTaskExecution]) -> list[str]:
+    """Node ids with every node after its parents. Raises ValueError for cycles."""
+    step_ids = {step["id"] for step in steps}
+    in_degree = {}
+    children = defaultdict(list)
+    for step in steps:
+        parent_ids = [p for p in step["parentIds"] if p in step_ids]
+        in_degree[step["id"]] = len(parent_ids)
+        for parent_id in parent_ids:
+            children[parent_id].append(step["id"])
+    order = [step["id"] for step in steps if in_degree[step["id"]] == 0]
+    for node_id in order:
+        for child_id in children[node_id]:
+            in_degree[child_id] -= 1
+            if in_degree[child_id] == 0:
+                order.append(child_id)
+    if len(order) != len(steps):
+        cyclic = sorted(node_id for node_id, degree in in_degree.items() if degree > 0)
+        raise ValueError(f"The execution plan has a cycle through: {cyclic}")
+    return order
+
+
+def merge_states(states: list[dict], ancestor: dict) -> dict:
+    """Input state of a node with several parents.
+    Each parent is compared with the state of their nearest common ancestor (see
+    common_ancestor): the document columns and global store keys a parent added or
+    replaced are combined. Columns are shared between states, so a column that is not
+    the ancestor's was changed on that parent's branch. When several parents changed
+    the same column, the last one in parentIds is taken.
+    Raises ValueError if the parents have different numbers of documents.
+    """
+    if len(states) == 1:
+        return states[0]
+    base = as_document_table(ancestor["documents"])
+    base_store = ancestor.get("global_store", {})
+    documents = as_document_table(states[0]["documents"])
+    global_store = dict(states[0].get("global_store", {}))
+    for state in states[1:]:
+        other = as_document_table(state["documents"])
+        if len(other) != len(documents):
+            raise ValueError(
+                "Cannot merge the states of parents with different numbers of "
+                f"documents: {len(documents)} and {len(other)}"
+            )
+        changed = {
+            key: column
+            for key, column in other.columns.items()
+            if base.columns.get(key) is not column
+        }
+        documents = documents.with_columns(
+            changed, {key: other.missing.get(key, []) for key in changed}
+        )
+        global_store.update(
+            {
+                key: value
+                for key, value in state.get("global_store", {}).items()
+                if key not in base_store or base_store[key] is not value
+            }
+        )
+    return {"documents": documents, "global_store": global_store}
+
+
+def common_ancestor(
+    steps_by_id: dict[str, PrimitiveTaskExecution], order: list[str], parent_ids: list[str]
+) -> str:
+    """The last node in topological order that is one of the parents or an ancestor of
+    all of them, None if they have no common ancestor"""
+
+    def ancestors(node_id: str) -> set[str]:
+        found = {node_id}
+        stack = [node_id]
+        while stack:
+            for parent_id in steps_by_id[stack.pop()]["parentIds"]:
+                if parent_id in steps_by_id and parent_id not in found:
+                    found.add(parent_id)
+                    stack.append(parent_id)
+        return found
+
+    common = set.intersection(*(ancestors(parent_id) for parent_id in parent_ids))
+    return max(common, key=order.index, default=None)
+
+
+def streaming_groups(
+    steps: list[PrimitiveTaskExecution], order: list[str]
+) -> list[list[str]]:
+    """Splits the nodes into the groups that run together, in topological order.
+    A per-document node whose only parent is a per-document node joins its parent's
+    group, so its documents are streamed from the parent. The other nodes head a group.
+    """
+    steps_by_id = {step["id"]: step for step in steps}
+    heads = {}
+    groups = defaultdict(list)
+    for node_id in order:
+        step = steps_by_id[node_id]
+        parent_ids = [p for p in step["parentIds"] if p in steps_by_id]
+        if (
+            len(parent_ids) == 1
+            and is_per_document(step)
+            and is_per_document(steps_by_id[parent_ids[0]])
+        ):
+            heads[node_id] = heads[parent_ids[0]]
+        else:
+            heads[node_id] = node_id
+        groups[heads[node_id]].append(node_id)
+    return list(groups.values())
+
+
+def node_state(output: dict, state: dict) -> dict:
+    """The output state of a node, with only the state channels as the graph's schema does"""
+    return {
+        "documents": as_document_table(output.get("documents", state["documents"])),
+        "global_store": output.get("global_store", state["global_store"]),
+    }
+
+
+def own_global_store(state: dict) -> dict:
+    # the reduce functions update the global store in place, siblings get their own
+    return {**state, "global_store": dict(state["global_store"])}
+
+
+async def stream_documents(
+    steps: list[PrimitiveTaskExecution],
+    state: dict,
+    on_step_done,
+    queue_size: int = None,
+    workers: int = None,
+):
+    """
+    Runs a group of per-document steps, each a child of an earlier step in the group,
+    the first one on the given state. Every document flows to the child steps as soon as
+    the parent step is done with it, through bounded queues: a full queue pauses the parent.
+
+    Args:
+        steps: The per-document steps, see streaming_groups
+        state: The input state of the first step
+        on_step_done: Callback (step, state, seconds), called as each step has all its outputs
+        queue_size: Documents waiting before each step (default: STREAM_QUEUE_SIZE)
+        workers: Documents processed at the same time by each step (default: STREAM_WORKERS)
+    """
+    queue_size = queue_size or STREAM_QUEUE_SIZE
+    workers = workers or STREAM_WORKERS
+    documents = as_document_table(state["documents"])
+    stage_of = {step["id"]: stage for stage, step in enumerate(steps)}
+    child_stages = defaultdict(list)
+    parent_stage = {}
+    for stage, step in enumerate(steps[1:], start=1):
+        parent_id = next(p for p in step["parentIds"] if p in stage_of)
+        parent_stage[stage] = stage_of[parent_id]
+        child_stages[stage_of[parent_id]].append(stage)
+    chains = [convert_spec_to_chain(step["execution"]) for step in steps]
+    spec_hashes = [hash_spec(step["execution"]) for step in steps]
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in steps]
+    outputs = [[None] * len(documents) for _ in steps]
+    states = {}
+    started = {}
+
+    async def feed():
+        for i, document in enumerate(documents.to_records()):
+            await queues[0].put((i, document))
+        for _ in range(workers):
+            await queues[0].put(None)
+
+    async def work(stage: int):
+        step = steps[stage]
+        while True:
+            item = await queues[stage].get()
+            if item is None:
+                return
+            i, document = item
+            started.setdefault(stage, time.perf_counter())
+            # the same projection as get_input_func
+            inputs = {
+                key: document[key] for key in step["doc_input_keys"] if key in document
+            }
+            output = await document_memo.ainvoke(
+                step["execution"], chains[stage], inputs, spec_hashes[stage]
+            )
+            outputs[stage][i] = output
+            document = {
+                **document,
+                **document_output(output, step["state_output_key"]),
+            }
+            for child_stage in child_stages[stage]:
+                await queues[child_stage].put((i, document))
+
+    async def run_stage(stage: int):
+        await asyncio.gather(*(work(stage) for _ in range(workers)))
+        # reduce the outputs into the state, as the node's chain does after its batch
+        step = steps[stage]
+        input_state = states[parent_stage[stage]] if stage in parent_stage else state
+        combined = {
+            **own_global_store(input_state),
+            step["state_output_key"]: outputs[stage],
+        }
+        with profiler.span("reduce", node_id=step["id"]) as span:
+            states[stage] = node_state(node_reduce_func(step)(combined), input_state)
+            span.set(documents=len(states[stage]["documents"]))
+        seconds = time.perf_counter() - started.get(stage, time.perf_counter())
+        on_step_done(step, states[stage], seconds)
+        for child_stage in child_stages[stage]:
+            for _ in range(workers):
+                await queues[child_stage].put(None)
+
+    await asyncio.gather(feed(), *(run_stage(stage) for stage in range(len(steps))))
+
+
+async def run_pipeline(
+    steps: list[PrimitiveTaskExecution],
+    initial_state: dict,
+    max_concurrency: int = None,
+    on_node_done=None,
+    stream: bool = True,
+) -> tuple[dict[str, dict], dict[str, float]]:
+    """
+    Executes every compiled step of the plan on the initial state.
+
+    Args:
+        steps: The compiled execution plan
+        initial_state: The state of the root nodes, i.e. {"documents": DocumentTable}
+        max_concurrency: At most this many nodes run at the same time (default: no limit),
+            a streamed group counts as one
+        on_node_done: Optional callback (node_id, state, seconds), called as each node finishes
+        stream: Stream the documents through chains of per-document nodes, see stream_documents.
+            Otherwise every node waits for all the outputs of its parents.
+
+    Returns:
+        The output state and the execution seconds of each node
+    """
+    steps = executable_steps(steps)
+    steps_by_id = {step["id"]: step for step in steps}
+    order = topological_order(steps)
+    initial_state = {
+        "documents": as_document_table(initial_state.get("documents")),
+        "global_store": initial_state.get("global_store", {}),
+    }
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    loop = asyncio.get_running_loop()
+    # node id -> its output state, once the node is done
+    futures = {node_id: loop.create_future() for node_id in order}
+    results = {}
+    timings = {}
+
+    def finish(step, state, seconds):
+        results[step["id"]] = state
+        timings[step["id"]] = seconds
+        futures[step["id"]].set_result(state)
+        if on_node_done is not None:
+            on_node_done(step["id"], state, seconds)
+
+    async def input_state(step) -> dict:
+        parent_ids = [p for p in step["parentIds"] if p in steps_by_id]
+        parent_states = [await futures[parent_id] for parent_id in parent_ids]
+        if len(parent_states) > 1:
+            ancestor_id = common_ancestor(steps_by_id, order, parent_ids)
+            ancestor = results[ancestor_id] if ancestor_id else initial_state
+            state = merge_states(parent_states, ancestor)
+        else:
+            state = parent_states[0] if parent_states else initial_state
+        return own_global_store(state)
+
+    async def run_group(group: list[str]):
+        state = await input_state(steps_by_id[group[0]])
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            if len(group) > 1:
+                # the streamed nodes have no input and tool spans, only their reduce
+                with profiler.span("stream", node_id=group[0], nodes=len(group)):
+                    await stream_documents(
+                        [steps_by_id[n] for n in group], state, finish
+                    )
+                return
+            step = steps_by_id[group[0]]
+            start = time.perf_counter()
+            output = await create_node(step).ainvoke(state)
+            finish(step, node_state(output, state), time.perf_counter() - start)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    groups = streaming_groups(steps, order) if stream else [[n] for n in order]
+    tasks = [asyncio.create_task(run_group(group)) for group in groups]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results, timings
+
+
+def critical_path_seconds(
+    steps: list[PrimitiveTaskExecution], timings: dict[str, float]
+) -> float:
+    """The longest chain of node timings, the lower bound of the pipeline time"""
+    steps = executable_steps(steps)
+    steps_by_id = {step["id"]: step for step in steps}
+    finish = {}
+    for node_id in topological_order(steps):
+        parent_ids = [p for p in steps_by_id[node_id]["parentIds"] if p in finish]
+        start = max((finish[p] for p in parent_ids), default=0.0)
+        finish[node_id] = start + timings.get(node_id, 0.0)
+    return max(finish.values(), default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plan", required=True, help="compiled execution plan (json)")
+    parser.add_argument("--dataset", required=True, help="documents (json list)")
+    parser.add_argument("--output", help="write the output state of every node as json")
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="run every node on all documents before its children start",
+    )
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get("OPENAI_API_KEY"),
+        help="replaces the api_key of the plan's tools (default: $OPENAI_API_KEY)",
+    )
+    args = parser.parse_args()
+
+    steps = json.load(open(args.plan))
+    if args.api_key:
+        for step in executable_steps(steps):
+            if "api_key" in step["execution"].get("parameters", {}):
+                step["execution"]["parameters"]["api_key"] = args.api_key
+    initial_state = {
+        "documents": DocumentTable.from_records(json.load(open(args.dataset)))
+    }
+
+    def report(node_id, state, seconds):
+        print(f"{node_id}: {seconds:.1f}s")
+
+    start = time.perf_counter()
+    results, timings = asyncio.run(
+        run_pipeline(
+            steps, initial_state, args.max_concurrency, report, stream=not args.no_stream
+        )
+    )
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(results)} nodes in {elapsed:.1f}s, "
+        f"critical path {critical_path_seconds(steps, timings):.1f}s, "
+        f"sum of nodes {sum(timings.values()):.1f}s"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    node_id: to_legacy_state(state)
+                    for node_id, state in results.items()
+                },
+                f,
+                indent=4,
+                ensure_ascii=False,
+            )
+
+
+if __name__ == "__main__":
+    main()
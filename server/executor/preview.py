@@ -0,0 +1,111 @@
+import random
+from collections import defaultdict
+
+from server.custom_types import DocumentTable
+
+# documents a preview runs on when no sample size is given
+PREVIEW_SAMPLE_SIZE = 50
+
+
+def sample_indices(
+    documents, size: int, stratify_key: str = None, seed: int = 0
+) -> list[int]:
+    """
+    Indices of a sample of the documents, in document order.
+
+    Args:
+        documents: The DocumentTable to sample from
+        size: The number of documents to sample
+        stratify_key: A document key (i.e. a cluster label). Each of its values gets a share
+            of the sample proportional to its documents, and at least one document while the
+            sample size allows. Without it the sample is uniformly random.
+        seed: The same seed gives the same sample, so the previews of a node are comparable
+
+    Returns:
+        The sampled indices
+    """
+    rng = random.Random(seed)
+    n = len(documents)
+    if size >= n:
+        return list(range(n))
+    if stratify_key is None or not documents.has(stratify_key):
+        return sorted(rng.sample(range(n), size))
+
+    column = documents.column(stratify_key)
+    missing = set(documents.missing.get(stratify_key, []))
+    strata = defaultdict(list)
+    for i in range(n):
+        # documents without the key form their own stratum
+        strata[None if i in missing else repr(column[i])].append(i)
+    strata = sorted(strata.values(), key=len, reverse=True)
+    if len(strata) >= size:
+        # one document of each of the largest strata
+        shares = [1] * size + [0] * (len(strata) - size)
+    else:
+        shares = [
+            min(len(stratum), max(1, size * len(stratum) // n)) for stratum in strata
+        ]
+        # every stratum keeps at least one document
+        while sum(shares) > size:
+            shares[shares.index(max(shares))] -= 1
+        # the rest of the sample goes to the largest strata
+        for s, stratum in enumerate(strata):
+            shares[s] += min(len(stratum) - shares[s], size - sum(shares))
+    indices = []
+    for stratum, share in zip(strata, shares):
+        indices.extend(rng.sample(stratum, share))
+    return sorted(indices)
+
+
+def input_documents(state: dict) -> DocumentTable:
+    documents = state.get("documents")
+    if not isinstance(documents, DocumentTable):
+        documents = DocumentTable.from_records(documents or [])
+    return documents
+
+
+def sample_state(state: dict, indices: list[int]) -> dict:
+    """The state with only the sampled documents, the global store is kept as is"""
+    sampled = dict(state)
+    sampled["documents"] = input_documents(state).take(indices)
+    if "global_store" in state:
+        sampled["global_store"] = dict(state["global_store"])
+    return sampled
+
+
+async def preview_node(
+    app,
+    node_id: str,
+    state: dict,
+    sample_size: int = PREVIEW_SAMPLE_SIZE,
+    stratify_key: str = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Runs a node of the graph on a sample of its input documents, outside of the graph,
+    so the preview leaves the node's execution history untouched.
+
+    The node runs through its document memo, so executing it on all the documents later
+    only computes the documents that were not in the sample (per-document nodes only,
+    the tools in BARRIER_TOOLS see all the documents at once and run again).
+
+    Args:
+        app: The compiled execution graph
+        node_id: The node to preview
+        state: The node's input state (i.e. its parent's last state)
+        sample_size, stratify_key, seed: See sample_indices
+
+    Returns:
+        {"state": the output state on the sample, "indices": the sampled document indices,
+         "total": the number of input documents}
+    """
+    node = app.builder.nodes[node_id].runnable
+    documents = input_documents(state)
+    indices = sample_indices(documents, sample_size, stratify_key, seed)
+    output = await node.ainvoke(sample_state(state, indices))
+    return {
+        "state": output,
+        "indices": indices,
+        "total": len(documents),
+        "stratify_key": stratify_key,
+    }
@@ -10,7 +10,6 @@ from openai import RateLimitError, APITimeoutError
 from openai import OpenAI
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_agentchat.agents import AssistantAgent
-from autogen_core import CancellationToken
 from autogen_agentchat.messages import TextMessage
 import json
 import time
@@ -20,7 +19,7 @@ import asyncio
 import traceback
 from tqdm.asyncio import tqdm_asyncio
 from sklearn.feature_extraction.text import TfidfVectorizer
-from server.utils import extract_json_content
+from server.utils import extract_json_content, cancellation_token
 
 
 async def radial_dr(texts: list[str], model: str, api_key: str):
@@ -94,7 +93,7 @@ async def call_agent(agent, user_message):
     print("calling agent - token length: ", token_length)
     response = await agent.on_messages(
         [TextMessage(content=user_message, source="user")],
-        cancellation_token=CancellationToken(),
+        cancellation_token=cancellation_token(),
     )
     return response
 
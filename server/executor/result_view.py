@@ -0,0 +1,173 @@
+import base64
+import operator
+
+import numpy as np
+
+from server.custom_types import MatrixColumn
+from server.executor.langgraph_utils import as_document_table, to_json_value
+
+# global store keys of per-document vectors, only their first items are returned
+STORE_PREVIEW_KEYS = ("embeddings", "embedding")
+STORE_PREVIEW_ITEMS = 10
+
+# filter operators, {"key": ..., "op": ..., "value": ...}
+FILTER_OPS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "in": lambda value, options: value in options,
+    "contains": lambda value, part: part in value,
+    "exists": lambda value, _: value is not None,
+}
+
+
+def matching_indices(documents, filters: list[dict]) -> list[int]:
+    """Indices of the documents matching all filters, only the filtered columns are read"""
+    indices = range(len(documents))
+    for condition in filters or []:
+        key = condition["key"]
+        op = FILTER_OPS[condition.get("op", "eq")]
+        if not documents.has(key):
+            return []
+        column = documents.column(key)
+        missing = set(documents.missing.get(key, []))
+
+        def matches(i):
+            if i in missing:
+                return False
+            try:
+                return bool(op(column[i], condition.get("value")))
+            except TypeError:
+                return False
+
+        indices = [i for i in indices if matches(i)]
+    return list(indices)
+
+
+def encode_matrix(matrix: np.ndarray) -> dict:
+    """A float32 matrix as base64 little-endian bytes, for Float32Array on the client"""
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    return {
+        "dtype": "float32",
+        "shape": list(matrix.shape),
+        "data": base64.b64encode(matrix.tobytes()).decode("ascii"),
+    }
+
+
+def is_float_vector(value) -> bool:
+    if isinstance(value, np.ndarray):
+        return value.ndim == 1 and np.issubdtype(value.dtype, np.floating)
+    return (
+        isinstance(value, list) and len(value) > 0 and isinstance(value[0], float)
+    )
+
+
+def store_view(key: str, value, max_vector_dims: int = None):
+    """
+    The part of a global store value that is returned, before it is converted to JSON:
+    the first STORE_PREVIEW_ITEMS of the STORE_PREVIEW_KEYS, and the vectors (matrices,
+    lists of vectors) truncated to max_vector_dims.
+    """
+    if isinstance(value, MatrixColumn):
+        value = value.matrix
+    if key in STORE_PREVIEW_KEYS and isinstance(value, (list, np.ndarray)):
+        value = value[:STORE_PREVIEW_ITEMS]
+    if max_vector_dims is None:
+        return value
+    if isinstance(value, np.ndarray) and value.ndim >= 2:
+        return value[..., :max_vector_dims]
+    if isinstance(value, list) and len(value) > 0 and is_float_vector(value[0]):
+        return [
+            item[:max_vector_dims] if is_float_vector(item) else item for item in value
+        ]
+    return value
+
+
+def result_view(
+    state: dict,
+    fields: list[str] = None,
+    offset: int = 0,
+    limit: int = None,
+    filters: list[dict] = None,
+    store_keys: list[str] = None,
+    max_vector_dims: int = None,
+    binary_vectors: bool = False,
+) -> dict:
+    """
+    A read-only view of an execution state for the client. The stored state is never modified.
+
+    Args:
+        state: The execution state
+        fields: Document keys to return (default: all)
+        offset, limit: The page of the matching documents to return (default: all)
+        filters: Conditions on document keys, see FILTER_OPS
+        store_keys: Global store keys to return (default: all)
+        max_vector_dims: Truncates the document and global store vectors to this many
+            dimensions
+        binary_vectors: Return the vectors of matrix columns as base64 float32 matrices in
+            "vectors" (one per key), the documents hold their row index (or [start, stop] rows)
+
+    Returns:
+        {"documents", "global_store", "total", "offset", "limit"} and "vectors" if binary_vectors
+    """
+    documents = as_document_table(state.get("documents"))
+    indices = matching_indices(documents, filters)
+    total = len(indices)
+    indices = indices[offset : None if limit is None else offset + limit]
+    keys = [
+        key
+        for key in (fields if fields is not None else documents.keys())
+        if documents.has(key)
+    ]
+
+    page = [{} for _ in indices]
+    vectors = {}
+    for key in keys:
+        column = documents.column(key)
+        missing = set(documents.missing.get(key, []))
+        if isinstance(column, MatrixColumn):
+            matrix = column.matrix
+            if max_vector_dims is not None:
+                matrix = matrix[:, :max_vector_dims]
+            if binary_vectors:
+                # only the rows of the page are sent, renumbered from 0
+                rows, row_indices = [], []
+                for i in indices:
+                    row = column.rows[i]
+                    if row is None:
+                        rows.append(None)
+                    elif isinstance(row, int):
+                        rows.append(len(row_indices))
+                        row_indices.append(row)
+                    else:
+                        start = len(row_indices)
+                        rows.append([start, start + row[1] - row[0]])
+                        row_indices.extend(range(row[0], row[1]))
+                vectors[key] = encode_matrix(matrix[row_indices])
+                for document, i, row in zip(page, indices, rows):
+                    if i not in missing:
+                        document[key] = row
+                continue
+            column = MatrixColumn(matrix, column.rows)
+        for document, i in zip(page, indices):
+            if i not in missing:
+                document[key] = to_json_value(column[i])
+
+    global_store = state.get("global_store", {})
+    view = {
+        "documents": page,
+        "global_store": {
+            key: to_json_value(store_view(key, value, max_vector_dims))
+            for key, value in global_store.items()
+            if store_keys is None or key in store_keys
+        },
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+    }
+    if binary_vectors:
+        view["vectors"] = vectors
+    return view
@@ -0,0 +1,184 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from server.executor.preview import input_documents
+from server.utils import TaskCancelled, task_registry
+from server.utils.profiling import current_span
+
+# whether executions speculate on their children when the request does not say
+SPECULATE = os.environ.get("VIDEE_SPECULATE", "0") == "1"
+# speculative runs at the same time over all sessions, the others wait their turn
+SPECULATION_WORKERS = int(os.environ.get("VIDEE_SPECULATION_WORKERS", 1))
+# children speculated after each execution
+SPECULATION_MAX_CHILDREN = 2
+# larger inputs are not speculated on
+SPECULATION_MAX_DOCUMENTS = 5000
+
+
+class Speculation:
+    """A child node run on its parent's output before the user executes it"""
+
+    def __init__(self, node_id: str, parent_id: str, node, state: dict):
+        self.node_id = node_id
+        self.parent_id = parent_id
+        # the node's runnable and its input, to start the run again after a pause
+        self.node = node
+        self.input_state = state
+        self.task = None
+        # whether it was stopped for a foreground execution, see foreground()
+        self.paused = False
+        # whether it got a slot, see speculation_slots
+        self.started = False
+        self.state = None
+        self.error = None
+
+    def done(self) -> bool:
+        return self.task is not None and self.task.done()
+
+    def info(self) -> dict:
+        return {
+            "node_id": self.node_id,
+            "parent_id": self.parent_id,
+            "started": self.started,
+            "paused": self.paused,
+            "done": self.done(),
+            "error": self.error,
+        }
+
+
+class SpeculativeRuns(dict):
+    """The speculative runs of a session, node id -> Speculation.
+
+    A run is the node's runnable called outside the graph, like a preview, so the node's
+    execution history is untouched. It goes through the node cache, so when the user
+    executes the node on the same input the graph gets the cached output at once: the
+    provisional result is adopted. A run whose parent was executed again or whose plan
+    was edited or compiled is discarded, and its cached output, keyed by the input and
+    the node spec, is never matched again.
+    Runs are low priority: they pause while the session executes a node (see
+    foreground), and wait for the speculative runs of other sessions (see
+    speculation_slots). Runs of different sessions still share the LLM clients and
+    the tool pool with the foreground executions of other sessions.
+    """
+
+    def __init__(self, session_id: str):
+        super().__init__()
+        self.session_id = session_id
+        # foreground executions of the session running, runs start once it is 0
+        self.foreground_executions = 0
+
+    def start(self, app, parent_id: str, child_ids: list[str], state: dict) -> list[str]:
+        """
+        Starts the speculative runs of the children on the parent's output state,
+        within the budget (SPECULATION_MAX_CHILDREN, SPECULATION_MAX_DOCUMENTS).
+
+        Returns:
+            The speculated node ids
+        """
+        if len(input_documents(state)) > SPECULATION_MAX_DOCUMENTS:
+            return []
+        started = []
+        for node_id in child_ids[:SPECULATION_MAX_CHILDREN]:
+            self.discard([node_id])
+            node = app.builder.nodes[node_id].runnable
+            speculation = Speculation(node_id, parent_id, node, state)
+            if self.foreground_executions > 0:
+                speculation.paused = True
+            else:
+                speculation.task = asyncio.create_task(self.run(speculation))
+            self[node_id] = speculation
+            started.append(node_id)
+        return started
+
+    async def run(self, speculation: Speculation):
+        # its own trace, not a part of the execution that started it
+        current_span.set(None)
+
+        async def speculate():
+            # low priority: waits for the speculative runs of all sessions before it
+            async with speculation_slots():
+                speculation.started = True
+                return await speculation.node.ainvoke(speculation.input_state)
+
+        try:
+            speculation.state = await task_registry.run(
+                self.session_id, "speculate", speculate()
+            )
+        except (TaskCancelled, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            speculation.error = repr(e)
+
+    async def adopt(self, node_id: str) -> bool:
+        """
+        Waits for the node's speculative run, if there is one, before the node is
+        executed. Returns whether it produced a result, now in the node cache.
+        """
+        speculation = self.pop(node_id, None)
+        if speculation is None or speculation.task is None:
+            return False
+        if not speculation.started:
+            # still waiting for a slot, the execution does not wait for it
+            speculation.task.cancel()
+            return False
+        # a cancelled execute leaves the speculative run going
+        await asyncio.shield(speculation.task)
+        return speculation.state is not None
+
+    def discard(self, node_ids: list[str] = None):
+        """Cancels and forgets the speculative runs of the nodes (default: all)"""
+        node_ids = list(self) if node_ids is None else node_ids
+        for node_id in node_ids:
+            speculation = self.pop(node_id, None)
+            if speculation is not None and speculation.task is not None:
+                speculation.task.cancel()
+
+    def discard_children(self, parent_id: str):
+        """Discards the runs made on an output of the parent, i.e. before it ran again"""
+        self.discard(
+            [
+                node_id
+                for node_id, speculation in self.items()
+                if speculation.parent_id == parent_id
+            ]
+        )
+
+    @asynccontextmanager
+    async def foreground(self):
+        """
+        Pauses the session's speculative runs while the block (a user-triggered
+        execution) runs, so they do not compete with it for the LLM clients and the
+        tool pool. A paused run is cancelled and started again afterwards: the
+        documents it had finished are in the document memo, so it picks up where it
+        stopped.
+        """
+        self.foreground_executions += 1
+        for speculation in self.values():
+            if speculation.task is not None and not speculation.done():
+                speculation.task.cancel()
+                speculation.task = None
+                speculation.started = False
+                speculation.paused = True
+        try:
+            yield
+        finally:
+            self.foreground_executions -= 1
+            if self.foreground_executions == 0:
+                for speculation in self.values():
+                    if speculation.paused:
+                        speculation.paused = False
+                        speculation.task = asyncio.create_task(self.run(speculation))
+
+    def info(self) -> list[dict]:
+        return [speculation.info() for speculation in self.values()]
+
+
+_slots: asyncio.Semaphore = None
+
+
+def speculation_slots() -> asyncio.Semaphore:
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(max(1, SPECULATION_WORKERS))
+    return _slots
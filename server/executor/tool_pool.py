@@ -0,0 +1,414 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from server.custom_types import DocumentRecords, MatrixColumn
+
+# processes running the CPU-bound tools (see BARRIER_TOOLS), 0 runs them in a thread instead
+TOOL_WORKERS = int(os.environ.get("VIDEE_TOOL_WORKERS", min(4, os.cpu_count() or 1)))
+# tools running LLM-generated code, in their own resource-limited workers (LimitedPool).
+# The limits only bound CPU time, wall-clock time and memory: the workers can still read
+# and write files and use the network like the server, this is not a sandbox.
+LIMITED_TOOLS = ("data_transform_tool",)
+LIMITED_WORKERS = int(os.environ.get("VIDEE_LIMITED_WORKERS", TOOL_WORKERS))
+# CPU seconds of one limited call, and wall-clock seconds before its worker is killed
+LIMITED_CPU_SECONDS = int(os.environ.get("VIDEE_LIMITED_CPU_SECONDS", 60))
+LIMITED_TIMEOUT_SECONDS = int(os.environ.get("VIDEE_LIMITED_TIMEOUT_SECONDS", 120))
+# address space of a limited worker
+LIMITED_MAX_MEMORY = int(
+    os.environ.get("VIDEE_LIMITED_MAX_MEMORY", 4 * 1024 * 1024 * 1024)
+)
+# nodes whose last tool call metrics are kept, see tool_metrics
+TOOL_METRICS_SIZE = 1024
+# the pools are started from the server's threads, forking them could copy a held lock,
+# the workers are forked from a clean single-threaded server process instead
+MP_CONTEXT = multiprocessing.get_context("forkserver")
+
+_pool = None
+_limited_pool = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=TOOL_WORKERS, mp_context=MP_CONTEXT, initializer=warm_worker
+        )
+    return _pool
+
+
+class WorkerCrashed(Exception):
+    """The limited worker of a call died, i.e. it ran out of memory"""
+
+
+class LimitedWorker:
+    """A resource-limited process running the limited calls sent to it, one at a time"""
+
+    def __init__(self):
+        self.conn, worker_conn = MP_CONTEXT.Pipe()
+        self.process = MP_CONTEXT.Process(
+            target=limited_loop, args=(worker_conn,), daemon=True
+        )
+        self.process.start()
+        worker_conn.close()
+
+    async def call(self, tool: str, payload: dict, kwargs: dict, cpu_limit: float):
+        """The result of run_tool in the worker, its exception is raised here"""
+        self.conn.send((tool, payload, kwargs, cpu_limit))
+        try:
+            status, value = await asyncio.to_thread(self.conn.recv)
+        except (EOFError, OSError):
+            raise WorkerCrashed(self.process.pid)
+        if status == "error":
+            raise value
+        return value
+
+    def kill(self):
+        # the thread waiting for the reply gets EOFError, the pipe is closed with it
+        self.process.kill()
+        self.process.join(1)
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class LimitedPool:
+    """
+    The workers of the LIMITED_TOOLS. Unlike a ProcessPoolExecutor, whose workers are
+    all lost when one dies, a call that times out, crashes its worker or is cancelled
+    only kills its own worker, the calls of other sessions keep theirs. Idle workers
+    are reused, so they keep the transforms they compiled (see compile_transform).
+    """
+
+    def __init__(self, workers: int = LIMITED_WORKERS):
+        self.slots = asyncio.Semaphore(max(1, workers))
+        self.idle = []
+        self.busy = set()
+
+    async def run(
+        self, tool: str, payload: dict, kwargs: dict, cpu_limit: float, timeout: float
+    ) -> tuple[bytes, dict]:
+        """
+        Runs the call in an idle worker, or a new one.
+
+        Raises:
+            asyncio.TimeoutError: The call took more than timeout seconds
+            WorkerCrashed: The worker died during the call
+        """
+        async with self.slots:
+            worker = self.idle.pop() if self.idle else LimitedWorker()
+            self.busy.add(worker)
+            healthy = False
+            try:
+                result = await asyncio.wait_for(
+                    worker.call(tool, payload, kwargs, cpu_limit), timeout
+                )
+                healthy = True
+                return result
+            except (asyncio.TimeoutError, WorkerCrashed, asyncio.CancelledError):
+                raise
+            except Exception:
+                # the tool raised, its worker is fine
+                healthy = True
+                raise
+            finally:
+                self.busy.discard(worker)
+                if healthy:
+                    self.idle.append(worker)
+                else:
+                    # a call past its timeout never returns, killing its worker is the
+                    # only way to stop it
+                    worker.kill()
+
+    def shutdown(self):
+        for worker in self.idle:
+            worker.close()
+        for worker in self.busy:
+            worker.kill()
+        self.idle = []
+        self.busy = set()
+
+
+def get_limited_pool() -> LimitedPool:
+    global _limited_pool
+    if _limited_pool is None:
+        _limited_pool = LimitedPool(LIMITED_WORKERS)
+    return _limited_pool
+
+
+def shutdown_pool():
+    global _pool, _limited_pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+    if _limited_pool is not None:
+        _limited_pool.shutdown()
+        _limited_pool = None
+
+
+def warm_worker():
+    # import the tool modules (sklearn, umap, hdbscan, bertopic) once per worker,
+    # the models they load are then cached for the worker's lifetime
+    import server.executor.tools.clustering_tool
+    import server.executor.tools.data_transform_tool
+    import server.executor.tools.dim_reduction_tool
+
+
+def limit_worker():
+    # the whole worker is limited, so a transform cannot take the memory of the server
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = LIMITED_MAX_MEMORY
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    # past the CPU time limit of a call (see limit_cpu), the transform raises TimeoutError
+    signal.signal(signal.SIGXCPU, cpu_limit_exceeded)
+    import server.executor.tools.data_transform_tool
+
+
+def limited_loop(conn):
+    # the loop of a LimitedWorker, until it is closed or killed
+    limit_worker()
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            return
+        if call is None:
+            return
+        tool, payload, kwargs, cpu_limit = call
+        try:
+            reply = ("ok", run_tool(tool, payload, kwargs, cpu_limit))
+        except BaseException as e:
+            reply = ("error", e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # the exception could not be pickled
+            conn.send(("error", RuntimeError(repr(reply[1]))))
+
+
+def cpu_limit_exceeded(signum, frame):
+    raise TimeoutError(f"CPU time limit of {LIMITED_CPU_SECONDS}s exceeded")
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def limit_cpu(seconds: float = None):
+    """Limits the CPU time of the worker to `seconds` from now, None lifts the limit"""
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if seconds is None:
+        soft = hard
+    else:
+        soft = int(cpu_seconds() + seconds) + 1
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def get_tool(tool: str):
+    from server.executor.tools.clustering_tool import clustering_tool
+    from server.executor.tools.data_transform_tool import data_transform_tool
+    from server.executor.tools.dim_reduction_tool import dim_reduction_tool
+
+    return {
+        "clustering_tool": clustering_tool,
+        "data_transform_tool": data_transform_tool,
+        "dim_reduction_tool": dim_reduction_tool,
+    }[tool]
+
+
+def share_inputs(inputs: list) -> tuple[dict, list]:
+    """
+    Prepares the tool inputs for a worker process. The matrix columns of the inputs are not
+    pickled: memory-mapped matrices are passed by file name, the others are copied once
+    into shared memory that the worker maps without copying.
+
+    Returns:
+        The payload for load_inputs and the shared memory blocks to release after the call
+    """
+    matrices = getattr(inputs, "matrices", {})
+    shared = {}
+    blocks = []
+    for key, column in matrices.items():
+        matrix = column.matrix
+        if isinstance(matrix, np.memmap) and matrix.filename:
+            shared[key] = {"file": matrix.filename, "rows": column.rows}
+            continue
+        block = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+        blocks.append(block)
+        np.ndarray(matrix.shape, dtype=np.float32, buffer=block.buf)[...] = matrix
+        shared[key] = {"shm": block.name, "shape": matrix.shape, "rows": column.rows}
+    records = list(inputs)
+    if matrices:
+        # the vectors of the records are rows of the matrices, the tools read the matrices
+        records = [
+            {k: v for k, v in record.items() if k not in matrices}
+            if isinstance(record, dict)
+            else record
+            for record in records
+        ]
+    return {"records": records, "matrices": shared}, blocks
+
+
+def load_inputs(payload: dict) -> tuple[list, list]:
+    """The tool inputs in the worker, and the shared memory blocks to close after the call"""
+    matrices = {}
+    blocks = []
+    for key, spec in payload["matrices"].items():
+        if "file" in spec:
+            matrix = np.load(spec["file"], mmap_mode="r")
+        else:
+            block = shared_memory.SharedMemory(name=spec["shm"])
+            try:
+                # the parent owns the block, the worker must not unlink it on exit
+                resource_tracker.unregister(block._name, "shared_memory")
+            except Exception:
+                pass
+            blocks.append(block)
+            matrix = np.ndarray(spec["shape"], dtype=np.float32, buffer=block.buf)
+        matrices[key] = MatrixColumn(matrix=matrix, rows=spec["rows"])
+    if not matrices:
+        return payload["records"], blocks
+    return DocumentRecords(payload["records"], matrices=matrices), blocks
+
+
+def run_tool(
+    tool: str, payload: dict, kwargs: dict, cpu_limit: float = None
+) -> tuple[bytes, dict]:
+    """
+    Runs the tool in a worker, the result is pickled before the shared memory is closed.
+
+    Returns:
+        The pickled result and the worker's metrics of the call
+    """
+    start = cpu_seconds()
+    inputs, blocks = load_inputs(payload)
+    try:
+        if cpu_limit is not None:
+            limit_cpu(cpu_limit)
+        output = get_tool(tool)(inputs, **kwargs)
+    finally:
+        if cpu_limit is not None:
+            limit_cpu(None)
+    result = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+    metrics = {
+        "cpu_seconds": cpu_seconds() - start,
+        # kilobytes on linux
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "pid": os.getpid(),
+    }
+    del inputs, output
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # a view is still alive, the mapping goes away with it
+            pass
+    return result, metrics
+
+
+class ToolMetrics:
+    """Metrics of the last tool call of each node, least recently updated go first"""
+
+    def __init__(self, max_nodes: int = TOOL_METRICS_SIZE):
+        self.max_nodes = max_nodes
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, node_id: str, metrics: dict):
+        with self.lock:
+            self.nodes[node_id] = metrics
+            self.nodes.move_to_end(node_id)
+            while len(self.nodes) > self.max_nodes:
+                self.nodes.popitem(last=False)
+
+    def get(self, node_id: str) -> dict:
+        with self.lock:
+            return self.nodes.get(node_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.nodes)
+
+
+# shared by all sessions
+tool_metrics = ToolMetrics()
+
+
+async def run_tool_in_pool(tool: str, inputs: list, node_id: str = None, **kwargs):
+    """
+    Runs a CPU-bound tool off the event loop, in the tool pool. The LIMITED_TOOLS run in
+    the limited pool instead, limited to LIMITED_CPU_SECONDS of CPU time,
+    LIMITED_TIMEOUT_SECONDS of wall-clock time and LIMITED_MAX_MEMORY of memory.
+    A limited call past its limits returns [{"error": ...}] like a failed transform.
+
+    Args:
+        tool: The tool name, see get_tool
+        inputs: The tool inputs, as from get_input_func
+        node_id: The node running the tool, its metrics are kept in tool_metrics
+        **kwargs: The tool parameters
+
+    Returns:
+        The tool output
+    """
+    start = time.perf_counter()
+    metrics = {"tool": tool, "documents": len(inputs)}
+    if TOOL_WORKERS <= 0:
+        output = await asyncio.to_thread(get_tool(tool), inputs, **kwargs)
+        metrics["seconds"] = time.perf_counter() - start
+        if node_id is not None:
+            tool_metrics.record(node_id, metrics)
+        return output
+    limited = tool in LIMITED_TOOLS
+    payload, blocks = share_inputs(inputs)
+    try:
+        loop = asyncio.get_running_loop()
+        if limited:
+            result, worker_metrics = await get_limited_pool().run(
+                tool, payload, kwargs, LIMITED_CPU_SECONDS, LIMITED_TIMEOUT_SECONDS
+            )
+        else:
+            result, worker_metrics = await loop.run_in_executor(
+                get_pool(), run_tool, tool, payload, kwargs
+            )
+        output = pickle.loads(result)
+        metrics.update(worker_metrics, output_bytes=len(result))
+    except (asyncio.TimeoutError, WorkerCrashed) as e:
+        if not limited:
+            raise
+        # only the worker of this call was killed, see LimitedPool
+        if isinstance(e, asyncio.TimeoutError):
+            error = f"Time limit of {LIMITED_TIMEOUT_SECONDS}s exceeded"
+        else:
+            error = "The transform worker crashed, it may have run out of memory"
+        output = [{"error": error}]
+        metrics["error"] = error
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    metrics["seconds"] = time.perf_counter() - start
+    if node_id is not None:
+        tool_metrics.record(node_id, metrics)
+    return output
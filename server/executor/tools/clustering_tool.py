@@ -7,6 +7,7 @@ from sklearn.metrics import silhouette_score
 import hdbscan
 from bertopic import BERTopic
 from umap import UMAP
+from .vectors import feature_matrix, load_sentence_transformer
 
 
 class ClusteringModel:
@@ -308,7 +309,6 @@ def clustering_tool(
         return result
     try:
         # Prepare for processing
-        all_elements = []  # Will hold all elements to cluster
         doc_indices = []  # Will track which document each element came from
         embedding_indices = (
             []
@@ -316,99 +316,49 @@ def clustering_tool(
         is_text_data = False  # Flag to determine if we're processing text data
         original_texts = []  # Will hold original text data if processing strings
 
-        # Process each document
-        for doc_idx, doc in enumerate(inputs):
-            if feature_key not in doc:
-                continue
-
-            content = doc[feature_key]
-
-            if isinstance(content, list) and content:
-                # Case 1: If content is an array of numeric arrays (embeddings)
-                if all(isinstance(item, float) for item in content):
-                    # for emb_idx, embedding in enumerate(content):
-                    #     if not embedding:
-                    #         continue
-                    # all_elements.append(embedding)
-                    all_elements.append(content)
-                    doc_indices.append(doc_idx)
-                    embedding_indices.append(0)
+        # Case 1: If content is numeric vectors (embeddings), use them as one float32 matrix
+        column = feature_matrix(inputs, feature_key)
+        if column is not None:
+            data_array = column.matrix
+            doc_indices, embedding_indices = column.positions()
+        else:
+            # Process each document's text
+            for doc_idx, doc in enumerate(inputs):
+                if feature_key not in doc:
+                    continue
+
+                content = doc[feature_key]
+                # Case 4: If content is a dict with a single key, use its value
+                if isinstance(content, dict) and len(content) == 1:
+                    content = list(content.values())[0]
+
                 # Case 2: If content is an array of strings
-                elif all(isinstance(item, str) for item in content if item):
-                    is_text_data = True
-                    algorithm = "bertopic"  # Force BERTopic for text data
-                    for str_idx, text_item in enumerate(content):
-                        if not text_item:
-                            continue
-                        original_texts.append(text_item)
-                        doc_indices.append(doc_idx)
-                        embedding_indices.append(str_idx)
-
-            # Case 3: If content is a single string
-            elif isinstance(content, str) and content:
-                is_text_data = True
-                algorithm = "bertopic"  # Force BERTopic for text data
-                original_texts.append(content)
-                doc_indices.append(doc_idx)
-                embedding_indices.append(0)  # Single item at position 0
-
-            # Case 4: If content is a dict with a single key containing a list
-            elif isinstance(content, dict) and len(content) == 1:
-                single_value = list(content.values())[0]
-                if isinstance(single_value, list):
-                    if all(
-                        isinstance(item, list)
-                        and all(isinstance(x, (int, float)) for x in item)
-                        for item in single_value
-                        if item
-                    ):
-                        # Numeric embeddings in dict
-                        for emb_idx, embedding in enumerate(single_value):
-                            if not embedding:
-                                continue
-                            all_elements.append(embedding)
-                            doc_indices.append(doc_idx)
-                            embedding_indices.append(emb_idx)
-                    elif all(isinstance(item, str) for item in single_value if item):
-                        # String items in dict
-                        is_text_data = True
-                        algorithm = "bertopic"
-                        for str_idx, text_item in enumerate(single_value):
+                if isinstance(content, list) and content:
+                    if all(isinstance(item, str) for item in content if item):
+                        for str_idx, text_item in enumerate(content):
                             if not text_item:
                                 continue
                             original_texts.append(text_item)
                             doc_indices.append(doc_idx)
                             embedding_indices.append(str_idx)
-                else:
-                    # Single non-list value in dict
-                    if isinstance(single_value, str) and single_value:
-                        is_text_data = True
-                        algorithm = "bertopic"
-                        original_texts.append(single_value)
-                        doc_indices.append(doc_idx)
-                        embedding_indices.append(0)
-
-        # Convert text data to embeddings if necessary
-        if is_text_data:
+
+                # Case 3: If content is a single string
+                elif isinstance(content, str) and content:
+                    original_texts.append(content)
+                    doc_indices.append(doc_idx)
+                    embedding_indices.append(0)  # Single item at position 0
+
             if not original_texts:
-                logging.warning(f"No valid text data found with key: {feature_key}")
+                logging.warning(f"No valid data found with key: {feature_key}")
                 return result
 
-            # Generate embeddings for text data
-            from sentence_transformers import SentenceTransformer
-
-            embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-            all_elements = [embedding_model.encode(text) for text in original_texts]
+            # Convert text data to embeddings
+            is_text_data = True
+            algorithm = "bertopic"  # Force BERTopic for text data
+            embedding_model = load_sentence_transformer("all-MiniLM-L6-v2")
+            data_array = embedding_model.encode(original_texts)
             kwargs["original_docs"] = original_texts
 
-        # If no valid data found at all, return empty result
-        if not all_elements:
-            logging.warning(f"No valid data found with key: {feature_key}")
-            return result
-
-        # Convert to numpy array for processing
-        data_array = np.array(all_elements)
-
         # Check if algorithm exists, fallback to appropriate default
         if algorithm not in _CLUSTERING_MODELS:
             if is_text_data:
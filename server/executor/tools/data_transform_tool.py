@@ -2,6 +2,7 @@ import json
 import logging
 import re
 from collections import defaultdict
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Callable
 
 """
@@ -25,6 +26,30 @@ class DataTransformer:
         return self.transform(data, feature_key, **kwargs)
 
 
+# Transforms compiled per process, keyed by their code (the same code is compiled once)
+TRANSFORM_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def compile_transform(transform_code: str) -> Callable:
+    """Compiles the transform code string once and returns its transform function"""
+    try:
+        # Compile and execute the reduce function
+        compiled_code = compile(transform_code, '<string>', 'exec')
+        namespace = {}
+        exec(compiled_code, namespace)
+
+        # Check if the transform function was defined
+        if 'transform' not in namespace or not callable(namespace['transform']):
+            raise ValueError("The provided code must define a function called 'transform'")
+
+        return namespace['transform']
+    except Exception as e:
+        logging.error(f"Error creating transform function from code: {e}")
+        # Return a function that just returns the data if there's an error
+        return lambda data: data
+
+
 # Transform operation with python executor
 class PythonExecutorTransformer(DataTransformer):
     """
@@ -46,21 +71,7 @@ class PythonExecutorTransformer(DataTransformer):
     """
     def _create_transform_function(self, transform_code: str) -> Callable:
         """Converts the transform code string to a callable function"""
-        try:
-            # Compile and execute the reduce function
-            compiled_code = compile(transform_code, '<string>', 'exec')
-            namespace = {}
-            exec(compiled_code, namespace)
-
-            # Check if the transform function was defined
-            if 'transform' not in namespace or not callable(namespace['transform']):
-                raise ValueError("The provided code must define a function called 'transform'")
-
-            return namespace['transform']
-        except Exception as e:
-            logging.error(f"Error creating transform function from code: {e}")
-            # Return a function that just returns the data if there's an error
-            return lambda data: data
+        return compile_transform(transform_code)
 
     def transform(self, data: List[Dict[str, Any]],
                  transform_code: str = None,
@@ -6,6 +6,8 @@ from sklearn.manifold import TSNE
 import io
 import base64
 import umap
+from server.custom_types import MatrixColumn
+from .vectors import feature_matrix
 
 class DimensionalityReductionModel:
     """Base class for dimensionality reduction models"""
@@ -63,7 +65,7 @@ def dim_reduction_tool(inputs: List[Dict[str, Any]],
                        feature_key: str = "embeddings",
                        algorithm: str = "pca",
                        n_components: int = 50,
-                       **kwargs) -> List[List[List[float]]]:
+                       **kwargs) -> List[Union[np.ndarray, List]]:
     """
     Reduces dimensionality of feature vectors in the input documents.
 
@@ -75,7 +77,7 @@ def dim_reduction_tool(inputs: List[Dict[str, Any]],
         **kwargs: Additional parameters to pass to the dimensionality reduction algorithm
 
     Returns:
-        List of lists containing reduced embeddings for each document
+        List containing the reduced float32 embeddings of each document, an empty list for documents without embeddings
     """
     '''
     input format
@@ -94,38 +96,14 @@ def dim_reduction_tool(inputs: List[Dict[str, Any]],
         # Initialize result structure matching input structure
         result = [[] for _ in range(len(inputs))]
 
-        # Prepare for processing
-        all_embeddings = []  # Will hold all embeddings from all documents
-        doc_indices = []     # Will track which document each embedding came from
-        embedding_indices = []  # Will track the position of each embedding within its document
-
-        # Extract all embeddings while tracking their origins
-        for doc_idx, doc in enumerate(inputs):
-            embeddings_list = doc.get(feature_key, [])
-            
-            # Skip if the document has no embeddings or feature_key doesn't exist
-            if not embeddings_list or not isinstance(embeddings_list, list):
-                continue
-                
-            # Process each embedding in the document
-            for emb_idx, embedding in enumerate(embeddings_list):
-                # Skip invalid embeddings (non-lists or empty lists)
-                if not isinstance(embedding, list) or not embedding:
-                    continue
-                    
-                # Store valid embedding and its indices
-                all_embeddings.append(embedding)
-                doc_indices.append(doc_idx)
-                embedding_indices.append(emb_idx)
+        # Get all embeddings of all documents as one float32 matrix, documents reference them by row
+        column = feature_matrix(inputs, feature_key)
 
         # If no valid embeddings found, return the empty result structure
-        if not all_embeddings:
+        if column is None:
             logging.warning(f"No valid embeddings found with key: {feature_key}")
             return result
 
-        # Convert to numpy array for processing
-        data_array = np.array(all_embeddings)
-
         # Check if algorithm exists, fallback to PCA if not
         if algorithm not in _REDUCTION_MODELS:
             logging.warning(f"Unknown dimensionality reduction algorithm: {algorithm}, falling back to pca")
@@ -135,22 +113,19 @@ def dim_reduction_tool(inputs: List[Dict[str, Any]],
 
         try:
             # Apply dimensionality reduction
-            reduced_data = model.fit_transform(data_array)
+            reduced_data = model.fit_transform(column.matrix).astype(
+                np.float32, copy=False
+            )
         except Exception as e:
             logging.error(f"Error in dimensionality reduction: {e}")
             return result
 
-        # Put reduced embeddings back in their original document structure
-        for i, reduced_vec in enumerate(reduced_data):
-            doc_idx = doc_indices[i]
-            emb_idx = embedding_indices[i]
-            
-            # Extend result list for this document if needed
-            while len(result[doc_idx]) <= emb_idx:
-                result[doc_idx].append([])
-                
-            # Insert the reduced vector
-            result[doc_idx][emb_idx] = reduced_vec.tolist()
+        # Put reduced embeddings back in their original document structure:
+        # the reduced vector of a single embedding, the reduced matrix of a list of embeddings
+        reduced_column = MatrixColumn(reduced_data, column.rows)
+        for doc_idx, reduced in enumerate(reduced_column):
+            if reduced is not None:
+                result[doc_idx] = reduced
 
         return result
     except Exception as e:
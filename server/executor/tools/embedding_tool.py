@@ -3,16 +3,19 @@ import numpy as np
 from typing import List, Dict, Union, Any, Optional
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
+from .vectors import load_sentence_transformer
 
 
 class EmbeddingProvider:
-    """Base class for embeddingProviders"""
+    """Base class for embeddingProviders.
+    Embeddings are float32 arrays, a vector for one text and a matrix (one row per text) for a batch.
+    """
 
-    def get_embedding(self, text: str, model: str) -> List[float]:
+    def get_embedding(self, text: str, model: str) -> np.ndarray:
         raise NotImplementedError
 
-    def get_batch_embeddings(self, texts: List[str], model: str) -> List[List[float]]:
-        return [self.get_embedding(text, model) for text in texts]
+    def get_batch_embeddings(self, texts: List[str], model: str) -> np.ndarray:
+        return np.stack([self.get_embedding(text, model) for text in texts])
 
 
 class OpenAIEmbeddingProvider(EmbeddingProvider):
@@ -22,10 +25,10 @@ class OpenAIEmbeddingProvider(EmbeddingProvider):
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10))
     def get_embedding(
         self, text: str, model: str = "text-embedding-ada-002"
-    ) -> List[float]:
+    ) -> np.ndarray:
         try:
             response = self.client.embeddings.create(input=text, model=model)
-            return response.data[0].embedding
+            return np.asarray(response.data[0].embedding, dtype=np.float32)
         except Exception as e:
             logging.error(f"Error generating embedding with OpenAI: {e}")
             # don't raise exception for now
@@ -34,10 +37,12 @@ class OpenAIEmbeddingProvider(EmbeddingProvider):
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10))
     def get_batch_embeddings(
         self, texts: List[str], model: str = "text-embedding-ada-002"
-    ) -> List[List[float]]:
+    ) -> np.ndarray:
         try:
             response = self.client.embeddings.create(input=texts, model=model)
-            return [item.embedding for item in response.data]
+            return np.asarray(
+                [item.embedding for item in response.data], dtype=np.float32
+            )
         except Exception as e:
             logging.error(f"Error generating batch embeddings with OpenAI: {e}")
             # don't raise exception for now
@@ -52,13 +57,12 @@ class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
         Args:
             model_name_or_path: Model name or path to load. If None, using the default model all-MiniLM-L6-v2
         """
-        from sentence_transformers import SentenceTransformer
-
         if model_name_or_path is None:
             model_name_or_path = "all-MiniLM-L6-v2"
-        self.model = SentenceTransformer(model_name_or_path)
+        # the provider is created for every document, the model is loaded once
+        self.model = load_sentence_transformer(model_name_or_path)
 
-    def get_embedding(self, text: str, model: str = None) -> List[float]:
+    def get_embedding(self, text: str, model: str = None) -> np.ndarray:
         """
         Generate embedding for given text.
 
@@ -70,16 +74,15 @@ class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
             embedding
         """
         try:
-            # Generate embedding and convert to list
-            embedding = self.model.encode(text)
-            return embedding.tolist()
+            # Generate embedding, kept as a float32 array
+            return self.model.encode(text).astype(np.float32, copy=False)
         except Exception as e:
             logging.error(f"Error generating embedding with SentenceTransformers: {e}")
             return []
 
     def get_batch_embeddings(
         self, texts: List[str], model: str = None
-    ) -> List[List[float]]:
+    ) -> np.ndarray:
         """
         Generate embeddings for multiple texts in batch.
 
@@ -88,12 +91,11 @@ class SentenceTransformersEmbeddingProvider(EmbeddingProvider):
             model: Same as above function, this param is just for Class compatibility. Model should be provided during initialization.
 
         Returns:
-            A list of embedding vectors for the given list of texts
+            A matrix of embedding vectors, one row per text
         """
         try:
             # Batch encode all texts at once (more efficient)
-            embeddings = self.model.encode(texts)
-            return [embedding.tolist() for embedding in embeddings]
+            return self.model.encode(texts).astype(np.float32, copy=False)
         except Exception as e:
             logging.error(
                 f"Error generating batch embeddings with SentenceTransformers: {e}"
@@ -119,7 +121,7 @@ def embedding_tool(
     model: str = "text-embedding-ada-002",
     feature_key: str = "content",
     provider: str = "openai",
-) -> List[List[float]]:
+) -> Union[np.ndarray, List]:
     """
     Generates embeddings for the given text using the specified embedding provider.
 
@@ -131,7 +133,8 @@ def embedding_tool(
         provider: Name of the embedding provider, see `_PROVIDERS`.
 
     Returns:
-        List[List[float]]: A list of embedding vectors or empty list on error
+        np.ndarray: A float32 embedding vector for a string, a matrix of embedding vectors
+        for a list of strings, or an empty list on error
     """
     try:
         """
@@ -220,7 +223,7 @@ def batch_embedding_tool(
     model: str = "text-embedding-ada-002",
     feature_key: str = "content",
     provider: str = "openai",
-) -> List[List[float]]:
+) -> List[Union[np.ndarray, List]]:
     """
     Generates embeddings for multiple docs in batch.
 
@@ -232,7 +235,7 @@ def batch_embedding_tool(
         provider: Name of the embedding provider
 
     Returns:
-        List[List[float]]: List of embedding vectors
+        List[np.ndarray]: List of float32 embedding vectors, empty lists for skipped docs
     """
     try:
         texts = [doc.get(feature_key, "") for doc in docs]
@@ -0,0 +1,53 @@
+from functools import lru_cache
+from typing import List, Dict, Any, Optional
+
+from server.custom_types import MatrixColumn
+
+
+@lru_cache(maxsize=4)
+def load_sentence_transformer(model_name_or_path: str = "all-MiniLM-L6-v2"):
+    """
+    Loads a SentenceTransformer model once per process, so later calls (and tool pool workers) reuse it warm.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name_or_path)
+
+
+def feature_matrix(
+    inputs: List[Dict[str, Any]], feature_key: str
+) -> Optional[MatrixColumn]:
+    """
+    Gets the vectors under feature_key in the inputs as one float32 matrix.
+
+    When the inputs are selected from a DocumentTable, the matrix column is used as is (no copy).
+    Otherwise the vectors of each document are stacked once. A document value can be
+    a vector, a list of vectors, or a dict with a single key holding either.
+
+    Args:
+        inputs: Input documents in json format
+        feature_key: Key in each input doc containing the vectors
+
+    Returns:
+        The MatrixColumn, or None if the values are not numeric vectors (i.e. text)
+    """
+    column = getattr(inputs, "matrices", {}).get(feature_key)
+    if column is not None:
+        return column
+    values = []
+    for doc in inputs:
+        value = doc.get(feature_key) if isinstance(doc, dict) else None
+        if isinstance(value, dict) and len(value) == 1:
+            value = next(iter(value.values()))
+        if isinstance(value, str) or (
+            isinstance(value, list) and len(value) > 0 and isinstance(value[0], str)
+        ):
+            return None
+        values.append(value)
+    try:
+        column = MatrixColumn.from_values(values)
+    except (ValueError, TypeError):
+        return None
+    if len(column.matrix) == 0:
+        return None
+    return column
@@ -3,10 +3,14 @@ from fastapi import FastAPI, Request
 import json
 import copy
 import os
+import pickle
+import re
 from collections import defaultdict
 from typing import Callable
+from functools import wraps
 from openai import OpenAI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
 
 
@@ -19,6 +23,7 @@ import server.custom_types as custom_types
 import server.decomposer as decomposer
 import server.executor as executor
 import server.evaluator as evaluator
+import server.utils as utils
 
 
 app = FastAPI()
@@ -31,19 +36,323 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# streamed responses, sent line by line as they are produced
+STREAMED_MEDIA_TYPES = ("application/x-ndjson", "text/event-stream")
+
+
+class StreamedResponseEncoding:
+    """
+    Keeps the compression middleware from buffering the streamed responses
+    (STREAMED_MEDIA_TYPES): it leaves alone the responses with a content encoding, so
+    inside it (mark=True) they get "Content-Encoding: identity", removed again outside
+    of it (mark=False).
+    """
+
+    def __init__(self, app, mark: bool):
+        self.app = app
+        self.mark = mark
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_encoded(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if self.mark:
+                    content_type = dict(headers).get(b"content-type", b"")
+                    if content_type.split(b";")[0].decode() in STREAMED_MEDIA_TYPES:
+                        headers.append((b"content-encoding", b"identity"))
+                else:
+                    headers = [
+                        header
+                        for header in headers
+                        if header != (b"content-encoding", b"identity")
+                    ]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_encoded)
+
+
+# large results (documents, execution states) are compressed, brotli if available
+app.add_middleware(StreamedResponseEncoding, mark=True)
+try:
+    from brotli_asgi import BrotliMiddleware
+
+    app.add_middleware(BrotliMiddleware, minimum_size=1000)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(StreamedResponseEncoding, mark=False)
 
 dirname = os.path.dirname(__file__)
 relative_path = lambda filename: os.path.join(dirname, filename)
 api_key = open(relative_path("api_key")).read()
 default_model = "gpt-4o-mini"
-user_sessions = {}
 # dataset_path = relative_path("executor/docs.json")
 dataset_path = relative_path("data/UIST/papers_small.json")
 # dataset_path = relative_path("data/UIST/papers.json")
+# execution checkpoints are persisted per session, so they survive restarts
+checkpoint_dir = relative_path("checkpoints")
+# long-running requests sent with "background": true run as jobs, see background_job
+job_queue = utils.init_job_queue(relative_path("jobs/jobs.sqlite"))
 
 dev = True
 
 
+# idle sessions release their runtime objects (graph, results, ...) after this long
+SESSION_TTL_SECONDS = int(os.environ.get("VIDEE_SESSION_TTL", 3600))
+# memory budget of the sessions cached by a worker, the least recently used go first
+SESSIONS_MAX_BYTES = int(os.environ.get("VIDEE_SESSIONS_MAX_BYTES", 4 * 1024**3))
+SESSION_SWEEP_SECONDS = 60
+# evicted sessions write the results their checkpoints do not have to a snapshot
+SESSION_SNAPSHOTS = os.environ.get("VIDEE_SESSION_SNAPSHOTS", "1") == "1"
+snapshot_dir = relative_path("sessions/snapshots")
+
+
+def session_filename(session_id: str, extension: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(session_id)) + extension
+
+
+def session_checkpointer(session_id: str):
+    filename = session_filename(session_id, ".sqlite")
+    return executor.DeltaSqliteSaver(os.path.join(checkpoint_dir, filename))
+
+
+def session_thread_config(session: utils.Session) -> dict:
+    # a thread per session and compiled plan, a fresh compile starts a new thread
+    plan_version = session.get("plan_version", 0)
+    return {"configurable": {"thread_id": f"{session.session_id}:{plan_version}"}}
+
+
+def session_execution_graph(session: utils.Session):
+    # the graph compiled from the session's last plan, on its checkpoints
+    if "graph_plan" not in session:
+        return {}
+    execution_graph, _ = executor.create_graph(
+        session["graph_plan"], checkpointer=session["checkpointer"]
+    )
+    return execution_graph
+
+
+def snapshot_path(session_id: str) -> str:
+    return os.path.join(snapshot_dir, session_filename(session_id, ".pkl"))
+
+
+def load_snapshot(session: utils.Session, key: str) -> dict:
+    path = snapshot_path(session.session_id)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        return pickle.load(f).get(key, {})
+
+
+class CheckpointedResults(dict):
+    """Execution results of a session by node id. The results this worker did not
+    compute are read from the session's checkpoints when first used, or else from
+    the snapshot written when the session was evicted."""
+
+    def __init__(self, session: utils.Session):
+        super().__init__()
+        self.session = session
+        self.snapshot = None
+
+    def __missing__(self, node_id: str):
+        execution_graph = self.session["execution_graph"]
+        state = None
+        if execution_graph:
+            state = executor.find_last_state(
+                execution_graph,
+                node_id,
+                session_thread_config(self.session),
+            )
+        if state is None:
+            if self.snapshot is None:
+                self.snapshot = load_snapshot(self.session, "execution_results")
+            state = self.snapshot.get(node_id)
+        if state is None:
+            raise KeyError(node_id)
+        self[node_id] = state
+        return state
+
+
+def release_session(session: utils.Session):
+    """Called when a session is evicted, its runtime objects are rebuilt when it is used"""
+    results = session.runtime.get("execution_results", {})
+    previews = session.runtime.get("preview_results", {})
+    if SESSION_SNAPSHOTS and (results or previews):
+        execution_graph = session.runtime.get("execution_graph")
+        thread_config = session_thread_config(session)
+        # i.e. the results of headless pipeline runs
+        not_checkpointed = {
+            node_id: state
+            for node_id, state in dict.items(results)
+            if not execution_graph
+            or executor.find_last_state(execution_graph, node_id, thread_config)
+            is None
+        }
+        os.makedirs(snapshot_dir, exist_ok=True)
+        with open(snapshot_path(session.session_id), "wb") as f:
+            pickle.dump(
+                {"execution_results": not_checkpointed, "preview_results": previews},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    speculative_runs = session.runtime.get("speculative_runs")
+    if speculative_runs is not None:
+        speculative_runs.discard()
+    checkpointer = session.runtime.get("checkpointer")
+    if checkpointer is not None:
+        checkpointer.close()
+
+
+def session_footprint(session: utils.Session) -> dict:
+    """Estimated bytes held by the session in this worker, by node result"""
+    seen = set()
+    results = {
+        node_id: utils.estimate_bytes(state, seen)
+        for node_id, state in dict.items(session.runtime.get("execution_results", {}))
+    }
+    previews = {
+        node_id: utils.estimate_bytes(preview, seen)
+        for node_id, preview in session.runtime.get("preview_results", {}).items()
+    }
+    checkpointer = session.runtime.get("checkpointer")
+    checkpoints = None
+    checkpoint_cache_bytes = 0
+    if checkpointer is not None:
+        checkpoints = checkpointer.stats()
+        # the columns the checkpointer remembers as already stored
+        checkpoint_cache_bytes = utils.estimate_bytes(checkpointer.held_columns(), seen)
+    stored_bytes = len(session.saved or "")
+    return {
+        "session_id": session.session_id,
+        "results": results,
+        "previews": previews,
+        "checkpoint_cache_bytes": checkpoint_cache_bytes,
+        # on disk
+        "checkpoints": checkpoints,
+        "stored_bytes": stored_bytes,
+        "total_bytes": sum(results.values())
+        + sum(previews.values())
+        + checkpoint_cache_bytes
+        + stored_bytes,
+    }
+
+
+def restore_session(data: dict) -> dict:
+    for key in ["result_evaluators", "execution_evaluations"]:
+        data[key] = defaultdict(list, data.get(key, {}))
+    return data
+
+
+# the sessions are shared by the server workers (see VIDEE_WORKERS), each worker keeps
+# the runtime objects of the sessions it serves and builds them from the stored part
+user_sessions = utils.SessionStore(
+    relative_path("sessions/sessions.sqlite"),
+    factories={
+        "checkpointer": lambda session: session_checkpointer(session.session_id),
+        "execution_graph": session_execution_graph,
+        "execution_results": CheckpointedResults,
+        # node id -> the node's last preview on a sample of its documents
+        "preview_results": lambda session: load_snapshot(session, "preview_results"),
+        # node id -> the node's provisional run, started when its parent was executed
+        "speculative_runs": lambda session: executor.SpeculativeRuns(session.session_id),
+    },
+    restore=restore_session,
+    on_evict=release_session,
+)
+
+
+def evict_idle_sessions() -> list[str]:
+    return user_sessions.evict_idle(
+        SESSION_TTL_SECONDS,
+        max_bytes=SESSIONS_MAX_BYTES,
+        footprint=lambda session: session_footprint(session)["total_bytes"],
+        # sessions with running executions, compilations or streams are kept
+        busy=lambda session_id: len(utils.task_registry.running(session_id)) > 0
+        or user_sessions.execution_lock(session_id).locked(),
+    )
+
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        try:
+            evict_idle_sessions()
+        except Exception as e:
+            print(f"Error evicting idle sessions: {e}")
+
+
+@app.middleware("http")
+async def save_sessions(request: Request, call_next):
+    # the sessions changed by the request are saved for the other workers
+    save_used = user_sessions.request_scope()
+    try:
+        return await call_next(request)
+    finally:
+        save_used()
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.session_sweeper = asyncio.create_task(sweep_sessions())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.session_sweeper.cancel()
+    executor.shutdown_pool()
+    await job_queue.stop_workers()
+    job_queue.close()
+    user_sessions.close()
+
+
+def background_job(kind: str):
+    """
+    Lets the endpoint run as a background job: a request with "background": true returns
+    {"job_id"} at once, and the response of the endpoint becomes the job's result
+    (see /jobs/status/, /jobs/result/ and /jobs/subscribe/).
+    """
+
+    def decorator(endpoint):
+        @wraps(endpoint)
+        async def run(request: Request):
+            body = json.loads(await request.body())
+            if not body.get("background", False):
+                return await endpoint(request)
+            async def work():
+                save_used = user_sessions.request_scope()
+                try:
+                    # the request body is cached, the endpoint reads it again
+                    return await endpoint(request)
+                finally:
+                    save_used()
+
+            job_id = job_queue.submit(body.get("session_id"), kind, work)
+            return {"job_id": job_id}
+
+        return run
+
+    return decorator
+
+
+def session_locked(endpoint):
+    """
+    Runs the endpoint holding the lock of the request's session, so the requests changing
+    a session's graph or execution history run one at a time, and those of different
+    sessions concurrently. Put it under background_job, so the job holds the lock.
+    """
+
+    @wraps(endpoint)
+    async def run(request: Request):
+        body = json.loads(await request.body())
+        async with user_sessions.execution_lock(body.get("session_id")):
+            return await endpoint(request)
+
+    return run
+
+
 @app.get("/test/")
 def test():
     return "Hello Task Decomposition"
@@ -58,7 +367,7 @@ async def test_stream():
             yield json.dumps(obj) + "\n"  # Ensure newline separation
             await asyncio.sleep(5)
 
-    return StreamingResponse(iter_response(), media_type="application/json")
+    return StreamingResponse(iter_response(), media_type="application/x-ndjson")
 
 
 @app.post("/session/create/")
@@ -66,13 +375,20 @@ async def create_session(request: Request):
     request = await request.body()
     request = json.loads(request)
     session_id = request["session_id"]
+    if session_id in user_sessions:
+        checkpointer = user_sessions[session_id].runtime.get("checkpointer")
+        if checkpointer is not None:
+            checkpointer.close()
+    if os.path.exists(snapshot_path(session_id)):
+        os.remove(snapshot_path(session_id))
     user_sessions[session_id] = {
+        "checkpointer": session_checkpointer(session_id),
         "goal": "",
         "semantic_tasks": [],
         "primitive_tasks": [],
         "execution_graph": {},
         "execution_state": {},
-        "execution_results": {},
+        "plan_version": 0,
         "eval_definitions": {
             "complexity": evaluator.complexity_definition,
             "coherence": evaluator.coherence_definition,
@@ -91,10 +407,31 @@ async def get_documents(request: Request):
     session_id = request["session_id"]
     assert session_id in user_sessions
     # return json.load(open(relative_path("data/papers.json")))
-    return json.load(open(dataset_path))
+    dataset = utils.load_dataset(dataset_path)
+    fields = request["fields"] if "fields" in request else None
+    if request.get("stream", False):
+        # newline-delimited batches of documents, for corpora too large for one response
+        batch_size = request.get("batch_size", utils.datasets.STREAM_BATCH_SIZE)
+
+        async def iter_response():
+            for batch in dataset.iter_pages(batch_size, fields):
+                yield json.dumps(batch) + "\n"
+                await asyncio.sleep(0)
+
+        return StreamingResponse(iter_response(), media_type="application/x-ndjson")
+    if "offset" in request or "limit" in request or fields is not None:
+        offset = request.get("offset", 0)
+        limit = request.get("limit", None)
+        return {
+            "documents": dataset.page(offset, limit, fields),
+            "total": len(dataset),
+            "fingerprint": dataset.fingerprint,
+        }
+    return dataset.page()
 
 
 @app.post("/documents/dr/")
+@background_job("dr")
 async def get_dr(request: Request):
     request = await request.body()
     request = json.loads(request)
@@ -160,6 +497,16 @@ async def goal_decomposition_MCTS_stepped(request: Request):
     select_strategy_arg = (
         request["select_strategy"] if "select_strategy" in request else None
     )
+    branching_strategy_arg = (
+        request["branching_strategy"] if "branching_strategy" in request else "fixed"
+    )
+    speculate = request["speculate"] if "speculate" in request else False
+    # cheap models expand and pre-screen, the full ensemble only sees the best children
+    oracle = (
+        decomposer.CascadeOracle.from_config()
+        if "cascade" in request and request["cascade"]
+        else None
+    )
     next_selection = (
         custom_types.MCT_Node.model_validate(request["next_expansion"])
         if "next_expansion" in request
@@ -184,6 +531,9 @@ async def goal_decomposition_MCTS_stepped(request: Request):
         eval_definitions,
         eval_few_shot_examples,
         select_strategy_arg,
+        branching_strategy_arg,
+        speculate,
+        oracle,
     ):  # (1)
         async for (
             new_root,
@@ -200,6 +550,9 @@ async def goal_decomposition_MCTS_stepped(request: Request):
             model=default_model,
             api_key=api_key,
             select_strategy_arg=select_strategy_arg,
+            branching_strategy_arg=branching_strategy_arg,
+            speculate=speculate,
+            oracle=oracle,
         ):
             if next_selection is None:
                 break
@@ -229,17 +582,25 @@ async def goal_decomposition_MCTS_stepped(request: Request):
                 pass
 
     try:
+        # cancelled with /tasks/cancel/ or when the client disconnects
         return StreamingResponse(
-            iter_response(
-                root=user_root,
-                node_dict=node_dict,
-                goal=goal,
-                next_selection=next_selection,
-                eval_definitions=eval_definitions,
-                eval_few_shot_examples=eval_few_shot_examples,
-                select_strategy_arg=select_strategy_arg,
+            utils.task_registry.stream(
+                session_id,
+                "mcts",
+                iter_response(
+                    root=user_root,
+                    node_dict=node_dict,
+                    goal=goal,
+                    next_selection=next_selection,
+                    eval_definitions=eval_definitions,
+                    eval_few_shot_examples=eval_few_shot_examples,
+                    select_strategy_arg=select_strategy_arg,
+                    branching_strategy_arg=branching_strategy_arg,
+                    speculate=speculate,
+                    oracle=oracle,
+                ),
             ),
-            media_type="application/json",
+            media_type="application/x-ndjson",
         )
     except Exception as e:
         print(f"Error in iter_response: {e}")
@@ -263,6 +624,11 @@ async def goal_decomposition_MCTS_regenerate(request: Request):
     eval_few_shot_examples = (
         request["eval_few_shot_examples"] if "eval_few_shot_examples" in request else []
     )
+    oracle = (
+        decomposer.CascadeOracle.from_config()
+        if "cascade" in request and request["cascade"]
+        else None
+    )
     if semantic_tasks is None or semantic_tasks == []:
         user_root = decomposer.init_MCTS()
         node_dict = {user_root.MCT_id: user_root}
@@ -281,6 +647,7 @@ async def goal_decomposition_MCTS_regenerate(request: Request):
             api_key=api_key,
             eval_definitions=eval_definitions,
             eval_few_shot_examples=eval_few_shot_examples,
+            oracle=oracle,
         )
     )
     try:
@@ -306,6 +673,57 @@ async def goal_decomposition_MCTS_regenerate(request: Request):
         pass
 
 
+@app.post("/goal_decomposition/beam_search/stepped/")
+async def goal_decomposition_beam_search_stepped(request: Request):
+    request = await request.body()
+    request = json.loads(request)
+    goal = request["goal"]
+    session_id = request["session_id"]
+    assert session_id in user_sessions
+    candidate_steps = (
+        [(beam, score) for beam, score in request["candidate_steps"]]
+        if "candidate_steps" in request
+        else []
+    )
+    k = request["k"] if "k" in request else 2
+    n = request["n"] if "n" in request else 2
+    fused = request["fused"] if "fused" in request else True
+    # per-step deadline in seconds, beams that are late are dropped
+    deadline = request["deadline"] if "deadline" in request else None
+
+    async def iter_response(candidate_steps):  # (1)
+        async for steps in decomposer.stream_goal_beam_search(
+            goal,
+            candidate_steps,
+            default_model,
+            api_key,
+            k=k,
+            n=n,
+            fused=fused,
+            deadline=deadline,
+        ):
+            try:
+                candidate_steps = steps
+                save_json(
+                    candidate_steps,
+                    relative_path("dev_data/test_beam_search_candidate_steps.json"),
+                )
+                yield json.dumps({"candidate_steps": candidate_steps}) + "\n"
+            except Exception as exception:
+                print(f"Error inside iter_response loop: {exception}")
+                pass
+
+    try:
+        return StreamingResponse(
+            utils.task_registry.stream(
+                session_id, "beam_search", iter_response(candidate_steps)
+            ),
+            media_type="application/x-ndjson",
+        )
+    except Exception as e:
+        print(f"Error in iter_response: {e}")
+
+
 @app.post("/semantic_task/update_value/")
 async def update_semantic_tasks(request: Request) -> dict:
     request = await request.body()
@@ -448,6 +866,8 @@ async def get_primitive_list():
 
 
 @app.post("/primitive_task/compile/")
+@background_job("compile")
+@session_locked
 async def compile_primitive_tasks(request: Request) -> dict:
     request = await request.body()
     request = json.loads(request)
@@ -472,14 +892,22 @@ async def compile_primitive_tasks(request: Request) -> dict:
         )
         primitive_task_execution_plan = primitive_task_execution_plan[1:]
     else:
-        primitive_task_execution_plan = await executor.execution_plan(
-            primitive_task_descriptions,
-            compile_target=compile_target,
-            skip_IO=skip_IO,
-            skip_parameters=skip_parameters,
-            model=default_model,
-            api_key=api_key,
-        )
+        try:
+            # the session is only updated once the plan is compiled
+            primitive_task_execution_plan = await utils.task_registry.run(
+                session_id,
+                "compile",
+                executor.execution_plan(
+                    primitive_task_descriptions,
+                    compile_target=compile_target,
+                    skip_IO=skip_IO,
+                    skip_parameters=skip_parameters,
+                    model=default_model,
+                    api_key=api_key,
+                ),
+            )
+        except utils.TaskCancelled:
+            return {"cancelled": True}
     # retain execution history if we are compiling a task target
     should_preserve_history = compile_target is not None
     old_checkpointer = (
@@ -489,19 +917,30 @@ async def compile_primitive_tasks(request: Request) -> dict:
         execution_graph, _ = executor.create_graph(
             primitive_task_execution_plan, checkpointer=old_checkpointer
         )
+        user_sessions[session_id]["graph_plan"] = list(primitive_task_execution_plan)
         execution_state = user_sessions[session_id].get("execution_state", {})
     else:
-        execution_graph, checkpointer = executor.create_graph(
+        # a fresh compile starts a new execution history, on a new thread
+        checkpointer = user_sessions[session_id]["checkpointer"]
+        checkpointer.reset()
+        user_sessions[session_id]["plan_version"] = (
+            user_sessions[session_id].get("plan_version", 0) + 1
+        )
+        execution_graph, _ = executor.create_graph(
             primitive_task_execution_plan,
-            checkpointer=None,
+            checkpointer=checkpointer,
         )
-        user_sessions[session_id]["checkpointer"] = checkpointer
+        user_sessions[session_id]["graph_plan"] = list(primitive_task_execution_plan)
         execution_state = executor.init_user_execution_state(
             execution_graph,
             primitive_task_execution_plan,
         )
 
     user_sessions[session_id]["execution_graph"] = execution_graph
+    # previews ran the previous nodes, their outputs stay in the document memo
+    user_sessions[session_id]["preview_results"] = {}
+    # the speculative runs were made with the previous plan
+    user_sessions[session_id]["speculative_runs"].discard()
 
     if False and should_preserve_history and session_id in user_sessions:
         old_execution_state = user_sessions[session_id]["execution_state"]
@@ -547,6 +986,8 @@ async def compile_primitive_tasks(request: Request) -> dict:
         copy_executed_history(root_nodes[0], compile_target)
 
     user_sessions[session_id]["execution_state"] = execution_state
+    # the compiled plan, for running it headless with /pipeline/run/
+    user_sessions[session_id]["primitive_tasks"] = list(primitive_task_execution_plan)
     primitive_task_execution_plan.insert(0, root_description)
     save_json(
         primitive_task_execution_plan,
@@ -559,6 +1000,7 @@ async def compile_primitive_tasks(request: Request) -> dict:
 
 
 @app.post("/primitive_task/update/")
+@session_locked
 async def update_primitive_tasks(request: Request):
     request = await request.body()
     request = json.loads(request)
@@ -596,6 +1038,7 @@ async def update_primitive_tasks(request: Request):
         primitive_task_execution_plan,
         checkpointer=checkpointer,
     )
+    user_sessions[session_id]["graph_plan"] = list(primitive_task_execution_plan)
     new_primitive_task_execution_plan = []
     for index in range(
         len(primitive_task_execution_plan) + len(not_compiled_node_indices)
@@ -608,6 +1051,13 @@ async def update_primitive_tasks(request: Request):
             )
 
     user_sessions[session_id]["execution_graph"] = execution_graph
+    # previews ran the previous nodes, their outputs stay in the document memo
+    user_sessions[session_id]["preview_results"] = {}
+    # the speculative runs were made with the previous plan
+    user_sessions[session_id]["speculative_runs"].discard()
+    user_sessions[session_id]["primitive_tasks"] = [
+        task for task in new_primitive_task_execution_plan if "execution" in task
+    ]
     new_primitive_task_execution_plan.insert(0, root_task)
     return {
         "primitive_tasks": new_primitive_task_execution_plan,
@@ -615,6 +1065,8 @@ async def update_primitive_tasks(request: Request):
 
 
 @app.post("/primitive_task/execute/")
+@background_job("execute")
+@session_locked
 async def execute_primitive_tasks(request: Request):
     request = await request.body()
     request = json.loads(request)
@@ -626,37 +1078,310 @@ async def execute_primitive_tasks(request: Request):
     parent_version = (
         request["parent_version"] if "parent_version" in request else None
     )  # the parent version that the node is executed from
-    thread_config = {"configurable": {"thread_id": 42}}
-    initial_state = {"documents": json.load(open(dataset_path))}
+    thread_config = session_thread_config(user_sessions[session_id])
+    initial_state = {
+        # shared by all sessions, the nodes never modify its columns in place
+        "documents": utils.load_dataset(dataset_path).table
+    }
 
     last_state = executor.find_last_state(
         execution_graph, parent_node_id, thread_config
     )
     last_state = last_state if last_state is not None else initial_state
-    save_json(last_state, relative_path("dev_data/test_last_state.json"))
-    parallelizable = execute_node["execution"]["tool"] not in [
-        "clustering_tool",
-        "data_transform_tool",
-        "dim_reduction_tool",
-    ]
-    state = await executor.execute_node(
-        execution_graph,
-        thread_config,
-        execute_node["id"],
-        parent_version,
-        state=last_state,
-        parallelize=parallelizable,
+    save_json(
+        executor.to_legacy_state(last_state),
+        relative_path("dev_data/test_last_state.json"),
     )
+    # the CPU-bound tools run in the tool pool, so every node can run asynchronously
+    # without blocking the event loop (see executor.tool_pool)
+    parallelizable = True
+    # preview: {"sample_size", "stratify_key", "seed"}, runs the node on a sample only
+    preview = request["preview"] if "preview" in request else None
+    if preview is not None:
+        if preview is True:
+            preview = {}
+        try:
+            # the session's speculative runs wait for the preview
+            async with user_sessions[session_id]["speculative_runs"].foreground():
+                result = await utils.task_registry.run(
+                    session_id,
+                    "preview",
+                    executor.execute_node(
+                        execution_graph,
+                        thread_config,
+                        execute_node["id"],
+                        state=last_state,
+                        preview=preview,
+                    ),
+                )
+        except utils.TaskCancelled:
+            return {
+                "execution_state": user_sessions[session_id]["execution_state"],
+                "cancelled": True,
+            }
+        # kept apart from the execution results, the node stays as it was
+        user_sessions[session_id]["preview_results"][execute_node["id"]] = result
+        return {
+            "execution_state": user_sessions[session_id]["execution_state"],
+            "preview": {
+                "indices": result["indices"],
+                "total": result["total"],
+                "stratify_key": result["stratify_key"],
+            },
+        }
+    # the documents of the node's preview are reused from the document memo
+    user_sessions[session_id]["preview_results"].pop(execute_node["id"], None)
+    # speculate: run the node's children ahead of time, see executor.SpeculativeRuns
+    speculate = request["speculate"] if "speculate" in request else executor.SPECULATE
+    speculative_runs = user_sessions[session_id]["speculative_runs"]
+    # the node's speculative run puts its output in the node cache, the execution
+    # below gets it from there
+    adopted = await speculative_runs.adopt(execute_node["id"])
+    # the children's runs were made on the node's previous output
+    speculative_runs.discard_children(execute_node["id"])
+    try:
+        # cancelled with /tasks/cancel/, the documents already done stay in the memo
+        # the trace of the execution: node phases and checkpoint writes, see /profile/
+        # the session's other speculative runs pause until the execution is done
+        with utils.profiler.span(
+            "execute", node_id=execute_node["id"], session_id=session_id
+        ):
+            async with speculative_runs.foreground():
+                state = await utils.task_registry.run(
+                    session_id,
+                    "execute",
+                    executor.execute_node(
+                        execution_graph,
+                        thread_config,
+                        execute_node["id"],
+                        parent_version,
+                        state=last_state,
+                        parallelize=parallelizable,
+                    ),
+                )
+    except utils.TaskCancelled:
+        # the node stays as it was, but its finished documents are kept: the memoized
+        # batch (DocumentMemo.wrap) stores each output as soon as it is done, so
+        # executing the node again on the same input looks them up and only runs the
+        # documents still missing. Only per-document tools are memoized, a cancelled
+        # barrier tool (BARRIER_TOOLS) starts over.
+        return {
+            "execution_state": user_sessions[session_id]["execution_state"],
+            "cancelled": True,
+        }
     # update execution state by adding the executed node as "executed" and updating its children "executable" states
     user_sessions[session_id]["execution_state"] = executor.update_execution_state(
         user_sessions[session_id]["execution_state"],
         execute_node["id"],
     )
     user_sessions[session_id]["execution_results"][execute_node["id"]] = state
-    save_json(state, relative_path("dev_data/test_execution_result.json"))
+    with utils.profiler.span(
+        "serialize", node_id=execute_node["id"], session_id=session_id
+    ):
+        save_json(
+            executor.to_legacy_state(state),
+            relative_path("dev_data/test_execution_result.json"),
+        )
+    speculated = []
+    if speculate:
+        execution_state = user_sessions[session_id]["execution_state"]
+        children = [
+            child_id
+            for child_id in execution_state[execute_node["id"]]["childrenIds"]
+            if execution_state[child_id]["executable"]
+            and not execution_state[child_id]["executed"]
+        ]
+        speculated = speculative_runs.start(
+            execution_graph, execute_node["id"], children, state
+        )
     # save_json(current_steps, "test_decomposed_steps_w_children.json")
     return {
         "execution_state": user_sessions[session_id]["execution_state"],
+        "adopted_speculation": adopted,
+        "speculating": speculated,
+    }
+
+
+@app.post("/pipeline/run/")
+@background_job("pipeline")
+@session_locked
+async def run_pipeline_headless(request: Request):
+    """Runs the whole compiled plan without interrupts, independent branches concurrently"""
+    request = await request.body()
+    request = json.loads(request)
+    session_id = request["session_id"]
+    assert session_id in user_sessions
+    steps = (
+        request["primitive_tasks"]
+        if "primitive_tasks" in request
+        else user_sessions[session_id]["primitive_tasks"]
+    )
+    max_concurrency = request["max_concurrency"] if "max_concurrency" in request else None
+    stream = request["stream"] if "stream" in request else True
+    initial_state = {
+        # shared by all sessions, the nodes never modify its columns in place
+        "documents": utils.load_dataset(dataset_path).table
+    }
+    done_nodes = []
+
+    def report_node_done(node_id, state, seconds):
+        # the progress of the pipeline when it runs as a job
+        done_nodes.append(node_id)
+        utils.report_progress(len(done_nodes), len(steps), f"{node_id} done")
+
+    start = time.perf_counter()
+    try:
+        with utils.profiler.span("pipeline", session_id=session_id, nodes=len(steps)):
+            results, timings = await utils.task_registry.run(
+                session_id,
+                "pipeline",
+                executor.run_pipeline(
+                    steps,
+                    initial_state,
+                    max_concurrency=max_concurrency,
+                    on_node_done=report_node_done,
+                    stream=stream,
+                ),
+            )
+    except utils.TaskCancelled:
+        return {"cancelled": True}
+    elapsed = time.perf_counter() - start
+    execution_state = user_sessions[session_id]["execution_state"]
+    for node_id, state in results.items():
+        user_sessions[session_id]["execution_results"][node_id] = state
+        if node_id in execution_state:
+            execution_state = executor.update_execution_state(execution_state, node_id)
+    user_sessions[session_id]["execution_state"] = execution_state
+    return {
+        "execution_state": execution_state,
+        "timings": timings,
+        "elapsed": elapsed,
+        "critical_path": executor.critical_path_seconds(steps, timings),
+    }
+
+
+@app.get("/cache/stats/")
+def get_cache_stats():
+    return {
+        "node_cache": executor.node_cache.stats(),
+        "document_memo": executor.document_memo.stats(),
+    }
+
+
+@app.get("/admin/sessions/")
+def list_session_footprints():
+    """The sessions cached by this worker, largest first, with their memory footprint"""
+    now = time.time()
+    footprints = []
+    for session_id, session in user_sessions.cached().items():
+        footprint = session_footprint(session)
+        footprint["idle_seconds"] = now - user_sessions.last_used.get(session_id, now)
+        footprints.append(footprint)
+    footprints.sort(key=lambda footprint: footprint["total_bytes"], reverse=True)
+    return {
+        "sessions": footprints,
+        "total_bytes": sum(footprint["total_bytes"] for footprint in footprints),
+        "max_bytes": SESSIONS_MAX_BYTES,
+        "ttl_seconds": SESSION_TTL_SECONDS,
+    }
+
+
+@app.post("/admin/sessions/evict/")
+async def evict_sessions(request: Request):
+    """Evicts one session (by session_id), or the idle ones"""
+    request = await request.body()
+    request = json.loads(request) if request else {}
+    if "session_id" in request:
+        user_sessions.evict(request["session_id"])
+        return {"evicted": [request["session_id"]]}
+    return {"evicted": evict_idle_sessions()}
+
+
+@app.post("/jobs/status/")
+async def get_job_status(request: Request):
+    request = await request.body()
+    request = json.loads(request)
+    return job_queue.status(request["job_id"])
+
+
+@app.post("/jobs/result/")
+async def get_job_result(request: Request):
+    """The job's status, with the response of its endpoint once it is done"""
+    request = await request.body()
+    request = json.loads(request)
+    return job_queue.status(request["job_id"], with_result=True)
+
+
+@app.post("/jobs/subscribe/")
+async def subscribe_job(request: Request):
+    """Newline-delimited status updates of the job, the last one with its result"""
+    request = await request.body()
+    request = json.loads(request)
+
+    async def iter_response():
+        async for status in job_queue.subscribe(request["job_id"]):
+            yield json.dumps(status) + "\n"
+
+    return StreamingResponse(iter_response(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs/list/")
+async def list_jobs(request: Request):
+    request = await request.body()
+    request = json.loads(request)
+    return {"jobs": job_queue.jobs(request["session_id"])}
+
+
+@app.post("/jobs/cancel/")
+async def cancel_job(request: Request):
+    request = await request.body()
+    request = json.loads(request)
+    return {"cancelled": job_queue.cancel(request["job_id"])}
+
+
+@app.post("/tasks/list/")
+async def list_tasks(request: Request):
+    request = await request.body()
+    request = json.loads(request)
+    session_id = request["session_id"]
+    return {"tasks": utils.task_registry.running(session_id)}
+
+
+@app.post("/tasks/cancel/")
+async def cancel_tasks(request: Request):
+    """Cancels the session's executions, compilations and streams (all, or by task_id or kind)"""
+    request = await request.body()
+    request = json.loads(request)
+    session_id = request["session_id"]
+    cancelled = utils.task_registry.cancel(
+        session_id, task_id=request.get("task_id"), kind=request.get("kind")
+    )
+    return {"cancelled": cancelled}
+
+
+@app.get("/tools/metrics/")
+def get_tool_metrics():
+    """Timing, CPU, memory and output size of the last pooled tool call of each node"""
+    return executor.tool_metrics.stats()
+
+
+@app.post("/profile/")
+async def get_profile(request: Request):
+    """
+    The recent execution traces, newest first: the time, documents and bytes of each
+    phase (input, tool, reduce, checkpoint, serialize) and the spans themselves.
+    Traces are only recorded with VIDEE_PROFILE=1. Set VIDEE_PROFILE_EXPORT to also
+    write them to a file as OTLP JSON lines.
+    """
+    request = await request.body()
+    request = json.loads(request) if request else {}
+    return {
+        "enabled": utils.profiler.enabled,
+        "executions": utils.profiler.executions(
+            session_id=request.get("session_id"),
+            node_id=request.get("node_id"),
+            limit=request.get("limit", 50),
+        )
     }
 
 
@@ -667,23 +1392,34 @@ async def fetch_primitive_task_result(request: Request):
     session_id = request["session_id"]
     assert session_id in user_sessions
     task_id = request["task_id"]
-    result = user_sessions[session_id]["execution_results"][task_id]
-    # reduce the length of embeddings to avoid IO bottleneck
-    for index, document in enumerate(result["documents"]):
-        if "embeddings" in document:
-            document["embeddings"] = document["embeddings"][:10]
-        if "embedding" in document:
-            document["embedding"] = document["embedding"][:10]
-        result["documents"][index] = document
-    if "global_store" in result:
-        if "embeddings" in result["global_store"]:
-            result["global_store"]["embeddings"] = result["global_store"]["embeddings"][
-                :10
-            ]
-        if "embedding" in result["global_store"]:
-            result["global_store"]["embedding"] = result["global_store"]["embedding"][
-                :10
-            ]
+    if request.get("preview", False):
+        state = user_sessions[session_id]["preview_results"][task_id]["state"]
+    elif request.get("speculative", False):
+        # the provisional result of the node, before the user executes it
+        speculation = user_sessions[session_id]["speculative_runs"][task_id]
+        if speculation.state is None:
+            return {"result": None, "speculation": speculation.info()}
+        state = speculation.state
+    else:
+        state = user_sessions[session_id]["execution_results"][task_id]
+    # a projected page of the stored result, the stored state itself is never modified
+    with utils.profiler.span(
+        "serialize", node_id=task_id, session_id=session_id
+    ) as span:
+        result = executor.result_view(
+            state,
+            fields=request.get("fields"),
+            offset=request.get("offset", 0),
+            limit=request.get("limit"),
+            filters=request.get("filters"),
+            store_keys=request.get("store_keys"),
+            # reduce the length of embeddings to avoid IO bottleneck
+            max_vector_dims=request.get("max_vector_dims", 10),
+            binary_vectors=request.get("binary_vectors", False),
+        )
+        span.set(
+            documents=len(result["documents"]), bytes=utils.estimate_bytes(result)
+        )
 
     # if dev:
     #     result = json.load(open(relative_path("dev_data/test_execution_result.json")))
@@ -696,6 +1432,7 @@ async def fetch_primitive_task_result(request: Request):
 
 
 @app.post("/primitive_task/evaluators/recommend/")
+@background_job("evaluators_recommend")
 async def recommend_evaluators(request: Request):
     request = await request.body()
     request = json.loads(request)
@@ -738,6 +1475,7 @@ async def add_evaluators(request: Request):
 
 
 @app.post("/primitive_task/evaluators/run/")
+@background_job("evaluators_run")
 async def run_evaluators(request: Request):
     request = await request.body()
     request = json.loads(request)
@@ -748,10 +1486,15 @@ async def run_evaluators(request: Request):
     evaluator_exec = await executor.create_evaluator_exec(evaluator_spec)
     task_id = evaluator_spec["task"]
     execution_result = user_sessions[session_id]["execution_results"][task_id]
-    save_json(execution_result, relative_path("dev_data/test_execution_result.json"))
+    save_json(
+        executor.to_legacy_state(execution_result),
+        relative_path("dev_data/test_execution_result.json"),
+    )
 
-    evaluation_result = evaluator_exec.invoke(
-        execution_result, config={"configurable": {"thread_id": session_id}}
+    evaluation_result = executor.to_legacy_state(
+        await evaluator_exec.ainvoke(
+            execution_result, config={"configurable": {"thread_id": session_id}}
+        )
     )
     user_sessions[session_id]["execution_evaluations"][task_id] = {
         "name": evaluator_spec["name"],
@@ -790,6 +1533,7 @@ def dev_convert():
 
 
 @app.post("/primitive_task/compile/dev/")
+@session_locked
 async def compile_primitive_tasks_dev(request: Request) -> dict:
     request = await request.body()
     request = json.loads(request)
@@ -809,14 +1553,21 @@ async def compile_primitive_tasks_dev(request: Request) -> dict:
         filter(lambda x: x["id"] != "-1", primitive_task_descriptions)
     )
     if compile_target:
-        primitive_task_execution_plan = await executor.execution_plan(
-            primitive_task_descriptions,
-            compile_target=compile_target,
-            skip_IO=skip_IO,
-            skip_parameters=skip_parameters,
-            model=default_model,
-            api_key=api_key,
-        )
+        try:
+            primitive_task_execution_plan = await utils.task_registry.run(
+                session_id,
+                "compile",
+                executor.execution_plan(
+                    primitive_task_descriptions,
+                    compile_target=compile_target,
+                    skip_IO=skip_IO,
+                    skip_parameters=skip_parameters,
+                    model=default_model,
+                    api_key=api_key,
+                ),
+            )
+        except utils.TaskCancelled:
+            return {"cancelled": True}
     else:
         primitive_task_execution_plan = json.load(
             open(relative_path("dev_data/user_study_plan_w_traps.json"))
@@ -833,20 +1584,32 @@ async def compile_primitive_tasks_dev(request: Request) -> dict:
         execution_graph, _ = executor.create_graph(
             primitive_task_execution_plan, checkpointer=old_checkpointer
         )
+        user_sessions[session_id]["graph_plan"] = list(primitive_task_execution_plan)
         execution_state = user_sessions[session_id].get("execution_state", {})
     else:
-        execution_graph, checkpointer = executor.create_graph(
+        # a fresh compile starts a new execution history, on a new thread
+        checkpointer = user_sessions[session_id]["checkpointer"]
+        checkpointer.reset()
+        user_sessions[session_id]["plan_version"] = (
+            user_sessions[session_id].get("plan_version", 0) + 1
+        )
+        execution_graph, _ = executor.create_graph(
             primitive_task_execution_plan,
-            checkpointer=None,
+            checkpointer=checkpointer,
         )
-        user_sessions[session_id]["checkpointer"] = checkpointer
+        user_sessions[session_id]["graph_plan"] = list(primitive_task_execution_plan)
         execution_state = executor.init_user_execution_state(
             execution_graph,
             primitive_task_execution_plan,
         )
 
     user_sessions[session_id]["execution_graph"] = execution_graph
+    # previews ran the previous nodes, their outputs stay in the document memo
+    user_sessions[session_id]["preview_results"] = {}
+    # the speculative runs were made with the previous plan
+    user_sessions[session_id]["speculative_runs"].discard()
     user_sessions[session_id]["execution_state"] = execution_state
+    user_sessions[session_id]["primitive_tasks"] = list(primitive_task_execution_plan)
     primitive_task_execution_plan.insert(0, root_description)
     # save_json(
     #     primitive_task_execution_plan,
@@ -883,82 +1646,12 @@ if __name__ == "__main__":
     # app.run(debug=True)
     import uvicorn
 
-    uvicorn.run("server.main:app", host="127.0.0.1", port=8000, reload=True)
-
-# @app.post("/goal_decomposition/beam_search/stepped/")
-# async def goal_decomposition_beam_search_stepped(request: Request):
-#     request = await request.body()
-#     request = json.loads(request)
-#     goal = request["goal"]
-#     session_id = request["session_id"]
-#     assert session_id in user_sessions
-#     user_sessions[session_id]["goal"] = goal
-#     user_steps = request["user_steps"]
-#     print("user_steps", user_steps)
-#     k, n = 2, 2
-#     if False:
-#         decomposed_steps = json.load(
-#             open(relative_path("dev_data/test_decomposed_steps_w_children.json"))
-#         )
-#         user_sessions[session_id]["semantic_tasks"] = decomposed_steps
-#         return decomposed_steps
-#     else:
-
-#         async def iter_response(candidate_steps):  # (1)
-#             if len(candidate_steps) == 0:
-#                 candidate_steps = await decomposer.goal_decode_n_samples(
-#                     goal, [], default_model, api_key, n=n
-#                 )
-#                 yield json.dumps({"semantic_tasks": candidate_steps}) + "\n"
-#             async for steps in decomposer.stream_goal_beam_search(
-#                 goal, candidate_steps, default_model, api_key, k=k, n=n
-#             ):
-#                 candidate_steps = steps
-#                 save_json(
-#                     candidate_steps,
-#                     relative_path("dev_data/test_beam_search_candidate_steps.json"),
-#                 )
-#                 yield json.dumps({"semantic_tasks": candidate_steps}) + "\n"
-
-#         return StreamingResponse(
-#             iter_response(user_steps), media_type="application/json"
-#         )
-
-# @app.post("/goal_decomposition/beam_search/stepped/")
-# async def goal_decomposition_beam_search_stepped(request: Request):
-#     request = await request.body()
-#     request = json.loads(request)
-#     goal = request["goal"]
-#     session_id = request["session_id"]
-#     assert session_id in user_sessions
-#     user_sessions[session_id]["goal"] = goal
-#     user_steps = request["user_steps"]
-#     print("user_steps", user_steps)
-#     k, n = 2, 2
-#     if False:
-#         decomposed_steps = json.load(
-#             open(relative_path("dev_data/test_decomposed_steps_w_children.json"))
-#         )
-#         user_sessions[session_id]["semantic_tasks"] = decomposed_steps
-#         return decomposed_steps
-#     else:
-
-#         async def iter_response(candidate_steps):  # (1)
-#             if len(candidate_steps) == 0:
-#                 candidate_steps = await decomposer.goal_decode_n_samples(
-#                     goal, [], default_model, api_key, n=n
-#                 )
-#                 yield json.dumps({"semantic_tasks": candidate_steps}) + "\n"
-#             async for steps in decomposer.stream_goal_beam_search(
-#                 goal, candidate_steps, default_model, api_key, k=k, n=n
-#             ):
-#                 candidate_steps = steps
-#                 save_json(
-#                     candidate_steps,
-#                     relative_path("dev_data/test_beam_search_candidate_steps.json"),
-#                 )
-#                 yield json.dumps({"semantic_tasks": candidate_steps}) + "\n"
-
-#         return StreamingResponse(
-#             iter_response(user_steps), media_type="application/json"
-#         )
+    # the workers share the sessions (see user_sessions), reload only works with one
+    workers = int(os.environ.get("VIDEE_WORKERS", 1))
+    uvicorn.run(
+        "server.main:app",
+        host="127.0.0.1",
+        port=8000,
+        reload=workers == 1,
+        workers=workers,
+    )
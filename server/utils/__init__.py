@@ -2,7 +2,26 @@ from .formatter import (
     extract_json_content,
     retry_llm_json_extraction
 )
+from .memory import estimate_bytes
+from .datasets import Dataset, load_dataset
+from .tasks import TaskCancelled, cancellation_token, task_registry
+from .jobs import JobQueue, init_job_queue, report_progress
+from .sessions import Session, SessionConflict, SessionStore
+from .profiling import profiler
 __all__ = [
     "extract_json_content",
     "retry_llm_json_extraction",
-]
\ No newline at end of file
+    "estimate_bytes",
+    "Dataset",
+    "load_dataset",
+    "TaskCancelled",
+    "cancellation_token",
+    "task_registry",
+    "JobQueue",
+    "init_job_queue",
+    "report_progress",
+    "Session",
+    "SessionConflict",
+    "SessionStore",
+    "profiler",
+]
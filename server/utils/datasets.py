@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterator
+
+from server.custom_types import DocumentTable
+
+# datasets kept loaded, least recently used go first
+DATASET_CACHE_SIZE = 4
+# documents per batch when streaming a dataset
+STREAM_BATCH_SIZE = 1000
+
+
+def file_fingerprint(path: str, chunk_size: int = 1 << 20) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class Dataset:
+    """A dataset file loaded once and shared by all sessions.
+
+    The documents are kept as a DocumentTable, whose columns are never modified in place,
+    so every session can start its execution from the same table. JSON and JSONL files are
+    parsed once. Parquet files are read column by column: pages only read the requested
+    columns, and the full table is only read when an execution needs it.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.format = dataset_format(path)
+        self._table = None
+        self._lock = threading.Lock()
+        if self.format == "parquet":
+            import pyarrow.parquet as pq
+
+            self._parquet = pq.ParquetFile(path)
+            self.length = self._parquet.metadata.num_rows
+            self.keys = list(self._parquet.schema_arrow.names)
+        else:
+            self.length = len(self.table)
+            self.keys = self.table.keys()
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def table(self) -> DocumentTable:
+        with self._lock:
+            if self._table is None:
+                self._table = self._load_table()
+            return self._table
+
+    def _load_table(self) -> DocumentTable:
+        if self.format == "parquet":
+            columns = self._parquet.read().to_pydict()
+            return DocumentTable(columns=columns, length=self.length)
+        with open(self.path) as f:
+            if self.format == "jsonl":
+                records = [json.loads(line) for line in f if line.strip()]
+            else:
+                records = json.load(f)
+        return DocumentTable.from_records(records)
+
+    def page(
+        self, offset: int = 0, limit: int = None, fields: list[str] = None
+    ) -> list[dict]:
+        """The documents [offset, offset + limit) with only the given fields (default: all)"""
+        stop = self.length if limit is None else min(self.length, offset + limit)
+        if offset >= stop:
+            return []
+        if self.format == "parquet" and self._table is None:
+            return self._read_parquet_rows(offset, stop, fields)
+        page = self.table.take(range(offset, stop))
+        return list(page.select(fields if fields is not None else self.keys))
+
+    def iter_pages(
+        self, batch_size: int = STREAM_BATCH_SIZE, fields: list[str] = None
+    ) -> Iterator[list[dict]]:
+        for offset in range(0, self.length, batch_size):
+            yield self.page(offset, batch_size, fields)
+
+    def _read_parquet_rows(
+        self, start: int, stop: int, fields: list[str]
+    ) -> list[dict]:
+        columns = [key for key in fields if key in self.keys] if fields else None
+        records = []
+        row = 0
+        for group in range(self._parquet.num_row_groups):
+            group_rows = self._parquet.metadata.row_group(group).num_rows
+            if row + group_rows > start and row < stop:
+                table = self._parquet.read_row_group(group, columns=columns)
+                begin = max(start - row, 0)
+                table = table.slice(begin, min(stop - row, group_rows) - begin)
+                records.extend(table.to_pylist())
+            row += group_rows
+            if row >= stop:
+                break
+        return records
+
+
+def dataset_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    return "json"
+
+
+_datasets = OrderedDict()
+_datasets_lock = threading.Lock()
+
+
+def load_dataset(path: str) -> Dataset:
+    """
+    The dataset of a file, loaded once while the file is unchanged.
+
+    Args:
+        path: A .json (list of documents), .jsonl or .parquet file
+
+    Returns:
+        The shared Dataset, fingerprinted by the file content
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _datasets_lock:
+        if key in _datasets:
+            _datasets.move_to_end(key)
+            return _datasets[key]
+    dataset = Dataset(path, file_fingerprint(path))
+    with _datasets_lock:
+        _datasets[key] = dataset
+        # older versions of the same file are not needed anymore
+        for other in [k for k in _datasets if k[0] == path and k != key]:
+            del _datasets[other]
+        while len(_datasets) > DATASET_CACHE_SIZE:
+            _datasets.popitem(last=False)
+    return dataset
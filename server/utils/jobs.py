@@ -0,0 +1,289 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable
+
+from .tasks import TaskCancelled, task_registry
+
+# jobs running at the same time, the others wait in the queue
+JOB_WORKERS = int(os.environ.get("VIDEE_JOB_WORKERS", 2))
+# seconds between the status updates of a subscription
+JOB_POLL_SECONDS = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# the job the current code runs in, see report_progress
+current_job: ContextVar[str] = ContextVar("current_job", default=None)
+
+
+class JobQueue:
+    """Long-running requests (compile, execute, evaluators, ...) run as background jobs.
+
+    A job is queued in a SQLite table and run by one of JOB_WORKERS workers. Its status,
+    progress and JSON result are kept in the table, so they can be polled by the client
+    after the request returned, from any server worker, and are still there after a
+    restart. The jobs left queued or running by a process that is gone cannot be resumed
+    (their work is code, not data) and are marked failed on startup. A running job can
+    only be cancelled by the worker running it.
+    """
+
+    def __init__(self, path: str, workers: int = JOB_WORKERS):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.queue = None
+        self.worker_tasks = []
+        # job id -> work, until a worker takes it
+        self.pending = {}
+        self.setup()
+
+    def setup(self):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    session_id TEXT,
+                    kind TEXT,
+                    status TEXT,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    task_id TEXT,
+                    created REAL,
+                    started REAL,
+                    finished REAL,
+                    worker INTEGER
+                )
+                """
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            if "worker" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, created)"
+            )
+            # the jobs of the other server workers still running are theirs
+            unfinished = self.conn.execute(
+                "SELECT job_id, worker FROM jobs WHERE status IN (?, ?)",
+                (QUEUED, RUNNING),
+            ).fetchall()
+            for job_id, worker in unfinished:
+                if worker is None or not process_alive(worker):
+                    self.conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, finished = ? "
+                        "WHERE job_id = ?",
+                        (FAILED, "Interrupted by a restart", time.time(), job_id),
+                    )
+
+    def update(self, job_id: str, **fields):
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                (*fields.values(), job_id),
+            )
+
+    # ---- workers ----
+
+    def start_workers(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.worker_tasks = [
+            asyncio.create_task(self.work()) for _ in range(max(1, self.workers))
+        ]
+
+    async def stop_workers(self):
+        for worker in self.worker_tasks:
+            worker.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.queue = None
+
+    async def work(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job_id: str):
+        if job_id not in self.pending:
+            # cancelled while queued
+            return
+        session_id, kind, work = self.pending.pop(job_id)
+        self.update(job_id, status=RUNNING, started=time.time())
+        current_job.set(job_id)
+        try:
+            result = await task_registry.run(
+                session_id, kind, work(), on_start=self.on_task
+            )
+        except TaskCancelled:
+            self.update(job_id, status=CANCELLED, finished=time.time())
+        except Exception as e:
+            self.update(job_id, status=FAILED, error=repr(e), finished=time.time())
+        else:
+            self.update(
+                job_id,
+                status=DONE,
+                result=json.dumps(result, default=str),
+                finished=time.time(),
+            )
+
+    def on_task(self, task_id: str):
+        # the tracked task of the running job, to cancel it
+        job_id = current_job.get()
+        if job_id is not None:
+            self.update(job_id, task_id=task_id)
+
+    # ---- jobs ----
+
+    def submit(
+        self, session_id: str, kind: str, work: Callable[[], Awaitable]
+    ) -> str:
+        """
+        Queues a job.
+
+        Args:
+            session_id: The session of the job
+            kind: The kind of job (i.e. "execute"), shown in the status
+            work: Returns the coroutine of the job, whose result is JSON-serializable
+
+        Returns:
+            The job id
+        """
+        self.start_workers()
+        job_id = uuid.uuid4().hex
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, session_id, kind, status, created, worker) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, kind, QUEUED, time.time(), os.getpid()),
+            )
+        self.pending[job_id] = (session_id, kind, work)
+        self.queue.put_nowait(job_id)
+        return job_id
+
+    def status(self, job_id: str, with_result: bool = False) -> dict:
+        """The job's status, progress and timings (and result), None if there is no such job"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT job_id, session_id, kind, status, progress, error, task_id, "
+                "created, started, finished, result FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = [
+            "job_id",
+            "session_id",
+            "kind",
+            "status",
+            "progress",
+            "error",
+            "task_id",
+            "created",
+            "started",
+            "finished",
+        ]
+        status = dict(zip(keys, row))
+        status["progress"] = json.loads(status["progress"] or "null")
+        if status["status"] == QUEUED:
+            queued = list(self.pending)
+            status["position"] = queued.index(job_id) if job_id in queued else None
+        if with_result:
+            status["result"] = json.loads(row[-1]) if row[-1] is not None else None
+        return status
+
+    def jobs(self, session_id: str, limit: int = 50) -> list[dict]:
+        with self.lock:
+            job_ids = [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT job_id FROM jobs WHERE session_id = ? "
+                    "ORDER BY created DESC LIMIT ?",
+                    (session_id, limit),
+                )
+            ]
+        return [self.status(job_id) for job_id in job_ids]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancels a queued or running job, whether it was"""
+        status = self.status(job_id)
+        if status is None or status["status"] in FINISHED:
+            return False
+        if self.pending.pop(job_id, None) is not None:
+            self.update(job_id, status=CANCELLED, finished=time.time())
+            return True
+        if status["task_id"] is None:
+            return False
+        cancelled = task_registry.cancel(
+            status["session_id"], task_id=status["task_id"]
+        )
+        return len(cancelled) > 0
+
+    async def subscribe(self, job_id: str) -> AsyncIterator[dict]:
+        """The job's status each time it changes, until the job is finished (with its result)"""
+        last = None
+        while True:
+            status = self.status(job_id)
+            if status is None:
+                return
+            if status["status"] in FINISHED:
+                yield self.status(job_id, with_result=True)
+                return
+            if status != last:
+                yield status
+                last = status
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def report_progress(done: int, total: int = None, message: str = None):
+    """Reports the progress of the current job, if the code runs in one"""
+    job_id = current_job.get()
+    if job_id is None or job_queue is None:
+        return
+    job_queue.update(
+        job_id,
+        progress=json.dumps({"done": done, "total": total, "message": message}),
+    )
+
+
+# created by the server with its own path, see init_job_queue
+job_queue: JobQueue = None
+
+
+def init_job_queue(path: str, workers: int = JOB_WORKERS) -> JobQueue:
+    global job_queue
+    job_queue = JobQueue(path, workers)
+    return job_queue
@@ -0,0 +1,43 @@
+import sys
+
+import numpy as np
+
+
+def estimate_bytes(value, seen: set = None) -> int:
+    """
+    Estimates the memory held by a value, following lists, dicts and the columns of DocumentTables.
+    Objects shared inside the value are counted once.
+
+    Args:
+        value: The value to measure
+        seen: ids of the objects already counted, to measure several values together
+
+    Returns:
+        The estimated number of bytes
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.memmap):
+        # the data stays on disk
+        return sys.getsizeof(value)
+    if isinstance(value, np.ndarray):
+        if isinstance(value.base, np.ndarray):
+            # a view (i.e. a row of a matrix column) holds the data of its base
+            return sys.getsizeof(value) + estimate_bytes(value.base, seen)
+        return sys.getsizeof(value) + value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_bytes(k, seen) + estimate_bytes(v, seen) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_bytes(v, seen) for v in value)
+    if hasattr(value, "__dataclass_fields__"):
+        # DocumentTable, MatrixColumn
+        return sys.getsizeof(value) + sum(
+            estimate_bytes(getattr(value, name), seen)
+            for name in value.__dataclass_fields__
+        )
+    return sys.getsizeof(value)
@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from .tasks import current_task
+
+# whether spans are recorded at all
+PROFILE = os.environ.get("VIDEE_PROFILE", "0") == "1"
+# finished traces kept for /profile/, oldest go first
+PROFILE_MAX_TRACES = 256
+# traces whose root span is still open, the oldest are dropped past this number, i.e.
+# the traces of stream generators that were abandoned and never closed
+PROFILE_MAX_OPEN_TRACES = 1024
+# when set, finished traces are appended to this file as OTLP JSON lines
+PROFILE_EXPORT_PATH = os.environ.get("VIDEE_PROFILE_EXPORT")
+SERVICE_NAME = "videe-server"
+
+
+class Span:
+    """A timed phase of the server's work, i.e. the input projection of a node.
+
+    Spans started while another one is open are its children and share its trace, so the
+    spans of one node execution (node, input, tool, reduce, checkpoint writes) form a
+    trace. The node and session ids are inherited from the parent span.
+    """
+
+    def __init__(self, name: str, parent: "Span" = None, **attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.node_id = attributes.pop("node_id", None) or (
+            parent.node_id if parent is not None else None
+        )
+        self.session_id = attributes.pop("session_id", None) or (
+            parent.session_id if parent is not None else None
+        )
+        if self.session_id is None:
+            tracked = current_task.get()
+            self.session_id = tracked.session_id if tracked is not None else None
+        # i.e. documents, bytes
+        self.attributes = attributes
+        self.start = time.time()
+        self.seconds = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "node_id": self.node_id,
+            "session_id": self.session_id,
+            "start": self.start,
+            "seconds": self.seconds,
+            **self.attributes,
+        }
+
+
+class _NoSpan:
+    # handed out when profiling is off, so callers can set attributes unconditionally
+    def set(self, **attributes):
+        pass
+
+
+# the span the current code runs in, inherited by the asyncio tasks it creates
+current_span: ContextVar[Span] = ContextVar("current_span", default=None)
+
+
+class Profiler:
+    """The recent traces of the server's work, trace id -> spans"""
+
+    def __init__(
+        self,
+        max_traces: int = PROFILE_MAX_TRACES,
+        max_open_traces: int = PROFILE_MAX_OPEN_TRACES,
+        export_path: str = PROFILE_EXPORT_PATH,
+        enabled: bool = PROFILE,
+    ):
+        self.max_traces = max_traces
+        self.max_open_traces = max_open_traces
+        self.export_path = export_path
+        self.enabled = enabled
+        self.traces = OrderedDict()
+        # trace id -> the finished spans of traces whose root is still open, oldest first
+        self.open_traces = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Times the block as a span, a child of the current span if there is one.
+        Set the span's attributes (i.e. documents, bytes) with span.set().
+        """
+        if not self.enabled:
+            yield _NoSpan()
+            return
+        span = Span(name, current_span.get(), **attributes)
+        if span.parent_id is None:
+            with self.lock:
+                self.open_traces[span.trace_id] = []
+                while len(self.open_traces) > self.max_open_traces:
+                    self.open_traces.popitem(last=False)
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            current_span.reset(token)
+            self.finish(span)
+
+    def finish(self, span: Span):
+        with self.lock:
+            if span.parent_id is not None and span.trace_id in self.open_traces:
+                self.open_traces[span.trace_id].append(span)
+                return
+            if span.parent_id is None:
+                spans = self.open_traces.pop(span.trace_id, []) + [span]
+                self.traces[span.trace_id] = spans
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+            else:
+                # a detached task that outlived its trace, i.e. a background write
+                spans = [span]
+                if span.trace_id in self.traces:
+                    self.traces[span.trace_id].append(span)
+        if self.export_path is not None:
+            self.export(spans)
+
+    def export(self, spans: list[Span]):
+        """Appends the spans to export_path as one OTLP JSON line"""
+        line = json.dumps(to_otlp(spans), default=str)
+        try:
+            directory = os.path.dirname(os.path.abspath(self.export_path))
+            os.makedirs(directory, exist_ok=True)
+            with self.lock, open(self.export_path, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Error exporting the profile: {e}")
+
+    def executions(
+        self, session_id: str = None, node_id: str = None, limit: int = 50
+    ) -> list[dict]:
+        """
+        The most recent traces, newest first, with the time, documents and bytes of
+        each phase summed over the trace's spans.
+
+        Args:
+            session_id: Only the traces of this session
+            node_id: Only the traces with spans of this node
+            limit: The number of traces
+        """
+        with self.lock:
+            traces = list(self.traces.values())
+        executions = []
+        for spans in reversed(traces):
+            root = next((span for span in spans if span.parent_id is None), spans[0])
+            if session_id is not None and root.session_id != session_id:
+                continue
+            if node_id is not None and all(span.node_id != node_id for span in spans):
+                continue
+            executions.append(
+                {
+                    "trace_id": root.trace_id,
+                    "name": root.name,
+                    "node_id": root.node_id,
+                    "session_id": root.session_id,
+                    "start": root.start,
+                    "seconds": root.seconds,
+                    "phases": summarize(spans),
+                    "spans": [span.info() for span in spans],
+                }
+            )
+            if len(executions) >= limit:
+                break
+        return executions
+
+    def clear(self):
+        with self.lock:
+            self.traces.clear()
+            self.open_traces.clear()
+
+
+def summarize(spans: list[Span]) -> dict:
+    """Phase name -> its total seconds and span count, and documents and bytes"""
+    phases = {}
+    for span in spans:
+        phase = phases.setdefault(span.name, {"seconds": 0.0, "count": 0})
+        phase["seconds"] += span.seconds or 0.0
+        phase["count"] += 1
+        for key in ("documents", "bytes"):
+            if key in span.attributes:
+                phase[key] = phase.get(key, 0) + span.attributes[key]
+    return phases
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: list[Span]) -> dict:
+    """The spans in the OTLP/JSON format read by OpenTelemetry collectors"""
+    otlp_spans = []
+    for span in spans:
+        attributes = {
+            "videe.node_id": span.node_id,
+            "videe.session_id": span.session_id,
+            **{f"videe.{key}": value for key, value in span.attributes.items()},
+        }
+        start = int(span.start * 1e9)
+        otlp_spans.append(
+            {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(start + int((span.seconds or 0.0) * 1e9)),
+                "attributes": [
+                    {"key": key, "value": otlp_value(value)}
+                    for key, value in attributes.items()
+                    if value is not None
+                ],
+            }
+        )
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "server.utils.profiling"}, "spans": otlp_spans}
+                ],
+            }
+        ]
+    }
+
+
+# shared by all sessions
+profiler = Profiler()
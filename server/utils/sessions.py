@@ -0,0 +1,433 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from contextvars import ContextVar
+from typing import Any, Callable
+from weakref import WeakValueDictionary
+
+# seconds between the attempts to take a session lock held by another worker
+SESSION_LOCK_POLL_SECONDS = 0.05
+
+# session ids already checked for changes by other workers in the current request
+_checked_sessions: ContextVar[set] = ContextVar("checked_sessions", default=None)
+
+
+class SessionConflict(Exception):
+    """Raised by SessionStore.save when another worker changed the same keys of the
+    session since it was loaded"""
+
+
+class Session(MutableMapping):
+    """The state of one user session.
+
+    The serializable part (plans, execution states, evaluations, ...) is saved in the
+    SessionStore. The runtime objects (compiled graph, checkpointer, execution results)
+    are kept by the worker only and built from the serializable part when first used,
+    by the store's runtime factories, so any worker can serve any session.
+    """
+
+    def __init__(self, session_id: str, data: dict, revision: int, factories: dict):
+        self.session_id = session_id
+        self.data = data
+        self.revision = revision
+        self.factories = factories
+        self.runtime = {}
+        # the data as last saved, to skip saving it again unchanged
+        self.saved = None
+
+    def __getitem__(self, key: str):
+        if key in self.factories:
+            if key not in self.runtime:
+                self.runtime[key] = self.factories[key](self)
+            return self.runtime[key]
+        return self.data[key]
+
+    def __setitem__(self, key: str, value):
+        if key in self.factories:
+            self.runtime[key] = value
+        else:
+            self.data[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self.factories:
+            self.runtime.pop(key, None)
+        else:
+            del self.data[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.data or key in self.factories
+
+    def __iter__(self):
+        yield from self.data
+        yield from self.factories
+
+    def __len__(self) -> int:
+        return len(self.data) + len(self.factories)
+
+
+class SessionLock:
+    """
+    Serializes the requests changing a session's graph or execution history, across the
+    server workers: an asyncio lock for the requests of this worker, and an exclusive
+    fcntl lock on the session's lock file for those of the others. The file lock is
+    released by the system if its worker dies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.file = None
+
+    def locked(self) -> bool:
+        """Whether a request of this worker holds or waits for the lock"""
+        return self.lock.locked()
+
+    async def __aenter__(self) -> "SessionLock":
+        await self.lock.acquire()
+        try:
+            self.file = open(self.path, "a+")
+            while True:
+                try:
+                    fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return self
+                except BlockingIOError:
+                    # held by another worker, waiting without blocking the event loop
+                    await asyncio.sleep(SESSION_LOCK_POLL_SECONDS)
+        except BaseException:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.lock.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+        self.lock.release()
+
+
+class SessionStore(MutableMapping):
+    """Sessions shared by the server workers, session id -> Session.
+
+    The serializable part of each session is a JSON row of a SQLite table with a revision
+    number. Each worker caches the sessions it served, and reloads one when another
+    worker saved a newer revision, dropping its runtime objects to rebuild them. Requests
+    therefore need no sticky routing. Changes are saved with save(), i.e. at the end of
+    each request (see request_scope).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        factories: dict[str, Callable[[Session], Any]] = None,
+        restore: Callable[[dict], dict] = None,
+        on_evict: Callable[[Session], None] = None,
+    ):
+        """
+        Args:
+            path: The SQLite file, shared by the workers
+            factories: Runtime key -> function building its value from the session
+            restore: Restores the loaded data (i.e. defaultdicts) of a session
+            on_evict: Called with a cached session when it is reloaded or deleted,
+                to release its runtime objects
+        """
+        self.path = path
+        self.factories = factories or {}
+        self.restore = restore
+        self.on_evict = on_evict
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.RLock()
+        self.cache = {}
+        # session id -> time of its last use by this worker
+        self.last_used = {}
+        # session id -> execution lock, dropped when no request holds or waits for it
+        self.execution_locks = WeakValueDictionary()
+        self.lock_dir = os.path.join(os.path.dirname(os.path.abspath(path)), "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    revision INTEGER,
+                    data TEXT,
+                    updated REAL
+                )
+                """
+            )
+
+    def _revision(self, session_id: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT revision FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _load(self, session_id: str) -> Session:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT revision, data FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        revision, saved = row
+        data = json.loads(saved)
+        if self.restore is not None:
+            data = self.restore(data)
+        session = Session(session_id, data, revision, self.factories)
+        session.saved = saved
+        return session
+
+    def _evict(self, session_id: str, release: bool = True):
+        session = self.cache.pop(session_id, None)
+        self.last_used.pop(session_id, None)
+        if session is not None and release and self.on_evict is not None:
+            self.on_evict(session)
+
+    def _checked(self, session_id: str) -> bool:
+        checked = _checked_sessions.get()
+        if checked is None:
+            return False
+        if session_id in checked:
+            return True
+        checked.add(session_id)
+        return False
+
+    def __getitem__(self, session_id: str) -> Session:
+        with self.lock:
+            session = self.cache.get(session_id)
+            if session is not None and self._checked(session_id):
+                self.last_used[session_id] = time.time()
+                return session
+            revision = self._revision(session_id)
+            if revision is None:
+                self._evict(session_id)
+                raise KeyError(session_id)
+            if session is None or session.revision != revision:
+                # another worker changed the session, requests of this worker still
+                # running keep the previous runtime objects until they are done
+                self._evict(session_id, release=False)
+                session = self._load(session_id)
+                self.cache[session_id] = session
+            self.last_used[session_id] = time.time()
+            return session
+
+    def __setitem__(self, session_id: str, data: dict):
+        with self.lock:
+            self._evict(session_id)
+            revision = self._revision(session_id) or 0
+            session = Session(session_id, {}, revision, self.factories)
+            for key, value in data.items():
+                session[key] = value
+            self.cache[session_id] = session
+            self.last_used[session_id] = time.time()
+            self.save(session_id)
+
+    def __delitem__(self, session_id: str):
+        with self.lock, self.conn:
+            self._evict(session_id)
+            self.conn.execute(
+                "DELETE FROM sessions WHERE session_id = ?", (session_id,)
+            )
+
+    def __contains__(self, session_id) -> bool:
+        try:
+            self[session_id]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT session_id FROM sessions").fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def cached(self) -> dict[str, Session]:
+        """The sessions cached by this worker"""
+        with self.lock:
+            return dict(self.cache)
+
+    def execution_lock(self, session_id: str) -> SessionLock:
+        """
+        The lock serializing the requests that change the session's graph or execution
+        history (compile, update, execute), in all the workers sharing the store.
+        Sessions have their own locks, so different sessions run concurrently.
+        """
+        with self.lock:
+            lock = self.execution_locks.get(session_id)
+            if lock is None:
+                filename = hashlib.sha1(str(session_id).encode()).hexdigest() + ".lock"
+                lock = SessionLock(os.path.join(self.lock_dir, filename))
+                self.execution_locks[session_id] = lock
+            return lock
+
+    def evict(self, session_id: str):
+        """Saves the session and releases its runtime objects, it is reloaded when used"""
+        with self.lock:
+            self.save(session_id)
+            self._evict(session_id)
+
+    def evict_idle(
+        self,
+        ttl_seconds: float,
+        max_bytes: int = None,
+        footprint: Callable[[Session], int] = None,
+        busy: Callable[[str], bool] = None,
+        min_idle_seconds: float = 60,
+    ) -> list[str]:
+        """
+        Evicts the cached sessions idle for more than ttl_seconds, then the least
+        recently used ones until the footprint of the others is under max_bytes.
+
+        Args:
+            ttl_seconds: Idle time after which a session is evicted
+            max_bytes: Memory budget of the cached sessions (default: no budget)
+            footprint: The estimated bytes of a session, required with max_bytes
+            busy: Whether a session is in use (i.e. it has running tasks), it is kept
+            min_idle_seconds: Sessions used more recently are kept, whatever the budget
+
+        Returns:
+            The evicted session ids
+        """
+        now = time.time()
+        with self.lock:
+            by_last_use = sorted(self.last_used.items(), key=lambda item: item[1])
+        candidates = [
+            session_id
+            for session_id, last_used in by_last_use
+            if now - last_used > min_idle_seconds
+            and (busy is None or not busy(session_id))
+        ]
+        evicted = [
+            session_id
+            for session_id in candidates
+            if now - self.last_used.get(session_id, now) > ttl_seconds
+        ]
+        if max_bytes is not None and footprint is not None:
+            sizes = {
+                session_id: footprint(session)
+                for session_id, session in self.cached().items()
+                if session_id not in evicted
+            }
+            total = sum(sizes.values())
+            for session_id in candidates:
+                if total <= max_bytes:
+                    break
+                if session_id in sizes:
+                    evicted.append(session_id)
+                    total -= sizes[session_id]
+        for session_id in evicted:
+            self.evict(session_id)
+        return evicted
+
+    def save(self, session_id: str):
+        """
+        Saves the serializable part of the session, if it changed.
+
+        The row is only replaced if it still has the revision the session was loaded
+        with. If another worker saved the session since, the keys changed here are
+        merged into its data, which is reloaded by the next request.
+        Raises SessionConflict if both workers changed the same key.
+        """
+        with self.lock:
+            session = self.cache.get(session_id)
+            if session is None:
+                return
+            saved = json.dumps(session.data, default=str)
+            if saved == session.saved:
+                return
+            if self._write(session_id, session.revision, saved):
+                session.revision += 1
+                session.saved = saved
+                return
+            # another worker saved a newer revision
+            self._evict(session_id, release=False)
+            while True:
+                row = self.conn.execute(
+                    "SELECT revision, data FROM sessions WHERE session_id = ?",
+                    (session_id,),
+                ).fetchone()
+                revision, stored = row if row is not None else (0, None)
+                merged = merge_saved(session.saved, saved, stored)
+                if merged is None:
+                    raise SessionConflict(
+                        f"Session {session_id} was changed by another worker"
+                    )
+                if self._write(session_id, revision, merged):
+                    return
+
+    def _write(self, session_id: str, revision: int, saved: str) -> bool:
+        # compare and swap on the revision, 0 for a session not saved yet
+        with self.conn:
+            cursor = self.conn.execute(
+                "UPDATE sessions SET revision = revision + 1, data = ?, updated = ? "
+                "WHERE session_id = ? AND revision = ?",
+                (saved, time.time(), session_id, revision),
+            )
+            if cursor.rowcount == 0 and revision == 0:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO sessions "
+                    "(session_id, revision, data, updated) VALUES (?, 1, ?, ?)",
+                    (session_id, saved, time.time()),
+                )
+        return cursor.rowcount == 1
+
+    def request_scope(self):
+        """
+        Marks the start of a request: each session is checked for changes by other
+        workers once per request. Returns a function saving the sessions used by the
+        request, to call when it ends.
+        """
+        checked = set()
+        _checked_sessions.set(checked)
+
+        def save_used():
+            conflicts = []
+            for session_id in checked:
+                try:
+                    self.save(session_id)
+                except SessionConflict as e:
+                    conflicts.append(e)
+            if conflicts:
+                raise conflicts[0]
+
+        return save_used
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def merge_saved(base: str, mine: str, theirs: str) -> str:
+    """
+    The saved data of another worker (theirs) with the keys changed here since base
+    applied, as JSON. Returns None if both sides changed the same key differently.
+    """
+    base = json.loads(base) if base is not None else {}
+    mine = json.loads(mine)
+    merged = json.loads(theirs) if theirs is not None else {}
+    for key in set(base) | set(mine):
+        if base.get(key) == mine.get(key):
+            continue
+        changed = key in merged and merged[key] != base.get(key)
+        if changed and merged[key] != mine.get(key):
+            return None
+        if key in mine:
+            merged[key] = mine[key]
+        else:
+            merged.pop(key, None)
+    return json.dumps(merged)
@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import threading
+import time
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable
+
+from autogen_core import CancellationToken
+
+
+class TaskCancelled(Exception):
+    """Raised by TaskRegistry.run when the task was cancelled with TaskRegistry.cancel"""
+
+
+class TrackedTask:
+    """A running execution, compilation or stream of a session that can be cancelled.
+
+    Cancelling it cancels its asyncio task, which cancels the awaits in flight
+    (i.e. the pending documents of a batch), and the autogen cancellation tokens
+    handed out while it runs (see cancellation_token).
+    """
+
+    def __init__(self, task_id: str, session_id: str, kind: str):
+        self.task_id = task_id
+        self.session_id = session_id
+        self.kind = kind
+        self.task = None
+        self.started = time.time()
+        self.cancel_requested = False
+        self.callbacks = []
+
+    def on_cancel(self, callback: Callable[[], None]):
+        if self.cancel_requested:
+            callback()
+        else:
+            self.callbacks.append(callback)
+
+    def run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def cancel(self):
+        self.cancel_requested = True
+        self.run_callbacks()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def info(self) -> dict:
+        return {
+            "task_id": self.task_id,
+            "session_id": self.session_id,
+            "kind": self.kind,
+            "started": self.started,
+            "seconds": time.time() - self.started,
+        }
+
+
+# the tracked task the current code runs in, inherited by the asyncio tasks it creates
+current_task: ContextVar[TrackedTask] = ContextVar("current_task", default=None)
+
+
+class TaskRegistry:
+    """The tracked tasks of all sessions"""
+
+    def __init__(self):
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def _add(self, session_id: str, kind: str) -> TrackedTask:
+        tracked = TrackedTask(f"{kind}-{next(self.ids)}", session_id, kind)
+        with self.lock:
+            self.tasks[tracked.task_id] = tracked
+        return tracked
+
+    def _remove(self, tracked: TrackedTask):
+        with self.lock:
+            self.tasks.pop(tracked.task_id, None)
+
+    async def run(
+        self,
+        session_id: str,
+        kind: str,
+        coro: Awaitable,
+        on_start: Callable[[str], None] = None,
+    ):
+        """
+        Runs the coroutine as a tracked task and returns its result.
+        If the caller is cancelled (i.e. the client disconnected), so is the task.
+        on_start is called with the task id before the task starts.
+
+        Raises:
+            TaskCancelled: The task was cancelled with cancel()
+        """
+        tracked = self._add(session_id, kind)
+        if on_start is not None:
+            on_start(tracked.task_id)
+
+        async def run_tracked():
+            current_task.set(tracked)
+            return await coro
+
+        tracked.task = asyncio.create_task(run_tracked())
+        try:
+            return await tracked.task
+        except asyncio.CancelledError:
+            tracked.run_callbacks()
+            if tracked.cancel_requested:
+                raise TaskCancelled(tracked.task_id)
+            raise
+        finally:
+            self._remove(tracked)
+
+    async def stream(
+        self, session_id: str, kind: str, iterator: AsyncIterator
+    ) -> AsyncIterator:
+        """
+        Iterates a streaming response as a tracked task. The response task is cancelled
+        by cancel(), and a client disconnect cancels the tokens handed out while streaming.
+        """
+        tracked = self._add(session_id, kind)
+        tracked.task = asyncio.current_task()
+        current_task.set(tracked)
+        finished = False
+        try:
+            async for chunk in iterator:
+                yield chunk
+            finished = True
+        finally:
+            if not finished:
+                tracked.run_callbacks()
+            self._remove(tracked)
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def cancel(
+        self, session_id: str, task_id: str = None, kind: str = None
+    ) -> list[str]:
+        """Cancels the session's tasks (all, or the one with task_id, or those of a kind)"""
+        with self.lock:
+            matching = [
+                tracked
+                for tracked in self.tasks.values()
+                if tracked.session_id == session_id
+                and (task_id is None or tracked.task_id == task_id)
+                and (kind is None or tracked.kind == kind)
+            ]
+        for tracked in matching:
+            tracked.cancel()
+        return [tracked.task_id for tracked in matching]
+
+    def running(self, session_id: str = None) -> list[dict]:
+        with self.lock:
+            return [
+                tracked.info()
+                for tracked in self.tasks.values()
+                if session_id is None or tracked.session_id == session_id
+            ]
+
+
+def cancellation_token() -> CancellationToken:
+    """An autogen CancellationToken, cancelled with the current tracked task if there is one"""
+    token = CancellationToken()
+    tracked = current_task.get()
+    if tracked is not None:
+        tracked.on_cancel(token.cancel)
+    return token
+
+
+# shared by all sessions
+task_registry = TaskRegistry()